@@ -0,0 +1,126 @@
+"""
+Writing the encoded examples in the background, so that the model does not wait for disk I/O.
+
+AsyncWriter takes items from a bounded queue and writes them on a background thread (or in a forked process). An
+error in the writer is raised in the producer on its next call to write(), flush() or close().
+"""
+
+import multiprocessing
+import queue
+import threading
+import traceback
+from typing import Callable
+
+
+class AsyncWriter(object):
+
+    def __init__(self, open_fn: Callable, write_fn: Callable, queue_size=64, use_process=False):
+        """
+        open_fn: called once by the writer, returns the output (e.g. an open file). It is closed when the writer
+                 is closed.
+        write_fn: called by the writer as write_fn(output, *item) for every item passed to write().
+        queue_size: the maximal number of items waiting to be written.
+        use_process: write in a forked process instead of a thread (items are then pickled).
+        """
+
+        self.open_fn = open_fn
+        self.write_fn = write_fn
+        self.closed = False
+
+        if use_process:
+            ctx = multiprocessing.get_context("fork")
+            self.queue, self.errors = ctx.JoinableQueue(queue_size), ctx.SimpleQueue()
+            self.worker = ctx.Process(target=self._run, daemon=True)
+        else:
+            self.queue, self.errors = queue.Queue(queue_size), queue.Queue()
+            self.worker = threading.Thread(target=self._run, daemon=True)
+
+        self.worker.start()
+
+    def _run(self):
+        output, failed = None, False
+
+        try:
+            output = self.open_fn()
+        except BaseException:
+            self.errors.put(traceback.format_exc())
+            failed = True
+
+        while True:
+            item = self.queue.get()
+
+            try:
+                if item is None:
+                    break
+
+                if not failed:  # after an error, the remaining items are dropped
+                    self.write_fn(output, *item)
+
+            except BaseException:
+                self.errors.put(traceback.format_exc())
+                failed = True
+
+            finally:
+                self.queue.task_done()
+
+        try:
+            if output is not None:
+                output.close()
+        except BaseException:
+            self.errors.put(traceback.format_exc())
+
+    def _check(self):
+        if not self.errors.empty():
+            raise RuntimeError("the writer failed:\n{}".format(self.errors.get()))
+
+    def _put(self, item, check=True) -> bool:
+        """
+        Put item in the queue, waiting while it is full.
+        check: raise the errors of the writer while waiting.
+        return: False if the writer exited (so the item will never be taken).
+        """
+
+        while True:
+            if check:
+                self._check()
+
+            try:
+                self.queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                if not self.worker.is_alive():
+                    return False
+
+    def write(self, *item):
+        assert not self.closed, "the writer is closed"
+
+        if not self._put(item):
+            raise RuntimeError("the writer exited unexpectedly")
+
+    def flush(self):
+        """
+        Wait until all the items written so far are written to the output.
+        """
+
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._put(None, check=False)  # the errors are raised below, once the writer has stopped
+            self.worker.join()
+
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            try:  # do not hide the original error
+                self.close()
+            except RuntimeError:
+                pass
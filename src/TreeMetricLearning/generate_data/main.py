@@ -2,6 +2,11 @@ import argparse
 import model
 from model_runner import ModelRunner
 import pickle
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "generate_dataset"))
+import corpus
+import elmo_encoder
 
 if __name__ == '__main__':
 
@@ -32,13 +37,20 @@ if __name__ == '__main__':
                         default='../data/external')
     parser.add_argument('--cuda-device', dest='cuda_device', type=int, default=0,
                         help='cuda device to run the LM on')
+    parser.add_argument('--elmo-vocab-size', dest='elmo_vocab_size', type=int, default=200000,
+                        help='number of most frequent words whose char-CNN representations ELMo computes once '
+                             '(0 to run the char-CNN on every token)')
 
     args = parser.parse_args()
 
     elmo_folder = args.elmo_folder
 
+    elmo_vocab = None
+    if args.elmo_vocab_size:
+        elmo_vocab = elmo_encoder.build_vocab(corpus.Corpus(args.input_wiki), max_size=args.elmo_vocab_size)
+
     model = model.Elmo(elmo_folder + '/elmo_2x4096_512_2048cnn_2xhighway_options.json',
                        elmo_folder + '/elmo_2x4096_512_2048cnn_2xhighway_weights.hdf5',
-                       args.cuda_device)
+                       args.cuda_device, vocab=elmo_vocab)
     model_runner = ModelRunner(model, args.input_wiki, args.output_data, persist=True)
     model_runner.run()
@@ -1,13 +1,18 @@
 from allennlp.commands.elmo import ElmoEmbedder
 from model_interface import ModelInterface
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "generate_dataset"))
+from elmo_encoder import CachedElmoEmbedder
 
 
 class Elmo(ModelInterface):
 
-    def __init__(self, elmo_options, elmo_weights, cuda_device):
+    def __init__(self, elmo_options, elmo_weights, cuda_device, vocab=None):
         options_file = elmo_options
         weight_file = elmo_weights
-        self.elmo = ElmoEmbedder(options_file, weight_file)#, cuda_device=cuda_device)
+        # the char-CNN representations of the words of vocab are computed once (see elmo_encoder.py)
+        self.elmo = CachedElmoEmbedder(options_file, weight_file, vocab=vocab)#, cuda_device=cuda_device)
 
     def run(self, sents, layer=-1):
         embeddings = self.elmo.embed_batch(sents)
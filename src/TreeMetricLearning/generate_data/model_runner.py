@@ -4,6 +4,13 @@ import numpy as np
 import utils
 import tqdm
 import random
+from async_writer import AsyncWriter
+
+
+def write_line(f, vecs, sentence: List[str]):
+    sent_str = " ".join(sentence)
+    vec_str = "*".join([utils.to_string(v) for v in vecs])
+    f.write(vec_str + "\t" + sent_str + "\n")
 
 
 class ModelRunner(object):
@@ -25,16 +32,11 @@ class ModelRunner(object):
         
         N = len(self.sentences)
 
-        with open(self.output_file, "w") as f:
+        # formatting and writing the vectors runs on a background thread, while the model runs on the next sentences
+        with AsyncWriter(lambda: open(self.output_file, "w"), write_line) as writer:
 
             for i in tqdm.tqdm(range(N)):
             
                 sents = [self.sentences[i]]
                 vecs = self.model.run(sents)[0]
-                sent_length = len(sents[0])
-                sent_str = " ".join(sents[0])
-                vec_str = "*".join([utils.to_string(v) for v in vecs])
-                #print("writing")
-                #print(vec_str)
-                #exit()
-                f.write(vec_str + "\t" + sent_str + "\n")
+                writer.write(vecs, sents[0])
@@ -1,3 +1,8 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "generate_dataset"))
+import corpus
+
 DEFAULT_PARAMS = {"file_name": "resources/wikipedia.sample.tokenized",
                   "pos2words_filename": "resources/pos2words.pickle",
                   "sentences_dict_filename": "resources/same_pos/sents.pickle",
@@ -19,12 +24,11 @@ DEFAULT_PARAMS = {"file_name": "resources/wikipedia.sample.tokenized",
 
 
 def read_sentences(fname):
-    with open(fname, "r") as f:
-        lines = f.readlines()
-
-    splitted = [line.strip().split(" ") for line in lines]
+    """
+    return: a lazy, indexable sequence of the sentences of fname (see corpus.py).
+    """
 
-    return splitted
+    return corpus.Corpus(fname)
 
 
 def to_string(np_array):
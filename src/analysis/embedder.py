@@ -24,6 +24,10 @@ from random_elmo import RandomElmoEmbedder
 import sys
 sys.path.append('src/generate_dataset')
 from collect_bert_states import BertLayerEmbedder
+from bert_encoder import BertWordEncoder
+from encoding_cache import model_id, module_id
+from elmo_encoder import CachedElmoEmbedder, build_vocab
+import corpus
 
 random.seed(0)
 from collections import Counter, defaultdict
@@ -32,21 +36,14 @@ from tqdm.auto import tqdm
 
 class Embedder(object):
     def __init__(self):
-        pass
+        self.cache = None  # an EncodingCache (see encoding_cache.py) of the embedder, if any
 
     def _load_sents(self, wiki_path, num_sents, max_length=35) -> List[List[str]]:
         print("Loading sentences...")
 
-        with open(wiki_path, "r", encoding="utf8") as f:
-            lines = f.readlines()
-            lines = [line.strip().split(" ") for line in lines]
+        lines = corpus.Corpus(wiki_path).filter_length(max_length=max_length)
 
-        if max_length is not None:
-            lines = list(filter(lambda sentence: len(sentence) < max_length, lines))
-
-        lines = lines[:num_sents]
-
-        return lines
+        return list(lines[:num_sents])
 
     def _embedder(self, sentence: List[str]) -> np.ndarray:
         raise NotImplementedError()
@@ -62,22 +59,36 @@ class Embedder(object):
 
 class EmbedElmo(Embedder):
 
-    def __init__(self, params: Dict, device: int = 0):
+    def __init__(self, params: Dict, device: int = 0, cache=None, vocab_size=200000):
 
         Embedder.__init__(self)
         elmo_options_path = params['elmo_options_path']
         elmo_weights_path = params['elmo_weights_path']
         self.embedder = self._load_elmo(elmo_weights_path, elmo_options_path, device=device)
+        self.vocab_size = vocab_size  # words whose char-CNN representations are computed once (0 for none)
+
+        self.cache = cache
+        if cache is not None:
+            self.model_id = model_id("elmo", elmo_options_path, elmo_weights_path)
 
     def _load_elmo(self, elmo_weights_path, elmo_options_path, device=0):
 
         print("Loading ELMO...")
-        return ElmoEmbedder(elmo_options_path, elmo_weights_path, cuda_device=device)
+        return CachedElmoEmbedder(elmo_options_path, elmo_weights_path, cuda_device=device)
+
+    def _embed_batch(self, sentences: List[List[str]]) -> List[np.ndarray]:
+        if self.cache is None:
+            return self.embedder.embed_batch(sentences)
+
+        return self.cache.encode(sentences, self.model_id, self.embedder.embed_batch)
 
     def run_embedder(self, sentences: List[List[str]]) -> List[Tuple[np.ndarray, str]]:
 
         print("Running ELMO...")
 
+        if isinstance(self.embedder, CachedElmoEmbedder) and self.vocab_size:
+            self.embedder.set_vocab(build_vocab(sentences, max_size=self.vocab_size))
+
         elmo_embeddings = []
 
         temp_list = []
@@ -85,13 +96,13 @@ class EmbedElmo(Embedder):
             temp_list.append(sent)
 
             if len(temp_list) > 500:
-                batch_embeds = self.embedder.embed_batch(temp_list)
+                batch_embeds = self._embed_batch(temp_list)
                 for sent, emb in zip(temp_list, batch_embeds):
                     elmo_embeddings.append((emb, sent))
                 temp_list = []
 
         if len(temp_list) > 0:
-            batch_embeds = self.embedder.embed_batch(temp_list)
+            batch_embeds = self._embed_batch(temp_list)
             for sent, emb in zip(temp_list, batch_embeds):
                 elmo_embeddings.append((emb, sent))
 
@@ -111,83 +122,20 @@ class EmbedElmo(Embedder):
 
 class BertEmbedder(Embedder):
 
-        def __init__(self, device, layers=[1, 16, "mean"):
-        
+        def __init__(self, device, layers=[1, 16, "mean"], pooling="last", cache=None):
+
+                Embedder.__init__(self)
                 self.cuda_device = device
-                self.tokenizer = BertTokenizer.from_pretrained('bert-large-uncased-whole-word-masking')
-                self.model = BertForMaskedLM.from_pretrained('bert-large-uncased-whole-word-masking', output_hidden_states = True, output_attentions = True)
-                #self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-                #self.model = BertForMaskedLM.from_pretrained('bert-base-uncased', output_hidden_states = True, output_attentions = True)
-                self.model.eval()
-                self.model.to('cuda:{}'.format(self.cuda_device))
-                self.num_vecs = len(layers)            
-                self.use_mean, self.layers = "mean" in layers, [l for l in layers if l != "mean"]         
-
-        def _tokenize(self, original_sentence: List[str]) -> Tuple[List[str], Dict[int, int]]:
-    
-                """
-                Parameters
-                ----------
-                Returns
-                -------
-                bert_tokens: The sentence, tokenized by BERT tokenizer.
-                orig_to_tok_map: An output dictionary consisting of a mapping (alignment) between indices in the original tokenized sentence, and indices in the sentence tokenized by the BERT tokenizer. See https://github.com/google-research/bert
-                """
-
-                bert_tokens = ["[CLS]"]
-                orig_to_tok_map = {}
-                has_subwords = False
-                is_subword = []
-        
-                for i, w in enumerate(original_sentence):
-            
-                        tokenized_w = self.tokenizer.tokenize(w)
-                        has_subwords = len(tokenized_w) > 1
-                        is_subword.append(has_subwords)
-                        bert_tokens.extend(tokenized_w)
-            
-                        orig_to_tok_map[i] = len(bert_tokens) - 1
-                  
-                bert_tokens.append("[SEP]")
-        
-                return (bert_tokens, orig_to_tok_map)
+                self.encoder = BertWordEncoder(device, layers, pooling=pooling, cache=cache)
+                self.num_vecs = len(layers)
 
         def run_embedder(self, sentences: List[List[str]]) -> List[Tuple[np.ndarray, str]]:
 
                 print("Running BERT...")
 
-                bert_embeddings = []
-                
-                for sent in tqdm(sentences, ascii=True):
-                
-                         bert_tokens, orig_to_tok_map = self._tokenize(sent)
-                         sent_len = len(sent)
-                         embeddings = np.zeros((sent_len, self.num_vecs * 1024))
-
-                         
-                         indexed_tokens = self.tokenizer.convert_tokens_to_ids(bert_tokens)
-                         tokens_tensor = torch.tensor([indexed_tokens]).to('cuda:{}'.format(self.cuda_device)) 
-                           
-                         with torch.no_grad():
-
-                                all_hidden_states, all_attentions = self.model(tokens_tensor)[-2:]
-                                layers = [all_hidden_states[layer].squeeze() for layer in self.layers]
-                                vecs = torch.cat(layers, dim = 1)  #.detach().cpu().numpy()
-       	       	       	       	
-                                if self.use_mean:
-
-                                    mean_vecs = torch.mean(torch.cat(all_hidden_states, dim = 0), dim = 0)#.detach().cpu().numpy()
-                                    vecs = torch.cat((vecs, mean_vecs), dim = 1)
-                                
-                                vecs = vecs.detach().cpu().numpy()
-
-                                for j in range(sent_len):  
-                                        
-                                        embeddings[j] = vecs[orig_to_tok_map[j]]
-                         
-                         bert_embeddings.append((embeddings, sent))     
-
-                return bert_embeddings   
+                bert_embeddings = self.encoder.encode(sentences, verbose=True)
+
+                return list(zip(bert_embeddings, sentences))
     
     
     
@@ -206,7 +154,7 @@ class EmbedRandomElmo(EmbedElmo):
                                   random_emb=random_emb, random_lstm=random_lstm)
 
 class EmbedBert(Embedder):
-    def __init__(self, params: Dict, device: int = 0):
+    def __init__(self, params: Dict, device: int = 0, cache=None):
         Embedder.__init__(self)
 
         bert_name = 'bert-large-uncased'
@@ -216,13 +164,22 @@ class EmbedBert(Embedder):
         # self.embedder = BertLayerEmbedder(bert_model).eval()
         self.embedder = PretrainedBertEmbedder(bert_name)
 
+        self.cache = cache
+        if cache is not None:
+            self.model_id = module_id("allennlp/" + bert_name, self.embedder)
+
     def run_embedder(self, sentences: List[List[str]]) -> List[Tuple[List[np.ndarray], str]]:
         print("Running Bert...")
 
         bert_embeddings = []
 
         for sent in tqdm(sentences, ascii=True):
-            bert_embeddings.append((self._embedder(sent), sent))
+            if self.cache is not None:
+                vecs = self.cache.encode([sent], self.model_id, lambda missing: [self._embedder(missing[0])])[0]
+            else:
+                vecs = self._embedder(sent)
+
+            bert_embeddings.append((vecs, sent))
 
         return bert_embeddings
 
@@ -1,8 +1,9 @@
-from embedder import EmbedElmo, EmbedBert, EmbedRandomElmo
+from embedder import EmbedElmo, EmbedBert, EmbedRandomElmo, BertEmbedder
 import pickle
 import evaluate
 import argparse
 import syntactic_extractor
+from encoding_cache import EncodingCache, GB
 
 if __name__ == '__main__':
 
@@ -37,6 +38,14 @@ if __name__ == '__main__':
     parser.add_argument('--embedder_type', dest='embedder_type', type=str,
                         default="elmo", help='elmo / elmo_rand_lstm / elmo_rand_all / bert')
     parser.add_argument('--layers', '--list', dest = "layers", help='list of bert/elmo layers to include', type=str, default = "16,mean")
+    parser.add_argument('--elmo-vocab-size', dest='elmo_vocab_size', type=int, default=200000,
+                        help='number of most frequent words whose char-CNN representations ELMo computes once '
+                             '(0 to run the char-CNN on every token)')
+    parser.add_argument('--cache-dir', dest='cache_dir', type=str, default='',
+                        help='directory of a persistent cache of encoded sentences (no cache if empty). '
+                             'not used by the random elmo embedders')
+    parser.add_argument('--cache-size-gb', dest='cache_size_gb', type=float, default=10,
+                        help='maximal size of the encoding cache; least recently used sentences are evicted')
 
     args = parser.parse_args()
     layers = [int(item) if item.isdigit() else item for item in args.layers.split(',')]
@@ -49,18 +58,22 @@ if __name__ == '__main__':
     # recalculate representations
     else:
         embedder_type = args.embedder_type
+        cache = EncodingCache(args.cache_dir, max_bytes=int(args.cache_size_gb * GB)) if args.cache_dir else None
         options = {'elmo_options_path': args.elmo_folder + '/elmo_2x4096_512_2048cnn_2xhighway_options.json',
                    'elmo_weights_path': args.elmo_folder + '/elmo_2x4096_512_2048cnn_2xhighway_weights.hdf5'}
         if embedder_type == 'elmo':
-            embedder = EmbedElmo(options, device=args.cuda_device)
+            embedder = EmbedElmo(options, device=args.cuda_device, cache=cache, vocab_size=args.elmo_vocab_size)
         elif embedder_type == 'elmo_rand_lstm':
             embedder = EmbedRandomElmo(options, device=args.cuda_device, random_emb=False, random_lstm=True)
         elif embedder_type == 'elmo_rand_all':
             embedder = EmbedRandomElmo(options, device=args.cuda_device, random_emb=True, random_lstm=True)
         else:
-            embedder = BertEmbedder(device=args.cuda_device, layers = layers)
+            embedder = BertEmbedder(device=args.cuda_device, layers = layers, cache=cache)
         data = embedder.get_data(args.input_wiki, args.num_sents)
         sentence_reprs = evaluate.get_sentence_representations(data)
+
+        if cache is not None:
+            print(cache.report())
         
         with open(args.encoded_data, "wb") as f:
             pickle.dump(sentence_reprs, f)
@@ -0,0 +1,51 @@
+"""
+Benchmark the masked-LM generators on the CPU: sentences/sec of BatchedOnlineBertGenerator
+with fp32 and dynamically-quantized (int8) weights, for bert-base and bert-large.
+"""
+
+import argparse
+import time
+import generators
+
+
+def benchmark(args, bert_model, quantize) -> float:
+
+    generator = generators.BatchedOnlineBertGenerator(args.input_wiki, "", args.num_sentences, topn=25,
+                                                      maintain_pos=False, cuda_device=-1,
+                                                      max_batch_tokens=args.max_batch_tokens, bert_model=bert_model,
+                                                      quantize=quantize, num_threads=args.num_threads)
+    indices = list(range(min(args.num_sents, len(generator.sentences))))
+
+    start = time.time()
+    for _ in generator._generate_groups(indices):
+        pass
+
+    return len(indices) / (time.time() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CPU generation benchmark',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--input-wiki', dest='input_wiki', type=str,
+                        default='../../data/external/wiki.clean.250k',
+                        help='name of the source wikipedia text file')
+    parser.add_argument('--num-sents', dest='num_sents', type=int, default=200,
+                        help='number of source sentences to generate from')
+    parser.add_argument('--num-sentences', dest='num_sentences', type=int, default=7,
+                        help='Number of equivalent sentences to generate from each sentence.')
+    parser.add_argument('--num-threads', dest='num_threads', type=int, default=0,
+                        help='number of CPU threads used by torch (0 for the default)')
+    parser.add_argument('--max-batch-tokens', dest='max_batch_tokens', type=int, default=4096,
+                        help='token budget of each (cross-sentence) batch')
+    parser.add_argument('--bert-models', dest='bert_models', type=str,
+                        default='bert-base-uncased,bert-large-uncased-whole-word-masking',
+                        help='comma-separated list of models to benchmark')
+
+    args = parser.parse_args()
+
+    print("{:<40}{:>10}{:>16}".format("model", "weights", "sents/sec"))
+
+    for bert_model in args.bert_models.split(","):
+        for quantize in [False, True]:
+            speed = benchmark(args, bert_model, quantize)
+            print("{:<40}{:>10}{:>16.2f}".format(bert_model, "int8" if quantize else "fp32", speed))
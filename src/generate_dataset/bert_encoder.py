@@ -0,0 +1,162 @@
+"""
+A batched BERT encoder of pre-tokenized sentences, that returns one vector per word (not per wordpiece).
+
+With an encoding cache (see encoding_cache.py), the pooled vectors of all the hidden states of a sentence are cached,
+and the layers are selected from them.
+"""
+
+from typing import List, Tuple
+
+import numpy as np
+import torch
+import tqdm
+from pytorch_transformers import BertTokenizer, BertModel
+
+import utils
+from encoding_cache import EncodingCache, module_id
+
+
+class BertWordEncoder(object):
+
+    def __init__(self, cuda_device=0, layers=(1, 16, -1), bert_model='bert-large-uncased-whole-word-masking',
+                 pooling="last", max_batch_tokens=8192, cache: EncodingCache = None):
+        """
+        cuda_device: the GPU to run on (-1 for the CPU).
+        layers: indices of hidden states to return (0 is the embedding layer), and/or "mean" for the mean of all
+                hidden states. The vector of a word is the concatenation of these, in this order.
+        pooling: "last" - a word is represented by its last wordpiece (as in the original implementation);
+                 "mean" - by the mean of its wordpieces.
+        max_batch_tokens: the maximal number of (padded) wordpieces in a batch.
+        cache: an encoding cache to read the vectors from, and store them in.
+        """
+
+        assert pooling in ("last", "mean")
+
+        self.device = 'cpu' if cuda_device < 0 else 'cuda:{}'.format(cuda_device)
+        self.tokenizer = BertTokenizer.from_pretrained(bert_model)
+        self.model = BertModel.from_pretrained(bert_model, output_hidden_states=True)
+        self.model.eval()
+        self.model.to(self.device)
+
+        self.layers = list(layers)
+        self.pooling = pooling
+        self.max_batch_tokens = max_batch_tokens
+        self.num_vecs = len(self.layers)
+        self.wordpiece_cache = dict()
+        self.cache = cache
+        self.model_id = module_id("{}/{}".format(bert_model, pooling), self.model) if cache is not None else None
+
+    def _wordpieces(self, w: str) -> List[int]:
+        if w not in self.wordpiece_cache:
+            self.wordpiece_cache[w] = self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(w))
+
+        return self.wordpiece_cache[w]
+
+    def tokenize(self, sentence: List[str]) -> Tuple[List[int], List[Tuple[int, int]]]:
+        """
+        return: the wordpiece ids of the sentence (including [CLS] and [SEP]), and the (start, end) positions of the
+                wordpieces of each word. A word without wordpieces is represented by the previous wordpiece,
+                like orig_to_tok_map of the original implementation.
+        """
+
+        cls_id, sep_id = self.tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+        ids, spans = [cls_id], []
+
+        for w in sentence:
+            wordpieces = self._wordpieces(w)
+            start = len(ids) if wordpieces else len(ids) - 1
+            ids.extend(wordpieces)
+            spans.append((start, len(ids)))
+
+        ids.append(sep_id)
+
+        return ids, spans
+
+    def _encode_batch(self, tokenized: List[Tuple[List[int], List[Tuple[int, int]]]],
+                      all_layers=False) -> List[np.ndarray]:
+        """
+        all_layers: return all the hidden states, (num hidden states, num words, hidden size) for each sentence,
+                    instead of the concatenation of the selected layers.
+        """
+
+        max_len = max(len(ids) for ids, _ in tokenized)
+        token_ids = torch.zeros((len(tokenized), max_len), dtype=torch.long)
+        attention_mask = torch.zeros((len(tokenized), max_len), dtype=torch.long)
+
+        # the rows of the flattened (batch * max_len) hidden states to pool, and the word each of them belongs to
+
+        rows, word_ids = [], []
+        num_words = 0
+
+        for b, (ids, spans) in enumerate(tokenized):
+            token_ids[b, :len(ids)] = torch.tensor(ids)
+            attention_mask[b, :len(ids)] = 1
+
+            for start, end in spans:
+                positions = range(end - 1, end) if self.pooling == "last" else range(start, end)
+                rows.extend(b * max_len + p for p in positions)
+                word_ids.extend([num_words] * len(positions))
+                num_words += 1
+
+        rows = torch.tensor(rows, device=self.device)
+        word_ids = torch.tensor(word_ids, device=self.device)
+
+        with torch.no_grad():
+            hidden_states = self.model(token_ids.to(self.device), attention_mask=attention_mask.to(self.device))[-1]
+
+            if all_layers:
+                vecs = torch.stack(hidden_states, dim=2)  # (batch, max_len, num hidden states, hidden size)
+            else:
+                vecs = [hidden_states[layer] if layer != "mean" else torch.mean(torch.stack(hidden_states), dim=0)
+                        for layer in self.layers]
+                vecs = torch.cat(vecs, dim=-1)  # (batch, max_len, num_vecs * hidden size)
+
+            vecs = vecs.reshape(len(tokenized) * max_len, -1)[rows]
+
+            if self.pooling == "mean":
+                counts = torch.bincount(word_ids, minlength=num_words).to(vecs.dtype)
+                vecs = torch.zeros((num_words, vecs.shape[-1]), dtype=vecs.dtype, device=self.device).index_add_(
+                    0, word_ids, vecs) / counts[:, None]
+
+            vecs = vecs.cpu().numpy()
+
+        splits = np.cumsum([len(spans) for _, spans in tokenized])[:-1]
+
+        if all_layers:
+            vecs = vecs.reshape(num_words, len(hidden_states), -1).transpose(1, 0, 2)
+            return np.split(vecs, splits, axis=1)
+
+        return np.split(vecs, splits)
+
+    def _encode(self, sentences: List[List[str]], all_layers=False, verbose=False) -> List[np.ndarray]:
+        tokenized = [self.tokenize(sentence) for sentence in sentences]
+        batches = utils.pack_batches([len(ids) for ids, _ in tokenized], self.max_batch_tokens)
+        embeddings = [None] * len(sentences)
+
+        for batch in (tqdm.tqdm(batches, ascii=True) if verbose else batches):
+            for k, vecs in zip(batch, self._encode_batch([tokenized[k] for k in batch], all_layers)):
+                embeddings[k] = vecs
+
+        return embeddings
+
+    def select_layers(self, all_layers: np.ndarray) -> np.ndarray:
+        """
+        all_layers: the hidden states of a sentence, (num hidden states, num words, hidden size).
+        return: the selected layers, (num words, num_vecs * hidden size).
+        """
+
+        return np.concatenate([all_layers[layer] if layer != "mean" else np.mean(all_layers, axis=0)
+                               for layer in self.layers], axis=-1)
+
+    def encode(self, sentences: List[List[str]], verbose=False) -> List[np.ndarray]:
+        """
+        return: for each sentence, an array of shape (num words, num_vecs * hidden size).
+        """
+
+        if self.cache is None:
+            return self._encode(sentences, verbose=verbose)
+
+        all_layers = self.cache.encode(sentences, self.model_id,
+                                       lambda missing: self._encode(missing, all_layers=True, verbose=verbose))
+
+        return [self.select_layers(sentence_layers) for sentence_layers in all_layers]
@@ -2,9 +2,16 @@ import argparse
 import numpy as np
 # import sys
 import pickle
-from typing import List
+from typing import Dict, List, Union
 import utils
+import shards
+import groups_store
+from hdf5_writer import AsyncHDF5Writer
 import h5py
+import storage
+import sharding
+import encoding_cache
+import torch
 
 from pytorch_pretrained_bert.modeling import BertConfig, BertModel
 
@@ -14,6 +21,7 @@ from allennlp.data.instance import Instance
 from allennlp.data.token_indexers.wordpiece_indexer import PretrainedBertIndexer
 from allennlp.data.tokenizers import Token
 from allennlp.data.vocabulary import Vocabulary
+from allennlp.modules.scalar_mix import ScalarMix
 from allennlp.modules.token_embedders.bert_token_embedder import BertEmbedder
 
 from tqdm import tqdm
@@ -26,6 +34,16 @@ from allennlp.nn import util
 
 # sys.path.append("../../../src/generate_dataset")
 FUNCTION_WORDS = utils.DEFAULT_PARAMS["function_words"]
+LAYER_MEAN, LAYER_MIX = "mean", "mix"
+
+
+def parse_layers(layers: str) -> List[Union[int, str]]:
+    """
+    layers: comma separated layers of bert: layer ids (negative ids count from the top), "mean" (the average of
+            all the layers) and "mix" (their scalar mix, see BertLayerEmbedder).
+    """
+
+    return [item if item in (LAYER_MEAN, LAYER_MIX) else int(item) for item in layers.split(",")]
 
 
 class BertLayerEmbedder(BertEmbedder):
@@ -50,19 +68,26 @@ class BertLayerEmbedder(BertEmbedder):
         The number of starting special tokens input to BERT (usually 1, i.e., [CLS])
     num_end_tokens : int, optional (default: 1)
         The number of ending tokens input to BERT (usually 1, i.e., [SEP])
+    mix_weights : List[float], optional (default: equal weights)
+        The (unnormalized) weights of the layers in the "mix" layer, a ``ScalarMix`` of all the layers.
     """
     def __init__(self,
                  bert_model: BertModel,
                  max_pieces: int = 512,
                  num_start_tokens: int = 1,
-                 num_end_tokens: int = 1) -> None:
+                 num_end_tokens: int = 1,
+                 mix_weights: List[float] = None) -> None:
         super().__init__(bert_model, True, max_pieces, num_start_tokens, num_end_tokens)
 
+        num_layers = bert_model.config.num_hidden_layers
+        self.layer_mix = ScalarMix(num_layers, initial_scalar_parameters=mix_weights or [0.0] * num_layers,
+                                   trainable=False)
+
     def forward(self,
                 input_ids: torch.LongTensor,
                 offsets: torch.LongTensor = None,
                 token_type_ids: torch.LongTensor = None,
-                layer_id: int =-1) -> torch.Tensor:
+                layer_id: Union[int, str, List[Union[int, str]]] = -1) -> torch.Tensor:
         """
         Parameters
         ----------
@@ -87,6 +112,9 @@ class BertLayerEmbedder(BertEmbedder):
             tokens from the first sentence should have type 0 and tokens from
             the second sentence should have type 1.  If you don't provide this
             (the default BertIndexer doesn't) then it's assumed to be all 0s.
+        layer_id : ``int``, ``str`` or a list of them, optional
+            The layer to return (see ``parse_layers``). If a list of layers is given, the list of their
+            embeddings is returned, all from the same forward pass of BERT.
         """
         # pylint: disable=arguments-differ
         batch_size, full_seq_len = input_ids.size(0), input_ids.size(-1)
@@ -181,17 +209,30 @@ class BertLayerEmbedder(BertEmbedder):
         # (layers, batch_size * d1 * ... * dn, sequence_length, embedding_dim)
         # recombined = torch.cat(combined, dim=2)
         input_mask = (recombined_embeddings != 0).long()
+        dims = initial_dims if needs_split else input_ids.size()
 
-        if self._scalar_mix is not None:
-            mix = self._scalar_mix(recombined_embeddings, input_mask)
-        else:
-            mix = recombined_embeddings[layer_id]
+        if isinstance(layer_id, (list, tuple)):
+            return [self._select_tokens(self._select_layer(recombined_embeddings, input_mask, layer), offsets, dims)
+                    for layer in layer_id]
+
+        return self._select_tokens(self._select_layer(recombined_embeddings, input_mask, layer_id), offsets, dims)
 
-        # At this point, mix is (batch_size * d1 * ... * dn, sequence_length, embedding_dim)
+    def _select_layer(self, recombined_embeddings: torch.Tensor, input_mask: torch.LongTensor,
+                      layer_id: Union[int, str]) -> torch.Tensor:
+        if layer_id == LAYER_MEAN:
+            return recombined_embeddings.mean(dim=0)
+        elif layer_id == LAYER_MIX:
+            return self.layer_mix(recombined_embeddings, input_mask)
+        elif self._scalar_mix is not None:
+            return self._scalar_mix(recombined_embeddings, input_mask)
+
+        return recombined_embeddings[layer_id]
+
+    def _select_tokens(self, mix: torch.Tensor, offsets: torch.LongTensor, dims) -> torch.Tensor:
+        # mix is (batch_size * d1 * ... * dn, sequence_length, embedding_dim)
 
         if offsets is None:
             # Resize to (batch_size, d1, ..., dn, sequence_length, embedding_dim)
-            dims = initial_dims if needs_split else input_ids.size()
             return util.uncombine_initial_dims(mix, dims)
         else:
             # offsets is (batch_size, d1, ..., dn, orig_sequence_length)
@@ -211,16 +252,19 @@ def get_equivalent_sentences(equivalent_sentences_path: str, num_sentences: int)
     # e.g., if the length of the sentences in the first group is L=20,
     # then sentences[0] is a KxL=15x20 list, where position i,j contains the jth word in the ith sentence.
 
-    with open(equivalent_sentences_path, "rb") as f:
-        sentences = pickle.load(f)  # a list of groups. each group is a list of lists of strings
-        sentences = list(sentences.values())
+    sentences = shards.load_equivalent_sentences(equivalent_sentences_path)
+    sentences = groups_store.group_list(sentences)  # a list of groups. each group is a list of lists of strings
 
     return sentences[:num_sentences]
 
 
-def get_bert_states(sentence_group: List[List[str]], embedder, layer: int):
+def _run_bert(sentences: List[List[str]], embedder, layers: List[Union[int, str]]) -> np.ndarray:
+    """
+    return: the states of the layers, (num layers, num sentences, sentence length, D).
+    """
+
     instances = []
-    for sen in sentence_group:
+    for sen in sentences:
         toks = [Token(w) for w in sen]
 
         instance = Instance({"tokens": TextField(toks, {"bert": token_indexer})})
@@ -233,32 +277,97 @@ def get_bert_states(sentence_group: List[List[str]], embedder, layer: int):
     tensor_dict = batch.as_tensor_dict(padding_lengths)
     tokens = tensor_dict["tokens"]
 
-    bert_vectors = embedder(tokens["bert"], offsets=tokens["bert-offsets"], layer_id=layer)
+    bert_vectors = embedder(tokens["bert"], offsets=tokens["bert-offsets"], layer_id=layers)
+
+    return np.stack([vectors.data.numpy() for vectors in bert_vectors])
+
+
+def _cached_layers(embedder) -> List[Union[int, str]]:
+    # the layers kept in the cache for every sentence: all the layers of bert, and their mean
+    return list(range(embedder.bert_model.config.num_hidden_layers)) + [LAYER_MEAN]
+
+
+def _select_cached_layers(cached: np.ndarray, embedder, layers: List[Union[int, str]]) -> np.ndarray:
+    """
+    cached: the states of the cached layers (see _cached_layers), (num layers + 1, num sentences, sentence length, D).
+    return: the states of layers, (len(layers), num sentences, sentence length, D).
+    """
+
+    selected = []
+
+    for layer in layers:
+        if layer == LAYER_MEAN:
+            selected.append(cached[-1])
+        elif layer == LAYER_MIX:
+            with torch.no_grad():
+                selected.append(embedder.layer_mix(torch.from_numpy(cached[:-1])).numpy())
+        else:
+            selected.append(cached[:-1][layer])
+
+    return np.stack(selected)
+
+
+def get_bert_states(sentence_group: List[List[str]], embedder,
+                    layer: Union[int, str, List[Union[int, str]]], cache=None,
+                    model_id: str = None) -> Union[np.ndarray, Dict[str, np.ndarray]]:
+    """
+    layer: a layer, or a list of layers (see parse_layers).
+    cache: an optional encoding_cache.EncodingCache, in which all the layers of each sentence are kept under
+           model_id (see cache_id). The requested layers are selected (or mixed) after reading them, so any other
+           layers are then read from the cache too.
+    return: the states of the layer, or a dict of the states of each of the layers, {str(layer): states}.
+    """
 
-    return bert_vectors.data.numpy()
+    layers = layer if isinstance(layer, list) else [layer]
+
+    if cache is None:
+        states = _run_bert(sentence_group, embedder, layers)
+    else:
+        cached_layers = _cached_layers(embedder)
+        sentence_states = cache.encode(sentence_group, model_id, lambda sentences: list(
+            _run_bert(sentences, embedder, cached_layers).swapaxes(0, 1)))
+        states = _select_cached_layers(np.stack(sentence_states, axis=1), embedder, layers)
+
+    if isinstance(layer, list):
+        return {str(layer_id): layer_states for layer_id, layer_states in zip(layer, states)}
+
+    return states[0]
+
+
+def cache_id(embedder) -> str:
+    """
+    return: the model id of the states of bert in the encoding cache. It changes with the weights of bert.
+    """
+
+    return encoding_cache.module_id("bert-states", embedder.bert_model)
 
 
 def save_bert_states(embedder, equivalent_sentences: List[List[List[str]]], output_file: str,
-                     layer: int):
+                     layer, storage_dtype="float32", codec="gzip:4", shard=None, cache=None):
+    """
+    layer: a layer, whose states are saved as "vecs", or a list of layers, whose states are computed in the same
+           forward pass and saved as "vecs_<layer>" (see hdf5_writer.write_group).
+    shard: (i, n) - save only shard i of n, into its shard file (see sharding.py).
+    cache: an optional encoding_cache.EncodingCache, so that the sentences encoded before are not encoded again.
+    """
 
-    with h5py.File(output_file, 'w') as h5:
-        for i, group_of_equivalent_sentences in tqdm(enumerate(equivalent_sentences)):
-            bert_states = get_bert_states(group_of_equivalent_sentences, embedder, layer)
-            # if the length (num of words) of the group i is L, and there are K=15 sentences in the group,
-            # then bert_states is a numpy array of dims KxLxD where D is the size of the bert vectors.
+    indices = range(len(equivalent_sentences))
+    if shard is not None:
+        output_file = sharding.shard_path(output_file, *shard)
+        indices = sharding.shard_indices(len(equivalent_sentences), *shard)
 
-            L = len(group_of_equivalent_sentences[0])  # group's sentence length
-            content_indices = np.array([i for i in range(L) if group_of_equivalent_sentences[0][i] not in FUNCTION_WORDS])
+    model_id = cache_id(embedder) if cache is not None else None
 
-            sents = np.array(group_of_equivalent_sentences, dtype=object)
+    # the groups are compressed and written on a background thread, while bert runs on the next ones
+    with AsyncHDF5Writer(output_file, storage_dtype=storage_dtype, codec=codec) as writer:
+        for i in tqdm(indices):
+            group_of_equivalent_sentences = equivalent_sentences[i]
+            bert_states = get_bert_states(group_of_equivalent_sentences, embedder, layer, cache, model_id)
+            # if the length (num of words) of the group i is L, and there are K=15 sentences in the group,
+            # then bert_states is a numpy array of dims KxLxD where D is the size of the bert vectors
+            # (or a dict of such arrays, one per layer).
 
-            # data.append(bert_states)
-            g = h5.create_group(str(i))
-            g.attrs['group_size'], g.attrs['sent_length'] = sents.shape
-            g.create_dataset('vecs', data=bert_states, compression=True, chunks=True)
-            dt = h5py.special_dtype(vlen=str)
-            g.create_dataset('sents', data=sents, dtype=dt, compression=True, chunks=True)
-            g.create_dataset('content_indices', data=content_indices, compression=True, chunks=True)
+            writer.write_group(str(i), group_of_equivalent_sentences, bert_states)
 
 
 if __name__ == "__main__":
@@ -277,8 +386,29 @@ if __name__ == "__main__":
                         help='The size of bert\'s vocabulary')
     parser.add_argument('--num-sentences', dest='num_sentences', type=int, default=999999999,
                         help='The amount of group sentences to use')
-    parser.add_argument('--layer', dest='layer', type=int, default=-1,
-                        help='The layer of bert to persist')
+    parser.add_argument('--layers', '--layer', dest='layers', type=str, default='-1',
+                        help='comma separated layers of bert to persist: layer ids, mean (of all the layers) and '
+                             'mix (a scalar mix of all the layers). all the layers are computed in one pass and '
+                             'stored in the datasets vecs_<layer>; vecs is the first one')
+    parser.add_argument('--mix-weights', dest='mix_weights', type=str, default='',
+                        help='comma separated weights of the layers in mix, normalized with a softmax '
+                             '(equal weights if empty)')
+    parser.add_argument('--storage-dtype', dest='storage_dtype', type=str, default='float32',
+                        choices=storage.STORAGE_DTYPES,
+                        help='dtype in which the vectors are stored. readers upcast them back to float32')
+    parser.add_argument('--codec', dest='codec', type=str, default='gzip:4',
+                        help='compression of the stored vectors: none / lzf / gzip:N')
+    parser.add_argument('--num-workers', dest='num_workers', type=int, default=1,
+                        help='number of processes encoding the groups in parallel, each into its own shard. '
+                             'the shards are merged into the output file')
+    parser.add_argument('--shard', dest='shard', type=str, default='',
+                        help='i/n - encode only shard i of n (merge the shards with sharding.py)')
+    parser.add_argument('--num-threads', dest='num_threads', type=int, default=0,
+                        help='torch threads per process (0 for the default, or an even share with --num-workers)')
+    parser.add_argument('--cache-dir', dest='cache_dir', type=str, default='',
+                        help='directory of a persistent cache of encoded sentences (no cache if empty)')
+    parser.add_argument('--cache-size-gb', dest='cache_size_gb', type=float, default=10,
+                        help='maximal size of the encoding cache; least recently used sentences are evicted')
 
     args = parser.parse_args()
     all_groups = get_equivalent_sentences(args.input_sentences, args.num_sentences)
@@ -288,6 +418,28 @@ if __name__ == "__main__":
 
     token_indexer = PretrainedBertIndexer(pretrained_model=args.bert_model, use_starting_offsets=True)
     vocab = Vocabulary()
-    tlo_embedder = BertLayerEmbedder(bert_model).eval()
+    mix_weights = [float(w) for w in args.mix_weights.split(",")] if args.mix_weights else None
+    tlo_embedder = BertLayerEmbedder(bert_model, mix_weights=mix_weights).eval()
+
+    layers = parse_layers(args.layers)  # even a single layer is stored as "vecs_<layer>", so it can be picked by name
+
+    cache = None
+    if args.cache_dir:
+        cache = encoding_cache.EncodingCache(args.cache_dir, max_bytes=int(args.cache_size_gb * encoding_cache.GB))
+
+    save_args = dict(storage_dtype=args.storage_dtype, codec=args.codec, cache=cache)
+
+    if args.num_workers > 1:
+        sharding.run_workers(lambda i, n: save_bert_states(tlo_embedder, all_groups, args.output_file, layers,
+                                                           shard=(i, n), **save_args),
+                             args.num_workers, args.num_threads)
+        sharding.merge_shards(args.output_file, args.num_workers)
+    else:
+        if args.num_threads:
+            torch.set_num_threads(args.num_threads)
+
+        shard = sharding.parse_shard(args.shard) if args.shard else None
+        save_bert_states(tlo_embedder, all_groups, args.output_file, layers, shard=shard, **save_args)
 
-    save_bert_states(tlo_embedder, all_groups, args.output_file, args.layer)
+    if cache is not None:
+        print(cache.report())
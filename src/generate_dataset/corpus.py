@@ -0,0 +1,119 @@
+"""
+A lazy, random-access reader of a tokenized corpus (one sentence per line, tokens separated by spaces).
+
+The first time a corpus file is opened, a line-offset index is built in one pass over the file and saved next
+to it, as <file>.offsets.npy (uint64 byte offsets of the lines, plus the end of the file) and
+<file>.lengths.npy (uint32 number of tokens of each line). The index is rebuilt whenever the file is newer
+than it. Lines are read from a memory map of the file, only when they are accessed.
+"""
+
+import mmap
+import os.path
+from typing import Iterator, List, Union
+
+import numpy as np
+
+
+def offsets_path(path: str) -> str:
+    return path + ".offsets.npy"
+
+
+def lengths_path(path: str) -> str:
+    return path + ".lengths.npy"
+
+
+def build_index(path: str):
+    """
+    Write the line-offset index of the corpus file.
+    """
+
+    offsets, lengths = [0], []
+
+    with open(path, "rb") as f:
+        for line in iter(f.readline, b""):
+            offsets.append(offsets[-1] + len(line))
+            lengths.append(len(line.split()))  # as get_wiki.py counted the tokens
+
+    np.save(offsets_path(path), np.array(offsets, dtype=np.uint64))
+    np.save(lengths_path(path), np.array(lengths, dtype=np.uint32))
+
+
+def has_index(path: str) -> bool:
+    return os.path.isfile(lengths_path(path)) and os.path.getmtime(lengths_path(path)) >= os.path.getmtime(path)
+
+
+class Corpus(object):
+    """
+    A sequence of sentences (lists of tokens), that supports len(), iteration, indexing by sentence id and
+    slicing. Slices and filtered corpora are views of the same file; their ids are kept in self.ids.
+    """
+
+    def __init__(self, path: str, ids: np.ndarray = None):
+        self.path = path
+
+        if not has_index(path):
+            print("Indexing {}...".format(path))
+            build_index(path)
+
+        self.offsets = np.load(offsets_path(path), mmap_mode="r")
+        self.lengths = np.load(lengths_path(path), mmap_mode="r")
+        self.ids = np.arange(len(self.lengths)) if ids is None else ids
+        self._data = None
+
+    @property
+    def data(self) -> mmap.mmap:
+        if self._data is None:
+            with open(self.path, "rb") as f:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.offsets[-1] > 0 else b""
+
+        return self._data
+
+    def _view(self, ids: np.ndarray) -> "Corpus":
+        view = Corpus.__new__(Corpus)
+        view.__dict__.update(self.__dict__)
+        view.ids = ids
+
+        return view
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_line(self, i: int) -> str:
+        """
+        return: the i-th line of the corpus (of this view), without the trailing whitespace.
+        """
+
+        k = self.ids[i]
+        return self.data[self.offsets[k]: self.offsets[k + 1]].decode("utf-8").strip()
+
+    def __getitem__(self, i: Union[int, slice]) -> Union[List[str], "Corpus"]:
+        if isinstance(i, slice):
+            return self._view(self.ids[i])
+
+        return self.get_line(i).split(" ")
+
+    def __iter__(self) -> Iterator[List[str]]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def lines(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self.get_line(i)
+
+    def sentence_lengths(self) -> np.ndarray:
+        return self.lengths[self.ids]
+
+    def filter_length(self, min_length=None, max_length=None) -> "Corpus":
+        """
+        return: a view of the sentences with min_length < length < max_length (either bound may be None).
+        """
+
+        lengths = self.sentence_lengths()
+        keep = np.ones(len(self.ids), dtype=bool)
+
+        if min_length is not None:
+            keep &= lengths > min_length
+        if max_length is not None:
+            keep &= lengths < max_length
+
+        return self._view(self.ids[keep])
@@ -0,0 +1,166 @@
+"""
+An ElmoEmbedder that runs the character CNN of ELMo once per word of a vocabulary, instead of once per token.
+
+The context-independent (char-CNN) representation of a word does not depend on its sentence, so the representations
+of the words of the vocabulary are computed once, before the first batch, and looked up by word id from then on.
+The representations of out-of-vocabulary words of a batch are computed from their characters, once per distinct
+word. The output is that of allennlp's ElmoEmbedder.
+
+With forward_only, only the forward LSTMs of the biLM run, and every layer holds only its forward half: the
+context-independent representation (once, instead of twice), and the forward states of the LSTM layers. That is,
+the output is the first 512 dimensions of the output of ElmoEmbedder.
+"""
+
+from collections import Counter
+from functools import partial
+from typing import Iterable, List, Optional, Tuple
+
+import torch
+from allennlp.commands.elmo import ElmoEmbedder
+from allennlp.modules.elmo import batch_to_ids
+from allennlp.modules.elmo_lstm import ElmoLstm
+from allennlp.nn.util import add_sentence_boundary_token_ids, remove_sentence_boundaries
+from torch.nn.utils.rnn import PackedSequence, pad_packed_sequence
+
+PADDING = "@@PADDING@@"  # word id 0, see _ElmoBiLm.create_cached_cnn_embeddings
+
+
+def build_vocab(sentences: Iterable[List[str]], max_size=None) -> List[str]:
+    """
+    return: the max_size most frequent words of sentences (all the words, if max_size is None).
+    """
+
+    counts = Counter(w for sentence in sentences for w in sentence)
+    return [w for w, _ in counts.most_common(max_size)]
+
+
+def _forward_lstm(lstm: ElmoLstm, inputs: PackedSequence,
+                  initial_state: Optional[Tuple[torch.Tensor, torch.Tensor]] = None):
+    """
+    ElmoLstm._lstm_forward, for the forward layers only. The states (and so the states kept between batches by
+    ElmoLstm) are of the forward layers only.
+    """
+
+    if initial_state is None:
+        hidden_states = [None] * len(lstm.forward_layers)
+    else:
+        hidden_states = list(zip(initial_state[0].split(1, 0), initial_state[1].split(1, 0)))
+
+    output_sequence, batch_lengths = pad_packed_sequence(inputs, batch_first=True)
+    sequence_outputs, final_states = [], []
+
+    for layer_index, state in enumerate(hidden_states):
+        layer_input = output_sequence
+        output_sequence, final_state = lstm.forward_layers[layer_index](layer_input, batch_lengths, state)
+
+        if layer_index != 0:  # skip connections
+            output_sequence = output_sequence + layer_input
+
+        sequence_outputs.append(output_sequence)
+        final_states.append(final_state)
+
+    final_hidden_states, final_memory_states = zip(*final_states)
+
+    return torch.stack(sequence_outputs), (torch.cat(final_hidden_states, 0), torch.cat(final_memory_states, 0))
+
+
+class CachedElmoEmbedder(ElmoEmbedder):
+
+    def __init__(self, options_file: str, weight_file: str, cuda_device=-1, vocab: List[str] = None,
+                 forward_only=False):
+        """
+        vocab: words whose char-CNN representations are cached (see set_vocab).
+        forward_only: run only the forward direction of the biLM.
+        """
+
+        super().__init__(options_file, weight_file, cuda_device=cuda_device)
+        self.vocab, self.word2id = None, dict()
+        self.forward_only = forward_only
+
+        if forward_only:  # ElmoLstm.forward runs the LSTMs through _lstm_forward
+            self.elmo_bilm._elmo_lstm._lstm_forward = partial(_forward_lstm, self.elmo_bilm._elmo_lstm)
+
+        if vocab:
+            self.set_vocab(vocab)
+
+    def set_vocab(self, vocab: List[str]):
+        """
+        Cache the char-CNN representations of the words of vocab. They are computed before the next batch is
+        encoded (so not at all if nothing is encoded).
+        """
+
+        self.vocab, self.word2id = list(dict.fromkeys(vocab)), dict()
+
+    def _cache_vocab(self):
+        with torch.no_grad():
+            self.elmo_bilm.create_cached_cnn_embeddings([PADDING] + self.vocab)
+
+        self.word2id = {w: i for i, w in enumerate(self.vocab, start=1)}
+        self.vocab = None
+
+    def _to_device(self, tensor: torch.Tensor) -> torch.Tensor:
+        return tensor.cuda(device=self.cuda_device) if self.cuda_device >= 0 else tensor
+
+    def _char_cnn(self, batch: List[List[str]]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        return: the context-independent representations of the words of batch, with sentence boundaries,
+                (batch_size, num_timesteps + 2, 512), and their mask.
+        """
+
+        if self.vocab is not None:
+            self._cache_vocab()
+
+        if not self.word2id:
+            token_embedding = self.elmo_bilm._token_embedder(self._to_device(batch_to_ids(batch)))
+            return token_embedding['token_embedding'], token_embedding['mask']
+
+        oov = list(dict.fromkeys(w for sentence in batch for w in sentence if w not in self.word2id))
+        oov2id = {w: k for k, w in enumerate(oov)}
+
+        shape = (len(batch), max(len(sentence) for sentence in batch))
+        word_ids, oov_ids = torch.zeros(shape, dtype=torch.long), torch.zeros(shape, dtype=torch.long)
+        is_oov, mask = torch.zeros(shape, dtype=torch.bool), torch.zeros(shape, dtype=torch.long)
+
+        for b, sentence in enumerate(batch):
+            mask[b, :len(sentence)] = 1
+
+            for j, w in enumerate(sentence):
+                if w in self.word2id:
+                    word_ids[b, j] = self.word2id[w]
+                else:
+                    oov_ids[b, j], is_oov[b, j] = oov2id[w], True
+
+        # the OOV rows are looked up separately, so that the table of the vocabulary is never copied
+        embedded = self.elmo_bilm._word_embedding.weight[self._to_device(word_ids)]
+
+        if oov:  # one "sentence" per word, whose representation is after the sentence start
+            oov_embedding = self.elmo_bilm._token_embedder(self._to_device(batch_to_ids([[w] for w in oov])))
+            embedded = torch.where(self._to_device(is_oov).unsqueeze(-1),
+                                   oov_embedding['token_embedding'][:, 1, :][self._to_device(oov_ids)], embedded)
+
+        return add_sentence_boundary_token_ids(embedded, self._to_device(mask),
+                                               self.elmo_bilm._bos_embedding, self.elmo_bilm._eos_embedding)
+
+    def _layers(self, type_representation: torch.Tensor, mask: torch.Tensor) -> List[torch.Tensor]:
+        """
+        return: the activations of the layers of the biLM, as in _ElmoBiLm.forward.
+        """
+
+        lstm_outputs = self.elmo_bilm._elmo_lstm(type_representation, mask)
+
+        if not self.forward_only:
+            type_representation = torch.cat([type_representation, type_representation], dim=-1)
+
+        layers = [type_representation * mask.float().unsqueeze(-1)]
+
+        return layers + [layer.squeeze(0) for layer in torch.chunk(lstm_outputs, lstm_outputs.size(0), dim=0)]
+
+    def batch_to_embeddings(self, batch: List[List[str]]) -> Tuple[torch.Tensor, torch.Tensor]:
+        with torch.no_grad():
+            type_representation, mask_with_bos_eos = self._char_cnn(batch)
+            layer_activations = self._layers(type_representation, mask_with_bos_eos)
+
+        without_bos_eos = [remove_sentence_boundaries(layer, mask_with_bos_eos) for layer in layer_activations]
+        activations = torch.cat([layer[0].unsqueeze(1) for layer in without_bos_eos], dim=1)
+
+        return activations, without_bos_eos[0][1]
@@ -0,0 +1,200 @@
+"""
+A persistent, content-addressed cache of the contextual vectors of sentences.
+
+An entry is keyed by the sha1 of (the tokens of the sentence, the model id), where the model id names the model
+and includes a checksum of its weights (see model_id), so that a changed model never reads stale vectors. Encoders
+store everything they compute for a sentence (e.g. all the layers of ELMo), and select the layers they need after
+reading it, so that changing the layers does not require encoding again.
+
+The entries are kept in a single SQLite file, <cache dir>/encodings.sqlite. When the cache grows beyond max_bytes,
+the least recently used entries are evicted, down to EVICT_TO of max_bytes (so that the table is not scanned on every
+write of a full cache).
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import time
+from typing import Callable, Dict, List, Sequence
+
+import numpy as np
+
+import utils
+
+GB = 1 << 30
+EVICT_TO = 0.9
+
+
+def model_id(name: str, *weight_files: str) -> str:
+    """
+    return: an id of the model name, that changes whenever one of the weight_files changes.
+    """
+
+    return "/".join([name] + [utils.file_hash(path) for path in weight_files])
+
+
+def module_id(name: str, module) -> str:
+    """
+    return: an id of the model name, that changes whenever the weights of the torch module change.
+    """
+
+    sha1 = hashlib.sha1()
+
+    for param_name, tensor in sorted(module.state_dict().items()):
+        sha1.update(param_name.encode("utf-8"))
+        sha1.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+
+    return "{}/{}".format(name, sha1.hexdigest()[:16])
+
+
+class EncodingCache(object):
+
+    def __init__(self, cache_dir: str, max_bytes=10 * GB):
+        """
+        max_bytes: the maximal total size of the cached vectors (None for no limit).
+        """
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "encodings.sqlite")
+        self.max_bytes = max_bytes
+        # shared with the forked workers of sharding.run_workers, so that the report counts their lookups too
+        self._hits, self._misses = multiprocessing.Value("q", 0), multiprocessing.Value("q", 0)
+        self._db, self._pid = None, None
+        self._total = 0  # the size of the cached vectors, as known to this process
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        # a connection is not shared with forked processes
+        if self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS encodings (key TEXT PRIMARY KEY, data BLOB, shape TEXT, "
+                             "dtype TEXT, size INTEGER, last_access REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS encodings_last_access ON encodings (last_access)")
+            self._pid = os.getpid()
+            self._total = self._sum_sizes()
+
+        return self._db
+
+    def _sum_sizes(self, keys: List[str] = None) -> int:
+        """
+        return: the total size of the entries of keys (of all the entries, if keys is None).
+        """
+
+        if keys is None:
+            return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM encodings").fetchone()[0]
+
+        total = 0
+        for start in range(0, len(keys), 500):  # SQLite limits the number of query parameters
+            batch = keys[start: start + 500]
+            total += self.db.execute("SELECT COALESCE(SUM(size), 0) FROM encodings WHERE key IN ({})".format(
+                ",".join("?" * len(batch))), batch).fetchone()[0]
+
+        return total
+
+    @property
+    def hits(self) -> int:
+        return self._hits.value
+
+    @property
+    def misses(self) -> int:
+        return self._misses.value
+
+    @staticmethod
+    def key(sentence: Sequence[str], model: str) -> str:
+        return hashlib.sha1(json.dumps([model, list(sentence)]).encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        found = dict()
+        unique_keys = list(set(keys))
+
+        for start in range(0, len(unique_keys), 500):  # SQLite limits the number of query parameters
+            batch = unique_keys[start: start + 500]
+            rows = self.db.execute("SELECT key, data, shape, dtype FROM encodings WHERE key IN ({})".format(
+                ",".join("?" * len(batch))), batch)
+
+            for key, data, shape, dtype in rows:
+                found[key] = np.frombuffer(data, dtype=dtype).reshape([int(d) for d in shape.split(",") if d])
+
+        now = time.time()
+        with self.db:
+            self.db.executemany("UPDATE encodings SET last_access = ? WHERE key = ?", [(now, key) for key in found])
+
+        return found
+
+    def put_many(self, items: Dict[str, np.ndarray]):
+        now = time.time()
+        rows = []
+
+        for key, vecs in items.items():
+            vecs = np.ascontiguousarray(vecs)
+            rows.append((key, vecs.tobytes(), ",".join(str(d) for d in vecs.shape), vecs.dtype.str, vecs.nbytes, now))
+
+        replaced = self._sum_sizes(list(items))
+
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO encodings VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+        self._total += sum(row[4] for row in rows) - replaced
+        self._evict()
+
+    def _evict(self):
+        if self.max_bytes is None or self._total <= self.max_bytes:
+            return
+
+        # other processes may write to the cache too, so the total is counted again before evicting
+        total = self._sum_sizes()
+        evicted = []
+        rows = self.db.execute("SELECT key, size FROM encodings ORDER BY last_access")
+
+        for key, size in rows:
+            if total <= EVICT_TO * self.max_bytes:
+                break
+
+            evicted.append((key,))
+            total -= size
+
+        rows.close()
+
+        with self.db:
+            self.db.executemany("DELETE FROM encodings WHERE key = ?", evicted)
+
+        self._total = total
+
+    def encode(self, sentences: List[Sequence[str]], model: str,
+               encode_fn: Callable[[List[Sequence[str]]], List[np.ndarray]]) -> List[np.ndarray]:
+        """
+        Encode sentences with model, reading the cached ones from the cache.
+        encode_fn: encodes a list of sentences (those that are not cached) with model.
+        """
+
+        keys = [self.key(sentence, model) for sentence in sentences]
+        found = self.get_many(keys)
+        missing = [k for k, key in enumerate(keys) if key not in found]
+
+        with self._hits.get_lock():
+            self._hits.value += len(sentences) - len(missing)
+
+        with self._misses.get_lock():
+            self._misses.value += len(missing)
+
+        if missing:
+            vecs = encode_fn([sentences[k] for k in missing])
+            computed = {keys[k]: np.asarray(sentence_vecs) for k, sentence_vecs in zip(missing, vecs)}
+            self.put_many(computed)
+            found.update(computed)
+
+        return [found[key] for key in keys]
+
+    def report(self) -> str:
+        total = self.hits + self.misses
+        return "Encoding cache: {} hits, {} misses ({:.1f}% hit rate).".format(
+            self.hits, self.misses, 100. * self.hits / max(total, 1))
+
+    def close(self):
+        if self._db is not None and self._pid == os.getpid():
+            self._db.close()
+
+        self._db, self._pid = None, None
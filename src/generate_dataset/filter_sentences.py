@@ -1,3 +1,5 @@
+import argparse
+import multiprocessing
 import pickle
 import gensim
 import numpy as np
@@ -7,22 +9,25 @@ from sklearn.metrics.pairwise import pairwise_distances, cosine_distances
 import tqdm
 import random
 from utils import DEFAULT_PARAMS
+import shards
+import groups_store
+import w2v_store
 
 FUNCTION_WORDS = DEFAULT_PARAMS["function_words"]
 
 
 def load_embeddings(w2v_file: str):
-    embeddings = gensim.models.KeyedVectors.load_word2vec_format(w2v_file, binary=True)
-    word_set = set(list(embeddings.wv.vocab))
+    # w2v_file is either a word2vec binary file or a pruned, memory-mapped store (see w2v_store.py)
+    embeddings = w2v_store.load(w2v_file)
+    word_set = set(list(embeddings.vocab))
 
     return embeddings, word_set
 
 
 def load_sents(path: str) -> List[List[List[str]]]:
-    with open(path, "rb") as f:
-        data = pickle.load(f)
+    data = shards.load_equivalent_sentences(path)
 
-    return list(data.values())
+    return groups_store.group_list(data)
 
 
 def calcualte_similarity_score(sent_vecs: np.ndarray, group_function_mask: np.ndarray, ignore_function=True) -> float:
@@ -34,23 +39,104 @@ def calcualte_similarity_score(sent_vecs: np.ndarray, group_function_mask: np.nd
     return mean_distance
 
 
-def sort_by_similarity_score(groups: List[List[List[str]]], embds: gensim.models.keyedvectors.Word2VecKeyedVectors,
-                             vocab: Set[str]):
-    scores = np.zeros(len(groups))
+def get_group_similarity_score(group: np.ndarray, embds: gensim.models.keyedvectors.Word2VecKeyedVectors,
+                               vocab: Set[str]) -> float:
+    group = np.asarray(group, dtype=object)
+    group_size, sent_len = group.shape
+    group_vecs = np.zeros((group_size, sent_len, 300))
+    group_function_mask = np.zeros((group_size, sent_len))
+
+    for j, sent in enumerate(group):
+        for k, w in enumerate(sent):
+            group_vecs[j, k] = embds[w] if w in vocab else embds["##"]
+            group_function_mask[j, k] = 1. if w not in FUNCTION_WORDS else 0.
+
+    return calcualte_similarity_score(group_vecs, group_function_mask)
+
 
-    for i, group in tqdm.tqdm(enumerate(groups), ascii=True, total=len(groups)):
+def encode_groups(groups: List[List[List[str]]], embds: gensim.models.keyedvectors.Word2VecKeyedVectors,
+                  vocab: Set[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Map the words of all groups to ids, once.
+    return: ids, an int32 array of shape (num_groups, max_group_size, max_sent_len) padded with 0;
+            group_sizes, the number of sentences of each group;
+            embedding_matrix, whose row i is the vector of word id i (unknown words get the vector of "##").
+            Row 0 (padding) and the rows of function words are zero, so they do not contribute to the scores.
+    """
 
-        group_size, sent_len = group.shape
-        group_vecs = np.zeros((group_size, sent_len, 300))
-        group_function_mask = np.zeros((group_size, sent_len))
+    word2id = dict()
+    max_group_size = max(len(group) for group in groups)
+    max_sent_len = max(len(sent) for group in groups for sent in group)
+    ids = np.zeros((len(groups), max_group_size, max_sent_len), dtype=np.int32)
+    group_sizes = np.array([len(group) for group in groups])
 
+    for i, group in enumerate(groups):
         for j, sent in enumerate(group):
-            for k, w in enumerate(sent):
-                group_vecs[j, k] = embds[w] if w in vocab else embds["##"]
-                group_function_mask[j, k] = 1. if w not in FUNCTION_WORDS else 0.
+            ids[i, j, :len(sent)] = [word2id.setdefault(w, len(word2id) + 1) for w in sent]
+
+    embedding_matrix = np.zeros((len(word2id) + 1, 300), dtype=np.float32)
+
+    for w, k in word2id.items():
+        if w not in FUNCTION_WORDS:
+            embedding_matrix[k] = embds[w] if w in vocab else embds["##"]
+
+    return ids, group_sizes, embedding_matrix
+
+
+def score_groups(ids: np.ndarray, group_sizes: np.ndarray, embedding_matrix: np.ndarray,
+                 slice_len=8) -> np.ndarray:
+    """
+    The vectorized version of calcualte_similarity_score, for many groups at once.
+    slice_len: the number of token positions whose vectors are looked up at once (bounds the memory use).
+    return: the mean cosine distance between the bag-of-words vectors of the sentences of each group.
+    """
+
+    bag_of_words = np.zeros(ids.shape[:2] + embedding_matrix.shape[1:])  # (num_groups, max_group_size, 300)
+
+    for start in range(0, ids.shape[2], slice_len):
+        bag_of_words += embedding_matrix[ids[:, :, start: start + slice_len]].sum(axis=2, dtype=np.float64)
+    norms = np.linalg.norm(bag_of_words, axis=-1, keepdims=True)
+    normalized = np.divide(bag_of_words, norms, out=np.zeros_like(bag_of_words), where=norms > 0)
+
+    # as in sklearn's cosine_distances: clip to [0, 2], and a sentence has zero distance from itself.
+
+    dis_mat = np.clip(1. - normalized @ normalized.transpose(0, 2, 1), 0., 2.)
+    dis_mat[:, np.arange(ids.shape[1]), np.arange(ids.shape[1])] = 0.
+
+    valid = np.arange(ids.shape[1])[None, :] < group_sizes[:, None]  # (num_groups, max_group_size)
+    dis_mat *= valid[:, :, None] & valid[:, None, :]
+
+    return dis_mat.sum(axis=(1, 2)) / group_sizes ** 2
+
+
+_scoring_data = None  # (ids, group_sizes, embedding_matrix), inherited by the workers of sort_by_similarity_score
+
+
+def _score_chunk(bounds: Tuple[int, int]) -> np.ndarray:
+    ids, group_sizes, embedding_matrix = _scoring_data
+    start, end = bounds
+
+    chunk_ids = ids[start:end]
+    sent_len = np.flatnonzero(chunk_ids.any(axis=(0, 1)))[-1] + 1 if chunk_ids.any() else 0
+    chunk_ids = chunk_ids[:, :, :sent_len]  # ids is padded to the longest sentence of all the groups
+
+    return score_groups(chunk_ids, group_sizes[start:end], embedding_matrix)
+
+
+def sort_by_similarity_score(groups: List[List[List[str]]], embds: gensim.models.keyedvectors.Word2VecKeyedVectors,
+                             vocab: Set[str], workers=1, chunk_size=256):
+    global _scoring_data
+    _scoring_data = encode_groups(groups, embds, vocab)
+
+    chunks = [(start, min(start + chunk_size, len(groups))) for start in range(0, len(groups), chunk_size)]
+
+    if workers > 1:
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            scores = list(tqdm.tqdm(pool.imap(_score_chunk, chunks), ascii=True, total=len(chunks)))
+    else:
+        scores = [_score_chunk(chunk) for chunk in tqdm.tqdm(chunks, ascii=True)]
 
-        sim_score = calcualte_similarity_score(group_vecs, group_function_mask)
-        scores[i] = sim_score
+    scores = np.concatenate(scores)
 
     groups_and_sim_scores = list(zip(groups, scores))
     groups_and_sim_scores = sorted(groups_and_sim_scores, key=lambda group_and_score: group_and_score[1])
@@ -88,9 +174,22 @@ def print_sents_by_percentile(sorted_sents: List[Tuple[np.ndarray, float]]):
 
 
 def main():
-    embds, vocab = load_embeddings("../../data/external/GoogleNews-vectors-negative300.bin")
-    groups = load_sents("../../data/interim/bert_online_sents_same_pos5.pickle")
-    groups_and_sim_scores = sort_by_similarity_score(groups, embds, vocab)
+    parser = argparse.ArgumentParser(description='Sort groups of equivalent sentences by similarity score',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--w2v-file', dest='w2v_file', type=str,
+                        default='../../data/external/GoogleNews-vectors-negative300.bin',
+                        help='word2vec binary file, or a pruned .npy store created by w2v_store.py')
+    parser.add_argument('--input-sentences', dest='input_sentences', type=str,
+                        default='../../data/interim/bert_online_sents_same_pos5.pickle',
+                        help='equivalent sentences to score')
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+                        help='number of worker processes')
+
+    args = parser.parse_args()
+
+    embds, vocab = load_embeddings(args.w2v_file)
+    groups = load_sents(args.input_sentences)
+    groups_and_sim_scores = sort_by_similarity_score(groups, embds, vocab, workers=args.workers)
     print_sents_by_percentile(groups_and_sim_scores)
 
 
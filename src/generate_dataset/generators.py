@@ -1,9 +1,18 @@
 import spacy
 import utils
-from typing import DefaultDict, List, Tuple, Dict
-from collections import defaultdict, Counter
+import corpus
+import shards
+import pos_cache
+import lexicon
+import knn_table
+import w2v_store
+from typing import DefaultDict, List, Tuple, Dict, Iterable, Iterator, Set
+from collections import defaultdict, Counter, deque
 import random
+import multiprocessing
+import multiprocessing.pool
 import os.path
+import time
 import tqdm
 import pickle
 import gensim
@@ -21,82 +30,248 @@ class EquivalentSentencesGenerator:
     the same underlying hierarchical structure (but possibly different semantics).
     """
 
+    # whether generate() may split the sentences across forked worker processes
+    parallelizable = True
+
     def __init__(self, data_filename: str, output_file: str,
                  num_sentences: int):
-        self.sentences = utils.read_sentences(data_filename)
+        self.sentences = corpus.Corpus(data_filename)
         self.num_sentences = num_sentences
         self.output_file = output_file
+        self.seed = None
+        self.pos_cache = None  # the POS tags of self.sentences, for generators that use them
+
+    def _load_pos_cache(self, data_filename: str, n_process=1):
+        self.pos_cache = pos_cache.get_pos_cache(data_filename, self.sentences, n_process=n_process)
+
+    def generate(self, resume=False, workers=1, seed=None, quality_gate=None,
+                 max_retries=2) -> Dict[int, List[List[str]]]:
+        """
+        Generate the equivalent sentences of every source sentence, appending each group to self.output_file
+        (see shards.py) as soon as it is ready.
+        resume: if True, keep the groups already in self.output_file, and skip their source sentences.
+        workers: if > 1, split the sentences across this number of worker processes.
+        seed: if given, the random state (of random and torch) is re-seeded with seed + i before generating from
+              sentence i, so the output does not depend on the number of workers.
+        quality_gate: an optional quality_gate.QualityGate. A group it rejects is regenerated up to max_retries
+                      times, and then dropped (not written). Its statistics are kept next to self.output_file
+                      (see QualityGate.open), so that a resumed run skips the dropped groups.
+        return: a dictionary mapping sentence indices to groups of equivalent sentences.
+        """
 
-    def generate(self) -> Dict[int, List[List[str]]]:
-        sents_dict = dict()
         print("Generating equivalent sentences...")
 
-        for i, sentence in tqdm.tqdm(enumerate(self.sentences), total=len(self.sentences)):
-            equivalent_sentences = self.get_equivalent_sentences(sentence)
-            sents_dict[i] = equivalent_sentences
+        with shards.ShardWriter(self.output_file, resume=resume) as writer:
+            if quality_gate is not None:
+                quality_gate.open(self.output_file, resume=resume, num_done=len(writer.done))
+
+            try:
+                indices = self.pending_indices(writer.done, resume=resume, quality_gate=quality_gate)
+
+                for i, equivalent_sentences in self.iter_groups(indices, workers=workers, seed=seed,
+                                                                quality_gate=quality_gate, max_retries=max_retries):
+                    writer.write(i, equivalent_sentences)
+
+                    if quality_gate is not None:
+                        quality_gate.commit(i)
+            finally:
+                self.save_quality_stats(quality_gate)
+
+        return shards.load_equivalent_sentences(self.output_file)
+
+    def pending_indices(self, done: Set[int], resume=False, quality_gate=None) -> List[int]:
+        """
+        return: the indices of the source sentences that still have to be generated from, given the indices that
+                are done (and, when resuming with a quality gate, the ones it dropped before; see QualityGate.open).
+        """
+
+        dropped = set(quality_gate.stats["dropped_indices"]) if quality_gate is not None else set()
+
+        indices = [i for i in range(len(self.sentences)) if i not in done and i not in dropped]
+        if resume:
+            print("Resuming: {} sentences already done.".format(len(self.sentences) - len(indices)))
+
+        return indices
+
+    def iter_groups(self, indices: List[int], workers=1, seed=None, quality_gate=None,
+                    max_retries=2, pool=None) -> Iterator[Tuple[int, List[List[str]]]]:
+        """
+        Yield the (sentence index, group of equivalent sentences) pairs of the given indices that pass the quality
+        gate, in order. See generate() for the arguments.
+        pool: with workers > 1, a pool created by worker_pool (by default, one is created here).
+        """
+
+        self.seed = seed
+
+        if workers > 1:
+            groups = self._generate_groups_parallel(indices, workers, pool)
+        else:
+            groups = self._generate_groups(indices)
+
+        for i, equivalent_sentences in tqdm.tqdm(groups, total=len(indices)):
+            if quality_gate is not None:
+                equivalent_sentences = self._apply_quality_gate(i, equivalent_sentences, quality_gate, max_retries)
+                if equivalent_sentences is None:
+                    continue
+
+            yield i, equivalent_sentences
+
+    def save_quality_stats(self, quality_gate):
+        if quality_gate is not None:
+            quality_gate.close()
+            print("Quality gate: {accepted} groups accepted ({regenerated} regenerated), {dropped} dropped.".format(
+                **quality_gate.stats))
+
+    def _apply_quality_gate(self, i: int, equivalent_sentences: List[List[str]], quality_gate,
+                            max_retries: int) -> List[List[str]]:
+        """
+        return: the first group generated from sentence i that passes the quality gate, or None if it was
+                rejected max_retries + 1 times.
+        """
+
+        rejections = []
+
+        for attempt in range(max_retries + 1):
+            if attempt > 0:
+                if self.seed is not None:  # a different, but still reproducible, random state for each retry
+                    _seed("{}-{}-{}".format(self.seed, i, attempt))
+
+                equivalent_sentences = self._get_group(i)
 
-        if (i % 100 == 0 and i != 0) or (i == len(self.sentences) - 1):
-            with open(self.output_file, 'wb') as f:
-                pickle.dump(sents_dict, f)
+            reason = quality_gate.check(equivalent_sentences)
+            if reason is None:
+                quality_gate.record(i, rejections, accepted=True)
+                return equivalent_sentences
 
-        return sents_dict
+            rejections.append(reason)
+
+        quality_gate.record(i, rejections, accepted=False)
+        return None
+
+    def _generate_groups(self, indices: List[int]) -> Iterator[Tuple[int, List[List[str]]]]:
+        """
+        Yield (sentence index, group of equivalent sentences) pairs for the given sentence indices, in order.
+        Subclasses may override this to process several source sentences together.
+        """
+
+        for i in indices:
+            if self.seed is not None:
+                _seed(self.seed + i)
+
+            yield i, self._get_group(i)
+
+    def _get_group(self, i: int) -> List[List[str]]:
+        if self.pos_cache is not None:
+            return self.get_equivalent_sentences(self.sentences[i], pos_tags=self.pos_cache[i])
+
+        return self.get_equivalent_sentences(self.sentences[i])
+
+    def worker_pool(self, workers: int, seed=None) -> multiprocessing.pool.Pool:
+        """
+        return: a pool of workers for iter_groups, forked now. The generator (including large read-only structures
+                such as pos2words or the word embeddings) is inherited by the workers copy-on-write, in its current
+                state. Create the pool before starting other threads (as pipeline.py does): forking a multithreaded
+                process can deadlock the workers on the locks held by the other threads.
+        """
+
+        global _worker_generator
+        assert self.parallelizable, "{} does not support multiple workers".format(type(self).__name__)
+
+        self.seed = seed
+        _worker_generator = self
+
+        return multiprocessing.get_context("fork").Pool(workers, initializer=_init_worker)
+
+    def _generate_groups_parallel(self, indices: List[int], workers: int, pool=None,
+                                  chunk_size=64) -> Iterator[Tuple[int, List[List[str]]]]:
+        """
+        Like _generate_groups, but over a pool of forked processes (see worker_pool), to which only chunks of
+        sentence indices are sent. The results are yielded in the order of indices.
+        """
+
+        if pool is None:
+            with self.worker_pool(workers, self.seed) as pool:
+                yield from self._generate_groups_parallel(indices, workers, pool, chunk_size)
+
+            return
+
+        chunks = [indices[k: k + chunk_size] for k in range(0, len(indices), chunk_size)]
+
+        for chunk in pool.imap(_generate_chunk, chunks):
+            yield from chunk
 
     def get_equivalent_sentences(self, original_sentence: List[str]) -> List[List[str]]:
         raise NotImplementedError()
 
 
+_worker_generator = None  # the generator used by the worker processes of worker_pool
+
+
+def _init_worker():
+    # the forked workers inherit the random state of the parent. without a seed (which re-seeds each sentence),
+    # they would all draw the same random substitutions
+    worker_seed = (os.getpid() * 1000003 + time.time_ns()) % (1 << 32)
+    random.seed(worker_seed)
+    np.random.seed(worker_seed)
+    torch.manual_seed(worker_seed)
+
+
+def _seed(seed):
+    # the bert generators sample their candidates with torch, the others with random: seed both. the torch seed is
+    # drawn from a separate Random, so that the draws of random (and the groups of the other generators) are unchanged
+    random.seed(seed)
+    torch.manual_seed(random.Random(seed).getrandbits(63))
+
+
+def _generate_chunk(indices: List[int]) -> List[Tuple[int, List[List[str]]]]:
+    return list(_worker_generator._generate_groups(indices))
+
+
 class POSBasedEGenerator(EquivalentSentencesGenerator):
 
     def __init__(self, data_filename, output_file, pos_tags_to_replace, num_sentences,
-                 pos2words_file):
+                 pos2words_file, tagging_processes=1, lexicon_workers=1):
 
         super().__init__(data_filename, output_file, num_sentences)
 
         self.nlp = spacy.load('en_core_web_sm')
         self.data_filename = data_filename
+        self._load_pos_cache(data_filename, n_process=tagging_processes)
         self.pos2words_file = pos2words_file
-        self.pos2words = self._get_POS2words_mapping()
+        self.pos2words = self._get_lexicon(workers=lexicon_workers)
         self.pos_tags_to_replace = pos_tags_to_replace
 
-    def _get_POS2words_mapping(self, min_occurrence=50) -> DefaultDict[str, set]:
+    def _lexicon_keys(self, sentence: List[str], pos_tags: List[str]) -> List[Tuple[str, str]]:
+        return list(zip(pos_tags, sentence))
+
+    def _get_lexicon(self, min_occurrence=50, workers=1) -> lexicon.Lexicon:
         """
         Iterate over the dataset, and find the words belonging to each POS tag.
-        return: pos2words, a dictionary mapping pos tags (strings) to sets of words.
+        return: a lexicon mapping pos tags to the words occurring more than min_occurrence times with that tag.
         """
 
-        pos2words_filename = self.pos2words_file
-
-        if os.path.isfile(pos2words_filename):
-
-            with open(pos2words_filename, 'rb') as f:
-                pos2words = pickle.load(f)
-
-        else:
-
-            print("Collecting POS:words mapping...")
+        lexicon_path = self.pos2words_file + ".lexicon"
 
-            pos2words = defaultdict(list)
+        if not lexicon.Lexicon.exists(lexicon_path):
 
-            sentences = utils.read_sentences(self.data_filename)
+            if os.path.isfile(self.pos2words_file):
 
-            for sentence in tqdm.tqdm(sentences):
+                # convert a legacy pos2words pickle
 
-                pos_tags = self._get_pos_tags(sentence)
+                with open(self.pos2words_file, 'rb') as f:
+                    pos2words = lexicon.Lexicon.from_dict(pickle.load(f))
 
-                for (w, pos_tag) in zip(sentence, pos_tags):
-                    pos2words[pos_tag].append(w)
+            else:
 
-            for pos, words in pos2words.items():
-                # filter rare words
+                print("Collecting POS:words mapping...")
 
-                counter = Counter(words)
-                words = set([w for w, count in counter.items() if count > min_occurrence])
-                pos2words[pos] = words
+                pair_counts, word_counts = lexicon.count_pairs(self.sentences, self.pos_cache, self._lexicon_keys,
+                                                               workers=workers)
+                pos2words = lexicon.build_lexicon(pair_counts, word_counts, min_pair_count=min_occurrence)
 
-            with open(pos2words_filename, 'wb') as f:
-                pickle.dump(pos2words, f)
+            pos2words.save(lexicon_path)
 
-        return pos2words
+        return lexicon.Lexicon.load(lexicon_path)
 
     def _get_pos_tags(self, sentence: List[str]) -> List[str]:
 
@@ -106,9 +281,11 @@ class POSBasedEGenerator(EquivalentSentencesGenerator):
         pos_tags = [token.tag_ for token in doc]
         return pos_tags
 
-    def get_equivalent_sentences(self, original_sentence: List[str], ) -> List[List[str]]:
+    def get_equivalent_sentences(self, original_sentence: List[str], pos_tags=None) -> List[List[str]]:
+
+        if pos_tags is None:
+            pos_tags = self._get_pos_tags(original_sentence)
 
-        pos_tags = self._get_pos_tags(original_sentence)
         equivalent_sentences = [original_sentence]
 
         for i in range(self.num_sentences):
@@ -117,13 +294,12 @@ class POSBasedEGenerator(EquivalentSentencesGenerator):
 
             for j, (w, pos_tag) in enumerate(zip(original_sentence, pos_tags)):
 
-                if (pos_tag in self.pos_tags_to_replace) and (len(self.pos2words[pos_tag]) > 0) and (
-                        w not in utils.DEFAULT_PARAMS['function_words']):
+                replacement = None
 
-                    sentence.append(random.choice(list(self.pos2words[pos_tag])))
-                else:
+                if (pos_tag in self.pos_tags_to_replace) and (w not in utils.DEFAULT_PARAMS['function_words']):
+                    replacement = self.pos2words.sample(pos_tag)
 
-                    sentence.append(w)
+                sentence.append(replacement if replacement is not None else w)
 
             equivalent_sentences.append(sentence)
 
@@ -133,15 +309,16 @@ class POSBasedEGenerator(EquivalentSentencesGenerator):
 class POSBasedEGenerator2(EquivalentSentencesGenerator):
 
     def __init__(self, data_filename, output_file, pos_tags_to_replace, num_sentences,
-                 pos2words_file, order=1):
+                 pos2words_file, order=1, tagging_processes=1, lexicon_workers=1):
 
         super().__init__(data_filename, output_file, num_sentences)
 
         self.order = order
         self.nlp = spacy.load('en_core_web_sm')
         self.data_filename = data_filename
+        self._load_pos_cache(data_filename, n_process=tagging_processes)
         self.pos2words_file = pos2words_file
-        self.pos2words = self._get_POS2words_mapping()
+        self.pos2words = self._get_lexicon(workers=lexicon_workers)
         self.pos_tags_to_replace = pos_tags_to_replace
 
     def _pad(self, sentence, pos_tags):
@@ -163,52 +340,48 @@ class POSBasedEGenerator2(EquivalentSentencesGenerator):
 
         return words_ngrams, pos_ngrams
 
-    def _get_POS2words_mapping(self, min_occurrence=20) -> DefaultDict[str, set]:
-        """
-        Iterate over the dataset, and find the words belonging to each POS tag.
-        return: pos2words, a dictionary mapping pos tags (strings) to sets of words.
-        """
-
-        pos2words_filename = self.pos2words_file
+    def _lexicon_keys(self, sentence: List[str], pos_tags: List[str]) -> List[Tuple[str, str]]:
 
-        if os.path.isfile(pos2words_filename) and True:
+        # add dummy characters at the end
 
-            with open(pos2words_filename, 'rb') as f:
-                pos2words = pickle.load(f)
+        sentence, pos_tags = self._pad(list(sentence), list(pos_tags))
 
-        else:
+        # collect occurrences of POS ngrams
 
-            print("Collecting POS:words mapping...")
+        words_ngrams, pos_ngrams = self._get_ngrams(sentence, pos_tags)
 
-            pos2words = defaultdict(set)
-            sentences = utils.read_sentences(self.data_filename)
-            all_words = [w for sent in sentences for w in sent]
-            words_counter = Counter(all_words)
-            common_words = set([w for w, count in words_counter.items() if count > min_occurrence])
+        return [("*".join(pos_tag_ngrams), w_ngrams[self.order]) for w_ngrams, pos_tag_ngrams in
+                zip(words_ngrams, pos_ngrams)]
 
-            for sentence in tqdm.tqdm(sentences):
+    def _get_lexicon(self, min_occurrence=20, workers=1) -> lexicon.Lexicon:
+        """
+        Iterate over the dataset, and find the words occurring within each POS ngram.
+        return: a lexicon mapping POS ngrams to the words (occurring more than min_occurrence times in the corpus)
+                that appear in their center.
+        """
 
-                pos_tags = self._get_pos_tags(sentence)
+        lexicon_path = self.pos2words_file + ".lexicon"
 
-                # add dummy characters at the end
+        if not lexicon.Lexicon.exists(lexicon_path):
 
-                sentence, pos_tags = self._pad(sentence, pos_tags)
+            if os.path.isfile(self.pos2words_file):
 
-                # collect occurrences of POS ngrams
+                # convert a legacy pos2words pickle
 
-                words_ngrams, pos_ngrams = self._get_ngrams(sentence, pos_tags)
+                with open(self.pos2words_file, 'rb') as f:
+                    pos2words = lexicon.Lexicon.from_dict(pickle.load(f))
 
-                for i, (w_ngrams, pos_tag_ngrams) in enumerate(zip(words_ngrams, pos_ngrams)):
+            else:
 
-                    w, pos = w_ngrams[self.order], pos_tag_ngrams[self.order]
+                print("Collecting POS:words mapping...")
 
-                    if w in common_words:
-                        pos2words["*".join(pos_tag_ngrams)].add(w)
+                pair_counts, word_counts = lexicon.count_pairs(self.sentences, self.pos_cache, self._lexicon_keys,
+                                                               workers=workers)
+                pos2words = lexicon.build_lexicon(pair_counts, word_counts, min_word_count=min_occurrence)
 
-            with open(pos2words_filename, 'wb') as f:
-                pickle.dump(pos2words, f)
+            pos2words.save(lexicon_path)
 
-        return pos2words
+        return lexicon.Lexicon.load(lexicon_path)
 
     def _get_pos_tags(self, sentence: List[str]) -> List[str]:
 
@@ -218,11 +391,12 @@ class POSBasedEGenerator2(EquivalentSentencesGenerator):
         pos_tags = [token.tag_ for token in doc]
         return pos_tags
 
-    def get_equivalent_sentences(self, original_sentence: List[str], ) -> List[List[str]]:
+    def get_equivalent_sentences(self, original_sentence: List[str], pos_tags=None) -> List[List[str]]:
 
-        pos_tags = self._get_pos_tags(original_sentence)
+        if pos_tags is None:
+            pos_tags = self._get_pos_tags(original_sentence)
 
-        sentence, pos_tags = self._pad(original_sentence[:], pos_tags)
+        sentence, pos_tags = self._pad(original_sentence[:], list(pos_tags))
 
         equivalent_sentences = [original_sentence]
         words_ngrams, pos_ngrams = self._get_ngrams(sentence, pos_tags)
@@ -234,15 +408,12 @@ class POSBasedEGenerator2(EquivalentSentencesGenerator):
             for j, (w_ngrams, pos_tag_ngrams) in enumerate(zip(words_ngrams, pos_ngrams)):
 
                 pos_tag, w = pos_tag_ngrams[self.order], w_ngrams[self.order]
-                pos_seq = "*".join(pos_tag_ngrams)
+                replacement = None
 
-                if (pos_tag in self.pos_tags_to_replace) and (pos_seq in self.pos2words) and (
-                        len(self.pos2words[pos_seq]) > 0) and (w not in utils.DEFAULT_PARAMS['function_words']):
+                if (pos_tag in self.pos_tags_to_replace) and (w not in utils.DEFAULT_PARAMS['function_words']):
+                    replacement = self.pos2words.sample("*".join(pos_tag_ngrams))
 
-                    sentence.append(random.choice(list(self.pos2words[pos_seq])))
-                else:
-
-                    sentence.append(w)
+                sentence.append(replacement if replacement is not None else w)
 
             equivalent_sentences.append(sentence)
 
@@ -251,18 +422,43 @@ class POSBasedEGenerator2(EquivalentSentencesGenerator):
 
 class EmbeddingBasedGenerator(EquivalentSentencesGenerator):
 
-    def __init__(self, data_filename, output_file, num_sentences, w2v_file, topn=8):
+    def __init__(self, data_filename, output_file, num_sentences, w2v_file, topn=8, knn_dir=None, knn_workers=4):
 
-        super().__init__(data_filename, output_file, num_sentences)
+        """
+        w2v_file: a word2vec binary file, or a pruned store (see w2v_store.py).
+        knn_dir: if given, the neighbours are looked up in a precomputed table (see knn_table.py) stored in this
+                 directory. The table is built (from w2v_file) if it does not exist yet; afterwards, the word2vec
+                 model is not loaded at all.
+        """
 
-        self.embeddings = gensim.models.KeyedVectors.load_word2vec_format(w2v_file, binary=True)
-        self.word_set = set(list(self.embeddings.wv.vocab))
-        self.word_list = list(self.embeddings.wv.vocab)
+        super().__init__(data_filename, output_file, num_sentences)
 
         self.topn = topn
+        self.knn_table = None
+
+        if knn_dir:
+
+            if not knn_table.exists(knn_dir):
+                embeddings = w2v_store.load(w2v_file)
+                knn_table.build_knn_table(embeddings, knn_table.corpus_vocab(self.sentences), knn_dir, topn=topn,
+                                          workers=knn_workers)
+                del embeddings
+
+            self.knn_table = knn_table.KNNTable(knn_dir)
+
+        else:
+
+            self.embeddings = w2v_store.load(w2v_file)
+            self.word_set = set(list(self.embeddings.vocab))
+            self.word_list = list(self.embeddings.vocab)
 
     @lru_cache(maxsize=256)
     def get_knn(self, w: str) -> List[str]:
+        if self.knn_table is not None:
+            if (w in utils.DEFAULT_PARAMS['function_words']) or (w not in self.knn_table):
+                return [w]
+            return self.knn_table.get(w)
+
         if (w in utils.DEFAULT_PARAMS['function_words']) or (w not in self.word_set):
             return [w]
         else:
@@ -288,19 +484,40 @@ class EmbeddingBasedGenerator(EquivalentSentencesGenerator):
 
 class BertGenerator(EquivalentSentencesGenerator):
 
+    parallelizable = False  # forking a process that holds a CUDA context is not supported
+
     def __init__(self, data_filename, output_file, num_sentences, topn=8, ignore_first_k=0, maintain_pos=False,
-                 cuda_device=0):
+                 cuda_device=0, bert_model='bert-large-uncased-whole-word-masking', quantize=False, num_threads=None,
+                 tagging_processes=1):
+
+        """
+        cuda_device: the GPU to run BERT on, or -1 to run it on the CPU.
+        bert_model: the name of the pretrained masked LM (e.g. bert-base-uncased).
+        quantize: if True, apply dynamic int8 quantization to BERT's Linear layers (CPU only).
+        num_threads: if given, the number of threads torch uses for intra-op parallelism on the CPU.
+        tagging_processes: the number of processes used for POS-tagging the corpus (if maintain_pos).
+        """
 
         super().__init__(data_filename, output_file, num_sentences)
 
         self.cuda_device = cuda_device
-        #self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-        #self.model = BertForMaskedLM.from_pretrained('bert-base-uncased')
-        self.tokenizer = BertTokenizer.from_pretrained('bert-large-uncased-whole-word-masking')
-        self.model = BertForMaskedLM.from_pretrained('bert-large-uncased-whole-word-masking')
-        
+        self.device = 'cuda:{}'.format(cuda_device) if cuda_device >= 0 else 'cpu'
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+
+        self.tokenizer = BertTokenizer.from_pretrained(bert_model)
+        self.model = BertForMaskedLM.from_pretrained(bert_model)
+
         self.model.eval()
-        self.model.to('cuda:{}'.format(self.cuda_device))
+
+        if quantize:
+            assert self.device == 'cpu', "int8 quantization is only supported on the CPU"
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+        self.model.to(self.device)
+        self._ids_buffer = torch.zeros(0, dtype=torch.long, device=self.device)
+        self._mask_buffer = torch.zeros(0, dtype=torch.long, device=self.device)
         self.forbidden_guesses = utils.DEFAULT_PARAMS["function_words"]
         self.topn = topn
         self.ignore_first_k = ignore_first_k
@@ -319,14 +536,114 @@ class BertGenerator(EquivalentSentencesGenerator):
 
             self.nlp = spacy.load('en_core_web_sm', disable=["parser", "ner", "sentencizer"])
 
+            self._load_pos_cache(data_filename, n_process=tagging_processes)
+
             print("Collecting word:POS mapping...")
             self.w2pos = defaultdict(Counter)
             for i, sentence in tqdm.tqdm(enumerate(self.sentences), total=len(self.sentences)):
 
-                tags = self._get_pos_tags(sentence)
+                tags = self.pos_cache[i]
                 for w, t in zip(sentence, tags):
                     self.w2pos[w][t] += 1
 
+        self._build_vocab_masks()
+
+    def _forward(self, indexed_tokens: np.ndarray, attention_mask: np.ndarray = None) -> torch.Tensor:
+
+        """
+        Inference-only forward pass of the masked LM. The token ids (and attention mask) are copied into buffers
+        that are preallocated on the model's device, and grow only when a larger batch is seen.
+
+        indexed_tokens: (batch_size, seq_length) array of token ids.
+        return: (batch_size, seq_length, voc_size) tensor of predictions.
+        """
+
+        size = indexed_tokens.size
+
+        if self._ids_buffer.numel() < size:
+            self._ids_buffer = torch.zeros(size, dtype=torch.long, device=self.device)
+            self._mask_buffer = torch.zeros(size, dtype=torch.long, device=self.device)
+
+        tokens_tensor = self._ids_buffer[:size].view(indexed_tokens.shape)
+        tokens_tensor.copy_(torch.from_numpy(indexed_tokens))
+
+        if attention_mask is not None:
+            attention_mask_tensor = self._mask_buffer[:size].view(attention_mask.shape)
+            attention_mask_tensor.copy_(torch.from_numpy(attention_mask))
+        else:
+            attention_mask_tensor = None
+
+        with torch.no_grad():
+
+            return self.model(tokens_tensor, attention_mask=attention_mask_tensor)[0]
+
+    def _build_vocab_masks(self):
+
+        """
+        Precompute boolean masks over BERT's vocabulary, used by choose_words to filter the candidates on the
+        model's device: allowed_mask excludes subwords and forbidden guesses, and row t of pos_masks contains
+        the words tagged with the t-th tag (at least twice) in the corpus. The last two rows of pos_masks stand for
+        "no POS constraint" (all True) and for a tag that was never seen (all False).
+        """
+
+        vocab = self.tokenizer.convert_ids_to_tokens(range(len(self.tokenizer.vocab)))
+        device = self.device
+
+        allowed_mask = np.array([("##" not in w) and (w not in self.forbidden_guesses) for w in vocab])
+        self.allowed_mask = torch.from_numpy(allowed_mask).to(device)
+
+        pos_tags = sorted(set(t for counter in self.w2pos.values() for t in counter)) if self.maintain_pos else []
+        self.pos2id = {t: i for i, t in enumerate(pos_tags)}
+        pos_masks = np.zeros((len(pos_tags) + 2, len(vocab)), dtype=bool)
+        pos_masks[len(pos_tags)] = True
+
+        for v, w in enumerate(vocab):
+            if self.maintain_pos and w in self.w2pos:
+                for t, count in self.w2pos[w].items():
+                    pos_masks[self.pos2id[t], v] = count > 1
+
+        self.pos_masks = torch.from_numpy(pos_masks).to(device)
+
+    def _get_pos_id(self, original_pos=None) -> int:
+
+        if not self.maintain_pos or original_pos is None:
+            return len(self.pos2id)
+
+        if original_pos == "VBP": original_pos = "VB"  # use use a unigram tagger, so VBPs are tagged as VBs
+
+        return self.pos2id.get(original_pos, len(self.pos2id) + 1)
+
+    def choose_words(self, logits: torch.Tensor, original_pos: List[str], candidate_pool=220) -> List[str]:
+
+        """
+        A batched, on-device version of choose_word.
+
+        logits: (batch_size, vocab_size), BERT's predictions for one masked position in each row.
+        original_pos: a list of size batch_size with the POS of the original word of each row (or None).
+        candidate_pool: only the candidate_pool highest-scoring words of each row are considered.
+        return: a list of size batch_size with the word chosen for each row (None if no candidate is left).
+        """
+
+        pos_ids = torch.tensor([self._get_pos_id(pos) for pos in original_pos], device=logits.device)
+        threshold = torch.topk(logits, k=candidate_pool, dim=-1)[0][:, -1:]
+        allowed = self.allowed_mask[None, :] & self.pos_masks[pos_ids] & (logits >= threshold)
+
+        values, indices = torch.topk(logits.masked_fill(~allowed, -np.inf), k=self.ignore_first_k + self.topn, dim=-1)
+        values, indices = values[:, self.ignore_first_k:], indices[:, self.ignore_first_k:]
+
+        # sample uniformly among the valid candidates of each row
+
+        valid = torch.isfinite(values)
+        has_candidates = valid.any(dim=-1)
+        weights = valid.float()
+        weights[~has_candidates, 0] = 1.
+        chosen = indices.gather(1, torch.multinomial(weights, 1)).squeeze(1)
+
+        chosen, has_candidates = chosen.cpu().numpy(), has_candidates.cpu().numpy()
+        chosen_words = self.tokenizer.convert_ids_to_tokens(chosen)
+
+        return [w if ok else None for w, ok in zip(chosen_words, has_candidates)]
+
     def choose_word(self, guesses, original_pos=None):
 
         if original_pos == "VBP": original_pos = "VB"  # use use a unigram tagger, so VBPs are tagged as VBs
@@ -387,17 +704,19 @@ class BertGenerator(EquivalentSentencesGenerator):
         pos_tags = [token.tag_ for token in doc]
         return pos_tags
 
-    def get_equivalent_sentences(self, original_sentence: List[str], online=False, topn=6) -> List[List[str]]:
+    def get_equivalent_sentences(self, original_sentence: List[str], online=False, topn=6,
+                                 pos_tags=None) -> List[List[str]]:
 
         raise NotImplementedError
 
 
 class IndependentBertGenerator(BertGenerator):
 
-    def __init__(self, data_filename, output_file, num_sentences, topn=8):
-        super().__init__(data_filename, output_file, num_sentences, topn=topn)
+    def __init__(self, data_filename, output_file, num_sentences, topn=8, **kwargs):
+        super().__init__(data_filename, output_file, num_sentences, topn=topn, **kwargs)
 
-    def get_equivalent_sentences(self, original_sentence: List[str], online=False, topn=6) -> List[List[str]]:
+    def get_equivalent_sentences(self, original_sentence: List[str], online=False, topn=6,
+                                 pos_tags=None) -> List[List[str]]:
 
         equivalent_sentences = [original_sentence]
 
@@ -426,7 +745,7 @@ class IndependentBertGenerator(BertGenerator):
 
                 indexed_tokens = self.tokenizer.convert_tokens_to_ids(masked_tokens)
                 tokens_tensor = torch.tensor([indexed_tokens])
-                tokens_tensor = tokens_tensor.to('cuda:{}'.format(self.cuda_device))
+                tokens_tensor = tokens_tensor.to(self.device)
 
                 with torch.no_grad():
 
@@ -465,11 +784,12 @@ class IndependentBertGenerator(BertGenerator):
 
 class OnlineBertGenerator(BertGenerator):
 
-    def __init__(self, data_filename, output_file, num_sentences, topn=9, ignore_first_k=2):
+    def __init__(self, data_filename, output_file, num_sentences, topn=9, ignore_first_k=2, **kwargs):
 
-        super().__init__(data_filename, output_file, num_sentences, topn=topn, ignore_first_k=ignore_first_k)
+        super().__init__(data_filename, output_file, num_sentences, topn=topn, ignore_first_k=ignore_first_k, **kwargs)
 
-    def get_equivalent_sentences(self, original_sentence: List[str], online=False, topn=6) -> List[List[str]]:
+    def get_equivalent_sentences(self, original_sentence: List[str], online=False, topn=6,
+                                 pos_tags=None) -> List[List[str]]:
 
         equivalent_sentences = [original_sentence]
 
@@ -479,7 +799,7 @@ class OnlineBertGenerator(BertGenerator):
             sentence = []
 
             tokens_tensor = torch.zeros(1, len(bert_tokens), dtype=torch.long)
-            tokens_tensor = tokens_tensor.to('cuda:{}'.format(self.cuda_device))
+            tokens_tensor = tokens_tensor.to(self.device)
 
             for j, w in enumerate(original_sentence):
 
@@ -521,75 +841,279 @@ class OnlineBertGenerator(BertGenerator):
         return equivalent_sentences
 
 
+class _OnlineSentenceState(object):
+    """
+    The state of the online, left-to-right substitution process of a single source sentence.
+    """
+
+    def __init__(self, index, original_sentence, bert_tokens, orig_to_tok_map, num_sentences,
+                 original_pos_tags=None):
+        self.index = index
+        self.original_sentence = original_sentence
+        self.orig_to_tok_map = orig_to_tok_map
+        self.original_pos_tags = original_pos_tags
+
+        self.batch_bert_tokens = np.empty((num_sentences, len(bert_tokens)), dtype=object)
+        self.batch_bert_tokens[:, ] = bert_tokens.copy()
+
+        self.equivalent_sentences = np.empty((num_sentences, len(original_sentence)), dtype=object)
+        self.equivalent_sentences[0, :] = original_sentence.copy()
+
+        self.positions = []  # the content positions, to be replaced left to right
+        self.cursor = 0
+
+        for j, w in enumerate(original_sentence):
+
+            if w in utils.DEFAULT_PARAMS["function_words"]:
+                self.equivalent_sentences[:, j].fill(w)
+            else:
+                self.positions.append(j)
+
+    @property
+    def num_tokens(self) -> int:
+        return self.batch_bert_tokens.shape[1]
+
+    @property
+    def done(self) -> bool:
+        return self.cursor == len(self.positions)
+
+    def mask_next(self) -> int:
+        masked_index = self.orig_to_tok_map[self.positions[self.cursor]]
+        self.batch_bert_tokens[:, masked_index] = "[MASK]"
+        return masked_index
+
+
 class BatchedOnlineBertGenerator(BertGenerator):
 
     def __init__(self, data_filename, output_file, num_sentences, topn=10, ignore_first_k=0, maintain_pos=False,
-                 cuda_device=0):
+                 cuda_device=0, max_batch_tokens=None, **kwargs):
+
+        """
+        max_batch_tokens: if given, generate() interleaves several source sentences in the same (padded) forward
+                          pass, admitting sentences as long as batch_size * padded_length <= max_batch_tokens.
+                          Each sentence is still processed online, from left to right.
+        """
 
         super().__init__(data_filename, output_file, num_sentences, topn=topn, ignore_first_k=ignore_first_k,
-                         maintain_pos=maintain_pos, cuda_device=cuda_device)
+                         maintain_pos=maintain_pos, cuda_device=cuda_device, **kwargs)
 
-    def get_equivalent_sentences(self, original_sentence: List[str], online=False, topn=6) -> List[List[str]]:
+        self.max_batch_tokens = max_batch_tokens
 
-        bert_tokens, orig_to_tok_map = self._tokenize(original_sentence)
+    def _generate_groups(self, indices: List[int]) -> Iterator[Tuple[int, List[List[str]]]]:
 
-        batch_bert_tokens = np.empty((self.num_sentences, len(bert_tokens)), dtype=object)
+        if not self.max_batch_tokens:
+            return super()._generate_groups(indices)
 
-        batch_bert_tokens[:, ] = bert_tokens.copy()
+        if self.seed is not None:  # sentences share forward passes, so the random state is seeded once per call
+            _seed(self.seed)
 
-        equivalent_sentences = np.empty((self.num_sentences, len(original_sentence)), dtype=object)
-        equivalent_sentences[0, :] = original_sentence.copy()
-        tokens_tensor = torch.zeros((self.num_sentences, len(bert_tokens)), dtype=torch.long)
-        tokens_tensor = tokens_tensor.to('cuda:{}'.format(self.cuda_device))
+        return self._schedule(((i, self.sentences[i], self.pos_cache[i] if self.pos_cache is not None else None)
+                               for i in indices), self.max_batch_tokens)
+
+    def get_equivalent_sentences(self, original_sentence: List[str], online=False, topn=6,
+                                 pos_tags=None) -> List[List[str]]:
+
+        (_, equivalent_sentences), = self._schedule([(0, original_sentence, pos_tags)])
+        return equivalent_sentences
+
+    def _init_state(self, index: int, original_sentence: List[str], pos_tags=None) -> _OnlineSentenceState:
+
+        bert_tokens, orig_to_tok_map = self._tokenize(original_sentence)
 
         if self.maintain_pos:
-            original_pos_tags = self._get_pos_tags(original_sentence)
+            original_pos_tags = pos_tags if pos_tags is not None else self._get_pos_tags(original_sentence)
+        else:
+            original_pos_tags = None
 
-        indices_and_words = list(enumerate(original_sentence.copy()))
+        return _OnlineSentenceState(index, original_sentence, bert_tokens, orig_to_tok_map, self.num_sentences,
+                                    original_pos_tags)
 
-        for j, w in indices_and_words:
+    def _fits(self, states: List[_OnlineSentenceState], max_batch_tokens) -> bool:
 
-            if w in utils.DEFAULT_PARAMS["function_words"]:
-                equivalent_sentences[:, j].fill(w)
+        if max_batch_tokens is None:
+            return True
 
-            else:
+        padded_length = max(state.num_tokens for state in states)
+        return len(states) * self.num_sentences * padded_length <= max_batch_tokens
 
-                masked_index = orig_to_tok_map[j]
-                original_pos = original_pos_tags[j] if (self.maintain_pos) else None
-                batch_bert_tokens[:, masked_index] = "[MASK]"
-                indexed_tokens = np.empty_like(batch_bert_tokens, dtype=int)
+    def _schedule(self, indexed_sentences: Iterable[Tuple[int, List[str], List[str]]],
+                  max_batch_tokens=None) -> Iterator[Tuple[int, np.ndarray]]:
 
-                for i in range(self.num_sentences):
-                    indexed_tokens[i, :] = self.tokenizer.convert_tokens_to_ids(batch_bert_tokens[i])
+        """
+        Run the online substitution process over many source sentences at once. In each step, every active sentence
+        masks its next content position, and all active sentences share a single padded forward pass. Sentences that
+        finish are replaced by new ones, as long as the batch fits into max_batch_tokens.
 
-                tokens_tensor = tokens_tensor.copy_(torch.from_numpy(indexed_tokens))
+        indexed_sentences: (index, sentence, POS tags or None) triples.
+        Yields (index, equivalent_sentences) pairs, in the order of indexed_sentences.
+        """
 
-                with torch.no_grad():
+        pending = (self._init_state(i, sentence, pos_tags) for i, sentence, pos_tags in indexed_sentences)
+        lookahead = next(pending, None)
+        active, finished, order = [], {}, deque()
+
+        while lookahead is not None or active:
 
-                    predictions = self.model(tokens_tensor)[0]  # (num_sentences, len(bert_tokens), voc_size)
+            while lookahead is not None and (not active or self._fits(active + [lookahead], max_batch_tokens)):
 
-                _, predicted_indices = torch.topk(predictions[:, masked_index, :], k=220, sorted=True, largest=True,
-                                                  dim=-1)
-                predicted_indices = predicted_indices.cpu().numpy()  # (num_sentences, k)
+                order.append(lookahead.index)
 
-                for i in range(1, self.num_sentences):  # the first sentence remains the original one
+                if lookahead.done:
+                    finished[lookahead.index] = lookahead.equivalent_sentences
+                else:
+                    active.append(lookahead)
 
-                    guesses = self.tokenizer.convert_ids_to_tokens(predicted_indices[i])  # (k,)
-                    chosen_w = self.choose_word(guesses, original_pos=original_pos)
+                lookahead = next(pending, None)
 
-                    if chosen_w is not None:
-                        batch_bert_tokens[i, masked_index] = chosen_w
+            if active:
 
-                        """
-                                        if subwords_exist:
-                     
-                                                suffix = batch_bert_tokens[i, masked_index + 1: orig_to_tok_map[j + 1]]
-                                                suffix_str = "".join(suffix)
-                                                chosen_w += suffix_str
-                                        """
+                self._step(active)
+
+                for state in active:
+                    if state.done:
+                        finished[state.index] = state.equivalent_sentences
+
+                active = [state for state in active if not state.done]
+
+            while order and order[0] in finished:
+                index = order.popleft()
+                yield index, finished.pop(index)
+
+    def _step(self, states: List[_OnlineSentenceState]):
+
+        """
+        Mask the next content position of each state, run a single forward pass over all of them,
+        and fill the masked positions with the words chosen.
+        """
+
+        n = self.num_sentences
+        padded_length = max(state.num_tokens for state in states)
+        indexed_tokens = np.zeros((len(states) * n, padded_length), dtype=int)
+        attention_mask = np.zeros_like(indexed_tokens)
+        masked_indices = np.zeros(len(states) * n, dtype=int)
+
+        for k, state in enumerate(states):
+
+            masked_indices[k * n: (k + 1) * n] = state.mask_next()
+
+            for i in range(n):
+                indexed_tokens[k * n + i, :state.num_tokens] = self.tokenizer.convert_tokens_to_ids(
+                    state.batch_bert_tokens[i])
+                attention_mask[k * n + i, :state.num_tokens] = 1
+
+        predictions = self._forward(indexed_tokens, attention_mask)  # (batch, padded_length, voc_size)
+        rows = torch.arange(len(masked_indices), device=self.device)
+        masked_indices = torch.from_numpy(masked_indices).to(self.device)
+
+        original_pos = []
+        for state in states:
+            j = state.positions[state.cursor]
+            original_pos.extend([state.original_pos_tags[j] if (self.maintain_pos) else None] * n)
+
+        chosen_words = self.choose_words(predictions[rows, masked_indices], original_pos)
+
+        for k, state in enumerate(states):
+            self._fill_masked(state, chosen_words[k * n: (k + 1) * n])
+
+    def _fill_masked(self, state: _OnlineSentenceState, chosen_words: List[str]):
+
+        j = state.positions[state.cursor]
+        w = state.original_sentence[j]
+        masked_index = state.orig_to_tok_map[j]
+
+        for i in range(1, self.num_sentences):  # the first sentence remains the original one
+
+            chosen_w = chosen_words[i]
+
+            if chosen_w is not None:
+                state.batch_bert_tokens[i, masked_index] = chosen_w
+
+            state.equivalent_sentences[i, j] = chosen_w.replace("##",
+                                                                "") if chosen_w is not None else w  # update the sentence with the word chosen.
+
+        state.cursor += 1
+
+
+class GibbsBertGenerator(BertGenerator):
+
+    """
+    A parallel (block-Gibbs) variant of the online generators. The content positions of the sentence are split
+    into num_blocks interleaved blocks, such that no two positions in a block are adjacent. All the positions of a
+    block are masked and filled in a single forward pass, conditioned on the current state of the other blocks.
+    After the first sweep over the blocks, num_sweeps additional sweeps re-sample each block given the others.
+    The number of forward passes per sentence is num_blocks * (1 + num_sweeps), independent of its length.
+    """
+
+    def __init__(self, data_filename, output_file, num_sentences, topn=10, ignore_first_k=0, maintain_pos=False,
+                 cuda_device=0, num_blocks=2, num_sweeps=1, **kwargs):
+
+        super().__init__(data_filename, output_file, num_sentences, topn=topn, ignore_first_k=ignore_first_k,
+                         maintain_pos=maintain_pos, cuda_device=cuda_device, **kwargs)
+
+        assert num_blocks >= 2, "at least two blocks are needed to keep adjacent positions apart"
+        self.num_blocks = num_blocks
+        self.num_sweeps = num_sweeps
+
+    def _get_blocks(self, original_sentence: List[str]) -> List[List[int]]:
+
+        blocks = [[] for _ in range(self.num_blocks)]
+
+        for j, w in enumerate(original_sentence):
+            if w not in utils.DEFAULT_PARAMS["function_words"]:
+                blocks[j % self.num_blocks].append(j)
+
+        return [block for block in blocks if block]
+
+    def get_equivalent_sentences(self, original_sentence: List[str], online=False, topn=6,
+                                 pos_tags=None) -> List[List[str]]:
+
+        bert_tokens, orig_to_tok_map = self._tokenize(original_sentence)
+
+        # the first sentence remains the original one, so only the other rows are passed through the model.
+
+        batch_bert_tokens = np.empty((self.num_sentences - 1, len(bert_tokens)), dtype=object)
+        batch_bert_tokens[:, ] = bert_tokens.copy()
+
+        equivalent_sentences = np.empty((self.num_sentences, len(original_sentence)), dtype=object)
+        equivalent_sentences[:, :] = original_sentence.copy()
+
+        if self.maintain_pos:
+            original_pos_tags = pos_tags if pos_tags is not None else self._get_pos_tags(original_sentence)
+        else:
+            original_pos_tags = None
+
+        for sweep in range(1 + self.num_sweeps):
+            for block in self._get_blocks(original_sentence):
+                self._fill_block(block, batch_bert_tokens, equivalent_sentences, orig_to_tok_map, original_pos_tags)
 
-                    equivalent_sentences[i, j] = chosen_w.replace("##",
-                                                                  "") if chosen_w is not None else w  # update the sentence with the word chosen.
         return equivalent_sentences
 
+    def _fill_block(self, block: List[int], batch_bert_tokens: np.ndarray, equivalent_sentences: np.ndarray,
+                    orig_to_tok_map: Dict[int, int], original_pos_tags=None):
+
+        masked_indices = [orig_to_tok_map[j] for j in block]
+        previous_tokens = batch_bert_tokens[:, masked_indices].copy()
+        batch_bert_tokens[:, masked_indices] = "[MASK]"
+
+        indexed_tokens = np.empty_like(batch_bert_tokens, dtype=int)
+        for i in range(len(batch_bert_tokens)):
+            indexed_tokens[i, :] = self.tokenizer.convert_tokens_to_ids(batch_bert_tokens[i])
+
+        predictions = self._forward(indexed_tokens)  # (num_sentences - 1, len(bert_tokens), voc_size)
+
+        logits = predictions[:, masked_indices, :].reshape(-1, predictions.shape[-1])  # (num_sentences - 1) * len(block) rows
+        original_pos = [original_pos_tags[j] if (self.maintain_pos) else None for j in block] * len(batch_bert_tokens)
+        chosen_words = self.choose_words(logits, original_pos)
+
+        for i in range(len(batch_bert_tokens)):
+            for b, j in enumerate(block):
+
+                chosen_w = chosen_words[i * len(block) + b]
+
+                if chosen_w is None:  # keep the current word
+                    batch_bert_tokens[i, masked_indices[b]] = previous_tokens[i, b]
+                else:
+                    batch_bert_tokens[i, masked_indices[b]] = chosen_w
+                    equivalent_sentences[i + 1, j] = chosen_w.replace("##", "")
+
 # PARAMS WERE 100, 9, IGNORE 2
@@ -1,11 +1,5 @@
 import argparse
-
-
-def read_file(input_file):
-    with open(input_file, 'r') as f:
-        lines = f.readlines()
-        lines = [x.strip() for x in lines]
-    return lines
+import corpus
 
 
 def write_file(output_file, data):
@@ -33,8 +27,8 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    data = read_file(args.input_wiki)
-    filtered_data = list(filter(lambda x: args.min_length < len(x.split()) < args.max_length, data))
+    data = corpus.Corpus(args.input_wiki)
+    filtered_data = data.filter_length(args.min_length, args.max_length)
 
     eval_data = filtered_data[args.train_size:]
-    write_file(args.out_file, eval_data)
+    write_file(args.out_file, eval_data.lines())
@@ -0,0 +1,74 @@
+"""
+Compare the parallel (block-Gibbs) BERT generator with the sequential online generator, in terms of
+speed (sentences/sec, forward passes per sentence) and quality (the mean group similarity score of
+filter_sentences.calcualte_similarity_score: lower means the equivalent sentences are semantically closer
+to each other; higher means more diverse substitutions).
+"""
+
+import argparse
+import time
+import numpy as np
+import generators
+import filter_sentences
+
+
+def evaluate_generator(generator, sentences, embds, vocab):
+
+    start = time.time()
+    groups = [generator.get_equivalent_sentences(sentence) for sentence in sentences]
+    elapsed = time.time() - start
+
+    scores = [filter_sentences.get_group_similarity_score(group, embds, vocab) for group in groups]
+
+    return len(sentences) / elapsed, np.mean(scores), np.std(scores)
+
+
+def count_passes(generator, sentences) -> float:
+
+    if isinstance(generator, generators.GibbsBertGenerator):
+        passes = [len(generator._get_blocks(s)) * (1 + generator.num_sweeps) for s in sentences]
+    else:
+        passes = [len([w for w in s if w not in generators.utils.DEFAULT_PARAMS["function_words"]]) for s in sentences]
+
+    return np.mean(passes)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sequential vs. block-Gibbs generation report',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--input-wiki', dest='input_wiki', type=str,
+                        default='../../data/external/wiki.clean.250k',
+                        help='name of the source wikipedia text file')
+    parser.add_argument('--w2v-file', dest='w2v_file', type=str,
+                        default='../../data/external/GoogleNews-vectors-negative300.bin',
+                        help='word2vec file used for the similarity score')
+    parser.add_argument('--num-sents', dest='num_sents', type=int, default=500,
+                        help='number of source sentences to generate from')
+    parser.add_argument('--num-sentences', dest='num_sentences', type=int, default=7,
+                        help='Number of equivalent sentences to generate from each sentence.')
+    parser.add_argument('--sweeps', dest='sweeps', type=str, default="0,1,2",
+                        help='comma-separated list of refinement sweeps to evaluate')
+    parser.add_argument('--cuda-device', dest='cuda_device', type=int, default=0,
+                        help='cuda device to run the LM on')
+
+    args = parser.parse_args()
+    embds, vocab = filter_sentences.load_embeddings(args.w2v_file)
+    rows = []
+
+    generator = generators.BatchedOnlineBertGenerator(args.input_wiki, "", args.num_sentences, topn=25,
+                                                      maintain_pos=True, cuda_device=args.cuda_device)
+    sentences = generator.sentences[:args.num_sents]
+    rows.append(("sequential", count_passes(generator, sentences)) + evaluate_generator(generator, sentences, embds,
+                                                                                        vocab))
+    del generator
+
+    for num_sweeps in [int(x) for x in args.sweeps.split(",")]:
+        generator = generators.GibbsBertGenerator(args.input_wiki, "", args.num_sentences, topn=25, maintain_pos=True,
+                                                  cuda_device=args.cuda_device, num_sweeps=num_sweeps)
+        rows.append(("gibbs, sweeps={}".format(num_sweeps), count_passes(generator, sentences))
+                    + evaluate_generator(generator, sentences, embds, vocab))
+        del generator
+
+    print("{:<20}{:>16}{:>16}{:>16}{:>16}".format("mode", "passes/sent", "sents/sec", "score (mean)", "score (std)"))
+    for name, passes, speed, mean_score, std_score in rows:
+        print("{:<20}{:>16.1f}{:>16.2f}{:>16.4f}{:>16.4f}".format(name, passes, speed, mean_score, std_score))
@@ -0,0 +1,175 @@
+"""
+A compact, integer-coded storage format for groups of equivalent sentences.
+
+A store is a directory holding:
+    vocab.txt         - the vocabulary of all groups, one word per line (word ids are line numbers).
+    keys.npy          - int64, the sentence index (key) of each group.
+    group_offsets.npy - int64 array of size num_groups + 1; the sentences of group k are the sentences
+                        group_offsets[k]:group_offsets[k + 1].
+    sent_lengths.npy  - int32, the length of each sentence.
+    sent_rows.npy     - int64, the row of each sentence in the bucket of its length.
+    bucket_<L>.npy    - int32 array of shape (num_sentences_of_length_L, L), the word ids of the sentences of
+                        length L.
+All arrays are memory-mapped, and groups are decoded only when they are accessed.
+"""
+
+import argparse
+import os
+from collections.abc import Mapping, Sequence
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+
+def is_group_store(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, "group_offsets.npy"))
+
+
+def write_groups(items: Iterable[Tuple[int, List[List[str]]]], path: str):
+    """
+    items: (sentence index, group of equivalent sentences) pairs, in the order they should be stored.
+    """
+
+    word2id = dict()
+    keys, group_offsets, sent_lengths, sent_rows = [], [0], [], []
+    buckets = dict()  # length -> list of word id lists
+
+    for i, group in items:
+        keys.append(i)
+        group_offsets.append(group_offsets[-1] + len(group))
+
+        for sentence in group:
+            bucket = buckets.setdefault(len(sentence), [])
+            sent_lengths.append(len(sentence))
+            sent_rows.append(len(bucket))
+            bucket.append([word2id.setdefault(w, len(word2id)) for w in sentence])
+
+    os.makedirs(path, exist_ok=True)
+
+    with open(os.path.join(path, "vocab.txt"), "w", encoding="utf-8") as f:
+        for w in sorted(word2id, key=word2id.get):
+            f.write(w + "\n")
+
+    np.save(os.path.join(path, "keys.npy"), np.array(keys, dtype=np.int64))
+    np.save(os.path.join(path, "sent_lengths.npy"), np.array(sent_lengths, dtype=np.int32))
+    np.save(os.path.join(path, "sent_rows.npy"), np.array(sent_rows, dtype=np.int64))
+
+    for length, bucket in buckets.items():
+        np.save(os.path.join(path, "bucket_{}.npy".format(length)),
+                np.array(bucket, dtype=np.int32).reshape(len(bucket), length))
+
+    # written last, as it marks the store as complete (see is_group_store)
+    np.save(os.path.join(path, "group_offsets.npy"), np.array(group_offsets, dtype=np.int64))
+
+
+class GroupList(Sequence):
+    """
+    A lazy list of the groups of a store, in storage order (like list(groups_dict.values())).
+    """
+
+    def __init__(self, store: "GroupStore", positions: range):
+        self.store = store
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return GroupList(self.store, self.positions[k])
+
+        return self.store.get_group(self.positions[k])
+
+
+class GroupStore(Mapping):
+    """
+    A read-only mapping from sentence indices to groups of equivalent sentences (lists of lists of words), that
+    can be used in place of the legacy Dict[int, List[List[str]]].
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(os.path.join(path, "vocab.txt"), "r", encoding="utf-8") as f:
+            self.vocab = [line.rstrip("\n") for line in f]
+
+        self.keys_array, self.group_offsets, self.sent_lengths, self.sent_rows = [
+            np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+            for name in ["keys", "group_offsets", "sent_lengths", "sent_rows"]]
+
+        self.buckets = dict()
+        self._key2position = None
+
+    def _bucket(self, length: int) -> np.ndarray:
+        if length not in self.buckets:
+            self.buckets[length] = np.load(os.path.join(self.path, "bucket_{}.npy".format(length)), mmap_mode="r")
+
+        return self.buckets[length]
+
+    def get_ids(self, k: int) -> List[np.ndarray]:
+        """
+        return: the word ids of the sentences of the k-th group (in storage order).
+        """
+
+        return [self._bucket(self.sent_lengths[s])[self.sent_rows[s]]
+                for s in range(self.group_offsets[k], self.group_offsets[k + 1])]
+
+    def get_group(self, k: int) -> List[List[str]]:
+        return [[self.vocab[w] for w in ids] for ids in self.get_ids(k)]
+
+    def __len__(self):
+        return len(self.keys_array)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.keys_array.tolist())
+
+    def __getitem__(self, i: int) -> List[List[str]]:
+        if self._key2position is None:
+            self._key2position = {key: k for k, key in enumerate(self.keys_array.tolist())}
+
+        return self.get_group(self._key2position[i])
+
+    def values(self) -> GroupList:
+        return GroupList(self, range(len(self)))
+
+    def items(self) -> Iterator[Tuple[int, List[List[str]]]]:
+        return zip(self, self.values())
+
+
+def group_list(groups) -> Sequence:
+    """
+    groups: a GroupStore, or a dictionary mapping sentence indices to groups.
+    return: a list of the groups (lazy, for a GroupStore).
+    """
+
+    if isinstance(groups, GroupStore):
+        return groups.values()
+
+    return list(groups.values())
+
+
+def convert(input_path: str, output_path: str):
+    """
+    Convert a legacy pickle (or a shard file) of equivalent sentences into a group store.
+    """
+
+    import shards
+
+    groups: Dict[int, List[List[str]]] = shards.load_equivalent_sentences(input_path)
+    write_groups(groups.items(), output_path)
+
+    print("Converted {} groups.".format(len(groups)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert equivalent sentences to the integer-coded group store',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--input-sentences', dest='input_sentences', type=str,
+                        default='../../data/interim/bert_online_sents_same_pos5.pickle',
+                        help='pickled (or shard) equivalent sentences file')
+    parser.add_argument('--output-dir', dest='output_dir', type=str,
+                        default='../../data/interim/bert_online_sents_same_pos5.groups',
+                        help='directory of the group store')
+
+    args = parser.parse_args()
+    convert(args.input_sentences, args.output_dir)
@@ -0,0 +1,138 @@
+"""
+A precomputed nearest-neighbours table for EmbeddingBasedGenerator.
+
+For every word of the corpus vocabulary that has a word2vec vector, the table holds its topn nearest
+neighbours by cosine similarity, searched over the whole word2vec vocabulary (the same as KeyedVectors.most_similar).
+The table is stored in a directory, as:
+    queries.txt    - the words the table covers, one per line (row i of neighbours.npy).
+    candidates.txt - the words the neighbours are taken from (neighbour ids are line numbers).
+    neighbours.npy - int32 array of shape (num_queries, topn), sorted by decreasing similarity.
+"""
+
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import numpy as np
+import tqdm
+
+import corpus
+import utils
+
+
+def _normalize(vecs: np.ndarray) -> np.ndarray:
+    vecs = np.asarray(vecs, dtype=np.float32)
+    return vecs / np.maximum(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-8)
+
+
+def _read_words(path: str) -> List[str]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.rstrip("\n") for line in f]
+
+
+def _write_words(path: str, words: List[str]):
+    with open(path, "w", encoding="utf-8") as f:
+        for w in words:
+            f.write(w + "\n")
+
+
+def build_knn_table(embeddings, vocab: List[str], output_dir: str, topn=8, restrict_vocab=None, block_size=16,
+                    workers=4):
+    """
+    embeddings: gensim KeyedVectors.
+    vocab: the words to compute neighbours for (words without a vector are skipped).
+    restrict_vocab: search the neighbours among this number of most frequent word2vec words (None for all, as
+                    most_similar does). A limit gives different neighbours from most_similar, for the words whose
+                    nearest neighbours are rarer.
+    block_size: number of query words per matrix product. Each thread holds a few (block_size, num_candidates)
+                float32 arrays: about 200MB each for 16 rows against the 3M words of GoogleNews.
+    workers: number of threads; each computes the neighbours of one block of queries at a time.
+    """
+
+    candidates = embeddings.index2word[:restrict_vocab]
+    candidate_vecs = _normalize(embeddings.vectors[:len(candidates)])
+    cand2i = {w: i for i, w in enumerate(candidates)}
+
+    queries = [w for w in vocab if w in embeddings.vocab]
+    query_vecs = _normalize(np.stack([embeddings[w] for w in queries])) if queries else np.zeros((0, 300))
+
+    os.makedirs(output_dir, exist_ok=True)
+    neighbours = np.lib.format.open_memmap(os.path.join(output_dir, "neighbours.npy"), mode="w+", dtype=np.int32,
+                                           shape=(len(queries), topn))
+
+    def run_block(start: int):
+        end = min(start + block_size, len(queries))
+        sims = query_vecs[start:end] @ candidate_vecs.T  # (block_size, num_candidates)
+
+        for k in range(start, end):  # a word is not its own neighbour
+            if queries[k] in cand2i:
+                sims[k - start, cand2i[queries[k]]] = -np.inf
+
+        top = np.argpartition(-sims, topn, axis=1)[:, :topn]
+        order = np.argsort(-np.take_along_axis(sims, top, axis=1), axis=1)
+        neighbours[start:end] = np.take_along_axis(top, order, axis=1)
+
+    print("Computing nearest neighbours...")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(tqdm.tqdm(pool.map(run_block, range(0, len(queries), block_size)),
+                       total=(len(queries) + block_size - 1) // block_size))
+
+    neighbours.flush()
+    _write_words(os.path.join(output_dir, "queries.txt"), queries)
+    _write_words(os.path.join(output_dir, "candidates.txt"), candidates)
+
+
+def exists(output_dir: str) -> bool:
+    return os.path.isfile(os.path.join(output_dir, "candidates.txt"))
+
+
+class KNNTable(object):
+
+    def __init__(self, output_dir: str):
+        self.queries = {w: i for i, w in enumerate(_read_words(os.path.join(output_dir, "queries.txt")))}
+        self.candidates = _read_words(os.path.join(output_dir, "candidates.txt"))
+        self.neighbours = np.load(os.path.join(output_dir, "neighbours.npy"), mmap_mode="r")
+
+    def __contains__(self, w: str) -> bool:
+        return w in self.queries
+
+    def get(self, w: str) -> List[str]:
+        return [self.candidates[j] for j in self.neighbours[self.queries[w]]]
+
+
+def corpus_vocab(sentences: List[List[str]]) -> List[str]:
+    return sorted(set(w for sentence in sentences for w in sentence) - utils.DEFAULT_PARAMS["function_words"])
+
+
+if __name__ == '__main__':
+    import gensim
+
+    parser = argparse.ArgumentParser(description='Nearest-neighbours table for the embeddings generator',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--input-wiki', dest='input_wiki', type=str,
+                        default='../../data/external/wiki.clean.250k',
+                        help='name of the source wikipedia text file')
+    parser.add_argument('--w2v-file', dest='w2v_file', type=str,
+                        default='../../data/external/GoogleNews-vectors-negative300.bin',
+                        help='word2vec file')
+    parser.add_argument('--output-dir', dest='output_dir', type=str,
+                        default='../../data/interim/knn_table',
+                        help='where to store the table')
+    parser.add_argument('--topn', dest='topn', type=int, default=8,
+                        help='number of neighbours per word')
+    parser.add_argument('--restrict-vocab', dest='restrict_vocab', type=int, default=0,
+                        help='search the neighbours among this number of most frequent word2vec words (0 for all, '
+                             'as most_similar does)')
+    parser.add_argument('--block-size', dest='block_size', type=int, default=16,
+                        help='number of query words per matrix product (bounds the memory of each thread)')
+    parser.add_argument('--workers', dest='workers', type=int, default=4,
+                        help='number of threads')
+
+    args = parser.parse_args()
+
+    embeddings = gensim.models.KeyedVectors.load_word2vec_format(args.w2v_file, binary=True)
+    vocab = corpus_vocab(corpus.Corpus(args.input_wiki))
+    build_knn_table(embeddings, vocab, args.output_dir, topn=args.topn, restrict_vocab=args.restrict_vocab or None,
+                    block_size=args.block_size, workers=args.workers)
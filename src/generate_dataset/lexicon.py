@@ -0,0 +1,163 @@
+"""
+An integer-coded substitution lexicon: for each context (a POS tag, or an n-gram of POS tags), the words that
+may replace a word appearing in that context.
+
+The lexicon is stored in a directory, as:
+    words.txt   - the vocabulary of candidate words, one per line (word ids are line numbers).
+    keys.npy    - sorted uint64 hashes of the contexts.
+    indptr.npy  - int64 array of size len(keys) + 1 (CSR row pointers).
+    indices.npy - int32 word ids; the candidates of keys[k] are indices[indptr[k]:indptr[k + 1]].
+The arrays are memory-mapped when loaded.
+"""
+
+import hashlib
+import multiprocessing
+import os
+import random
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import numpy as np
+
+
+def key_hash(key: str) -> int:
+    """
+    A hash of a context string, that (unlike hash()) is stable across processes and runs.
+    """
+
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class Lexicon(object):
+
+    def __init__(self, words: List[str], keys: np.ndarray, indptr: np.ndarray, indices: np.ndarray):
+        self.words = words
+        self.keys = keys
+        self.indptr = indptr
+        self.indices = indices
+
+    def candidates(self, key: str) -> np.ndarray:
+        """
+        return: the ids of the candidate words of the context key (an empty array if the context is unknown).
+        """
+
+        h = np.uint64(key_hash(key))
+        k = np.searchsorted(self.keys, h)
+
+        if k == len(self.keys) or self.keys[k] != h:
+            return self.indices[:0]
+
+        return self.indices[self.indptr[k]: self.indptr[k + 1]]
+
+    def sample(self, key: str) -> str:
+        """
+        return: a random candidate word of the context key, or None if it has no candidates.
+        """
+
+        candidates = self.candidates(key)
+
+        if len(candidates) == 0:
+            return None
+
+        return self.words[candidates[random.randrange(len(candidates))]]
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+
+        with open(os.path.join(path, "words.txt"), "w", encoding="utf-8") as f:
+            for w in self.words:
+                f.write(w + "\n")
+
+        np.save(os.path.join(path, "keys.npy"), self.keys)
+        np.save(os.path.join(path, "indptr.npy"), self.indptr)
+        np.save(os.path.join(path, "indices.npy"), self.indices)
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.isfile(os.path.join(path, "indices.npy"))
+
+    @staticmethod
+    def load(path: str) -> "Lexicon":
+        with open(os.path.join(path, "words.txt"), "r", encoding="utf-8") as f:
+            words = [line.rstrip("\n") for line in f]
+
+        keys, indptr, indices = [np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+                                 for name in ["keys", "indptr", "indices"]]
+
+        return Lexicon(words, keys, indptr, indices)
+
+    @staticmethod
+    def from_dict(key2words: Dict[str, Iterable[str]]) -> "Lexicon":
+        """
+        Build a lexicon from a dictionary mapping contexts to collections of words (e.g. a legacy pos2words pickle).
+        """
+
+        words = sorted(set(w for candidates in key2words.values() for w in candidates))
+        w2i = {w: i for i, w in enumerate(words)}
+
+        rows = sorted((key_hash(key), sorted(w2i[w] for w in candidates)) for key, candidates in key2words.items())
+        keys = np.array([h for h, _ in rows], dtype=np.uint64)
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(ids) for _, ids in rows])
+        indices = np.array([i for _, ids in rows for i in ids], dtype=np.int32)
+
+        return Lexicon(words, keys, indptr, indices)
+
+
+_shard_data = None  # (sentences, pos tags, key function), inherited by the workers of count_pairs
+
+
+def _count_shard(bounds: Tuple[int, int]) -> Tuple[Counter, Counter]:
+    sentences, pos_tags, key_fn = _shard_data
+    pair_counts, word_counts = Counter(), Counter()
+
+    for i in range(*bounds):
+        for key, w in key_fn(sentences[i], pos_tags[i]):
+            pair_counts[(key, w)] += 1
+            word_counts[w] += 1
+
+    return pair_counts, word_counts
+
+
+def count_pairs(sentences: List[List[str]], pos_tags, key_fn: Callable, workers=1,
+                shard_size=10000) -> Tuple[Counter, Counter]:
+    """
+    Count the (context, word) pairs of the corpus, in parallel shards that are merged at the end.
+
+    pos_tags: indexable, pos_tags[i] are the POS tags of sentences[i].
+    key_fn: maps a sentence and its POS tags to a list of (context, word) pairs.
+    return: the counts of (context, word) pairs, and the counts of words.
+    """
+
+    global _shard_data
+    _shard_data = (sentences, pos_tags, key_fn)
+
+    shards = [(start, min(start + shard_size, len(sentences))) for start in range(0, len(sentences), shard_size)]
+    pair_counts, word_counts = Counter(), Counter()
+
+    if workers > 1:
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            results = list(pool.imap_unordered(_count_shard, shards))
+    else:
+        results = map(_count_shard, shards)
+
+    for shard_pair_counts, shard_word_counts in results:
+        pair_counts.update(shard_pair_counts)
+        word_counts.update(shard_word_counts)
+
+    return pair_counts, word_counts
+
+
+def build_lexicon(pair_counts: Counter, word_counts: Counter, min_pair_count=0, min_word_count=0) -> Lexicon:
+    """
+    Keep the (context, word) pairs occurring more than min_pair_count times, whose word occurs more than
+    min_word_count times in the corpus.
+    """
+
+    key2words = dict()
+
+    for (key, w), count in pair_counts.items():
+        if count > min_pair_count and word_counts[w] > min_word_count:
+            key2words.setdefault(key, []).append(w)
+
+    return Lexicon.from_dict(key2words)
@@ -2,7 +2,15 @@ import generators
 import argparse
 import model
 from model_runner import ModelRunner, TuplesModelRunner
-import pickle
+import shards
+import pipeline
+import storage
+import corpus
+import elmo_encoder
+import sharding
+import torch
+from encoding_cache import EncodingCache, GB
+from quality_gate import QualityGate
 
 #import torch.backends
 #torch.backends.cudnn.benchmark=True
@@ -19,7 +27,7 @@ if __name__ == '__main__':
                         help='name of the source wikipedia text file')
     parser.add_argument('--w2v-file', dest='w2v_file', type=str,
                         default='../../data/external/GoogleNews-vectors-negative300.bin',
-                        help='name of the source wikipedia text file')
+                        help='word2vec binary file, or a pruned .npy store created by w2v_store.py')
     parser.add_argument('--output-data', dest='output_data', type=str,
                         default='../../data/interim/elmo_states.fwd.wiki.hdf5',
                         help='name of the output file')
@@ -34,20 +42,85 @@ if __name__ == '__main__':
     parser.add_argument('--num-sentences', dest='num_sentences', type=int, default=7,
                         help='Number of equivalent sentences to generate from each sentence.')
     parser.add_argument('--substitutions-type', dest='substitution_type', type=str,
-                        default='bert')
+                        default='bert', help='bert / bert-gibbs / pos / embeddings')
     parser.add_argument('--substitutions-file', dest='substitution_file', type=str,
                         default = '../../data/interim/bert.wiki.repeat=1.guesses=30.pickle')
     parser.add_argument('--elmo_folder', dest='elmo_folder', type=str,
                         default='../../data/external')
     parser.add_argument('--cuda-device', dest='cuda_device', type=int, default=2,
-                        help='cuda device to run the LM on')
+                        help='cuda device to run the LM on (-1 for CPU)')
     parser.add_argument('--dataset-type', dest='dataset_type', type=str, default="all",
                         help='all / pairs')
     parser.add_argument('--layers', '--list', dest = "layers", help='list of ELMO layers to include', type=str, default = "0,1,2")
+    parser.add_argument('--max-batch-tokens', dest='max_batch_tokens', type=int, default=0,
+                        help='if > 0, the BERT generator interleaves several source sentences in each forward pass, '
+                             'up to this number of (padded) tokens per batch')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help='keep the groups already in --output-sentences and skip their source sentences')
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+                        help='number of worker processes for the pos / embeddings generators '
+                             '(also used for building the substitution lexicon)')
+    parser.add_argument('--seed', dest='seed', type=int, default=None,
+                        help='if given, seed the generation of each sentence with seed + its index')
+    parser.add_argument('--knn-dir', dest='knn_dir', type=str, default='',
+                        help='precomputed nearest-neighbours table of the embeddings generator (built if missing)')
+    parser.add_argument('--tagging-processes', dest='tagging_processes', type=int, default=1,
+                        help='number of processes for the one-time POS tagging of --input-wiki')
+    parser.add_argument('--bert-model', dest='bert_model', type=str, default='bert-large-uncased-whole-word-masking',
+                        help='masked LM used by the bert generators')
+    parser.add_argument('--quantize', dest='quantize', action='store_true',
+                        help='apply dynamic int8 quantization to the bert generator (CPU only)')
+    parser.add_argument('--num-threads', dest='num_threads', type=int, default=0,
+                        help='number of CPU threads used by torch (0 for the default)')
+    parser.add_argument('--gibbs-sweeps', dest='gibbs_sweeps', type=int, default=1,
+                        help='number of refinement sweeps of the bert-gibbs generator')
+    parser.add_argument('--quality-gate', dest='quality_gate', action='store_true',
+                        help='reject generated groups that are identical to the source or contain duplicate sentences')
+    parser.add_argument('--min-similarity-score', dest='min_similarity_score', type=float, default=None,
+                        help='with --quality-gate, also reject groups scored below this (see filter_sentences.py; '
+                             'uses --w2v-file)')
+    parser.add_argument('--max-similarity-score', dest='max_similarity_score', type=float, default=None,
+                        help='with --quality-gate, also reject groups scored above this')
+    parser.add_argument('--quality-retries', dest='quality_retries', type=int, default=2,
+                        help='number of times a rejected group is regenerated before it is dropped')
+    parser.add_argument('--encode-batch-tokens', dest='encode_batch_tokens', type=int, default=4096,
+                        help='encode the sentences of several groups together, in length-sorted batches of up to '
+                             'this number of (padded) tokens (0 to encode each group separately)')
+    parser.add_argument('--writer-process', dest='writer_process', action='store_true',
+                        help='compress and write the HDF5 output in a separate process (instead of a thread)')
+    parser.add_argument('--pipeline', dest='pipeline', action='store_true',
+                        help='encode the groups while they are generated, instead of after the generation is done '
+                             '(not for --dataset-type pairs)')
+    parser.add_argument('--pipeline-batch-size', dest='pipeline_batch_size', type=int, default=32,
+                        help='number of groups encoded together in --pipeline mode')
+    parser.add_argument('--storage-dtype', dest='storage_dtype', type=str, default='float32',
+                        choices=storage.STORAGE_DTYPES,
+                        help='dtype in which the vectors are stored. readers upcast them back to float32')
+    parser.add_argument('--codec', dest='codec', type=str, default='gzip:4',
+                        help='compression of the stored vectors: none / lzf / gzip:N')
+    parser.add_argument('--num-workers', dest='num_workers', type=int, default=1,
+                        help='number of processes encoding the groups in parallel, each into its own shard. '
+                             'the shards are merged into the output file (not for --pipeline; CPU only)')
+    parser.add_argument('--shard', dest='shard', type=str, default='',
+                        help='i/n - encode only shard i of n (merge the shards with sharding.py)')
+    parser.add_argument('--elmo-bidirectional', dest='elmo_bidirectional', action='store_true',
+                        help='run both directions of ELMo (1024 dims per layer). by default only the forward LSTMs '
+                             'run, and each layer is its forward half (512 dims)')
+    parser.add_argument('--elmo-vocab-size', dest='elmo_vocab_size', type=int, default=200000,
+                        help='number of most frequent words whose char-CNN representations ELMo computes once '
+                             '(0 to run the char-CNN on every token)')
+    parser.add_argument('--cache-dir', dest='cache_dir', type=str, default='',
+                        help='directory of a persistent cache of encoded sentences (no cache if empty)')
+    parser.add_argument('--cache-size-gb', dest='cache_size_gb', type=float, default=10,
+                        help='maximal size of the encoding cache; least recently used sentences are evicted')
 
 
     args = parser.parse_args()
 
+    if args.num_workers > 1 and args.cuda_device >= 0:
+        parser.error("--num-workers > 1 forks the workers, which can not use CUDA: use --cuda-device -1, "
+                     "or run each shard as a separate job with --shard")
+
     layers = [int(item) if item.isdigit() else item for item in args.layers.split(',')]
 
     if args.layers != "mean":
@@ -56,6 +129,8 @@ if __name__ == '__main__':
         layers = "mean"
 
     maintain_pos = True
+    bert_backend = {"bert_model": args.bert_model, "quantize": args.quantize, "num_threads": args.num_threads,
+                    "tagging_processes": args.tagging_processes}
 
     # If no substitution file is provided, need to build these
     if args.substitution_file == '':
@@ -64,41 +139,86 @@ if __name__ == '__main__':
         if args.substitution_type == 'embeddings':
             generator = generators.EmbeddingBasedGenerator(args.input_wiki, args.output_sentences,
                                                            args.num_sentences,
-                                                           args.w2v_file, 7)
+                                                           args.w2v_file, 7, knn_dir = args.knn_dir,
+                                                           knn_workers = max(args.workers, 1))
+        elif args.substitution_type == 'bert-gibbs':
+            generator = generators.GibbsBertGenerator(args.input_wiki, args.output_sentences,
+                                                      args.num_sentences, topn = (25 if maintain_pos else 20), maintain_pos = maintain_pos,
+                                                      cuda_device = args.cuda_device, num_sweeps = args.gibbs_sweeps, **bert_backend)
         elif args.substitution_type == 'pos':
             generator = generators.POSBasedEGenerator2(args.input_wiki, args.output_sentences,
                                                       args.pos_tags_to_replace, args.num_sentences,
-                                                      args.pos2words_file)
+                                                      args.pos2words_file, tagging_processes = args.tagging_processes,
+                                                      lexicon_workers = args.workers)
         else:
             #generator = generators.OnlineBertGenerator(args.input_wiki, args.output_sentences,
             #                                          args.num_sentences)
             generator = generators.BatchedOnlineBertGenerator(args.input_wiki, args.output_sentences,
-                                                      args.num_sentences, topn = (25 if maintain_pos else 20), ignore_first_k = 0, maintain_pos = maintain_pos, cuda_device = args.cuda_device, num_repeats = 1) # was 13
+                                                      args.num_sentences, topn = (25 if maintain_pos else 20), ignore_first_k = 0, maintain_pos = maintain_pos, cuda_device = args.cuda_device, max_batch_tokens = args.max_batch_tokens, **bert_backend) # was 13
+
+        quality_gate = None
+        if args.quality_gate:
+            quality_gate = QualityGate(min_score=args.min_similarity_score, max_score=args.max_similarity_score,
+                                       w2v_file=args.w2v_file)
+
+        generation_args = dict(resume=args.resume, workers=args.workers, seed=args.seed, quality_gate=quality_gate,
+                               max_retries=args.quality_retries)
 
-        equivalent_sentences = generator.generate()
+        if not args.pipeline or args.dataset_type == "pairs":
+            equivalent_sentences = generator.generate(**generation_args)
+        else:
+            equivalent_sentences = None  # generated and encoded together below
     # otherwise, reading that file
     else:
-        with open(args.substitution_file, "rb") as f:
-            equivalent_sentences = pickle.load(f)
+        equivalent_sentences = shards.load_equivalent_sentences(args.substitution_file)
+
+    cache = EncodingCache(args.cache_dir, max_bytes=int(args.cache_size_gb * GB)) if args.cache_dir else None
 
     use_elmo = True
 
     if use_elmo:
         elmo_folder = args.elmo_folder
 
+        elmo_vocab = None
+        if args.elmo_vocab_size:
+            if equivalent_sentences is not None and args.dataset_type != "pairs":
+                vocab_sentences = (sent for group in equivalent_sentences.values() for sent in group)
+            else:
+                vocab_sentences = corpus.Corpus(args.input_wiki)
+
+            elmo_vocab = elmo_encoder.build_vocab(vocab_sentences, max_size=args.elmo_vocab_size)
+
         model = model.Elmo(elmo_folder + '/elmo_2x4096_512_2048cnn_2xhighway_options.json',
                        elmo_folder + '/elmo_2x4096_512_2048cnn_2xhighway_weights.hdf5',
-                       args.cuda_device, layers, only_fwd = True)
+                       args.cuda_device, layers, only_fwd = not args.elmo_bidirectional, cache = cache, vocab = elmo_vocab)
     else:
         raise NotImplementedError('need to chose of the available random states')
 
     USE_ELMO = True
     if not USE_ELMO:
       print("Using BERT")
-      model = model.Bert(args.cuda_device, layers = layers)
+      model = model.Bert(args.cuda_device, layers = layers, cache = cache)
 
-    if args.dataset_type == "pairs":
-        model_runner = TuplesModelRunner(model, equivalent_sentences, args.output_data, persist=True)
+    if equivalent_sentences is None:
+        pipeline.run_pipeline(generator, model, args.output_data, batch_size=args.pipeline_batch_size,
+                              max_batch_tokens=args.encode_batch_tokens or None, storage_dtype=args.storage_dtype,
+                              codec=args.codec, **generation_args)
     else:
-        model_runner = ModelRunner(model, equivalent_sentences, args.output_data, persist=True)
-    model_runner.run()
+        if args.dataset_type == "pairs":
+            model_runner = TuplesModelRunner(model, equivalent_sentences, args.output_data, persist=True)
+        else:
+            model_runner = ModelRunner(model, equivalent_sentences, args.output_data, persist=True,
+                                       max_batch_tokens=args.encode_batch_tokens or None,
+                                       writer_process=args.writer_process, storage_dtype=args.storage_dtype,
+                                       codec=args.codec, shard=sharding.parse_shard(args.shard) if args.shard else None)
+
+        if args.num_workers > 1 and args.dataset_type != "pairs":
+            model_runner.run_parallel(args.num_workers, args.num_threads)
+        else:
+            if args.shard and args.num_threads:
+                torch.set_num_threads(args.num_threads)
+
+            model_runner.run()
+
+    if cache is not None:
+        print(cache.report())
@@ -1,46 +1,182 @@
 import model
-from typing import Dict, List
+from typing import Dict, List, Tuple
 import numpy as np
 import utils
 import tqdm
 import random
-import h5py
+import time
+from hdf5_writer import AsyncHDF5Writer
+import sharding
+
+
+class EncodingStats(object):
+    """
+    Throughput, padding and deduplication statistics of the encoding of batches of sentences.
+    """
+
+    def __init__(self):
+        self.num_rows = 0  # sentences of the groups, including duplicates (see encode_groups)
+        self.num_sentences = 0
+        self.num_tokens = 0
+        self.num_padded_tokens = 0  # batch size * length of the longest sentence, summed over batches
+        self.time = 0.
+
+    def update(self, lengths: List[int], elapsed: float):
+        self.num_sentences += len(lengths)
+        self.num_tokens += sum(lengths)
+        self.num_padded_tokens += len(lengths) * max(lengths)
+        self.time += elapsed
+
+    def report(self) -> str:
+        return ("Encoded {} sentences in {:.1f}s ({:.1f} sentences/sec), padding waste {:.1f}%, "
+                "{} of {} sentences were duplicates ({:.1f}% not encoded)").format(
+            self.num_sentences, self.time, self.num_sentences / max(self.time, 1e-8),
+            100. * (1 - self.num_tokens / max(self.num_padded_tokens, 1)),
+            self.num_rows - self.num_sentences, self.num_rows,
+            100. * (1 - self.num_sentences / max(self.num_rows, 1)))
+
+
+def encode_groups(model: model.ModelInterface, groups: List[List[List[str]]], max_batch_tokens=None,
+                  stats: EncodingStats = None, dedup=True) -> List[List[np.ndarray]]:
+    """
+    Encode the sentences of several groups, packed into length-sorted batches of up to max_batch_tokens
+    (padded) tokens, with one call to model.run per batch. If max_batch_tokens is None, each group is a batch.
+    dedup: encode each distinct sentence of the groups once (a group repeats sentences, and several groups may
+           share their original sentence), and use its vectors for all its occurrences.
+    return: the vectors of the sentences of each group, in the order of groups.
+    """
+
+    sentences = []  # (k, j) of the first occurrence of each sentence to encode
+    occurrences = dict()  # sentence -> the index in sentences of its first occurrence
+    rows = []  # (k, j, index in sentences) of every sentence of the groups
+
+    for k, group in enumerate(groups):
+        for j, sentence in enumerate(group):
+            key = tuple(sentence) if dedup else (k, j)
+
+            if key not in occurrences:
+                occurrences[key] = len(sentences)
+                sentences.append((k, j))
+
+            rows.append((k, j, occurrences[key]))
+
+    lengths = [len(groups[k][j]) for k, j in sentences]
+
+    if max_batch_tokens:
+        batches = utils.pack_batches(lengths, max_batch_tokens)
+    else:
+        batches = [[] for _ in groups]
+        for s, (k, _) in enumerate(sentences):
+            batches[k].append(s)
+
+    sentence_vecs = [None] * len(sentences)
+
+    for batch in batches:
+        if not batch:  # a group whose sentences all appeared in previous groups
+            continue
+
+        start = time.time()
+        batch_vecs = model.run([groups[sentences[s][0]][sentences[s][1]] for s in batch])
+
+        for s, v in zip(batch, batch_vecs):
+            sentence_vecs[s] = v
+
+        if stats is not None:
+            stats.update([lengths[s] for s in batch], time.time() - start)
+
+    if stats is not None:
+        stats.num_rows += len(rows)
+
+    vecs = [[None] * len(group) for group in groups]
+    for k, j, s in rows:
+        vecs[k][j] = sentence_vecs[s]
+
+    return vecs
 
-FUNCTION_WORDS = utils.DEFAULT_PARAMS['function_words']
 
 class ModelRunner(object):
 
     def __init__(self, model: model.ModelInterface,
                  equivalent_sentences_dict: Dict[int, List[List[str]]],
                  output_file: str,
-                 persist=True):
+                 persist=True,
+                 max_batch_tokens=None,
+                 window_size=512,
+                 writer_process=False,
+                 storage_dtype="float32",
+                 codec="gzip:4",
+                 shard=None):
+
+        """
+        max_batch_tokens: if given, sentences of several groups are encoded together, in length-sorted batches
+                          of up to this number of (padded) tokens. Otherwise, each group is encoded separately.
+        window_size: the number of groups whose sentences are deduplicated and packed into batches together.
+        writer_process: compress and write the groups in a separate process, instead of a background thread.
+        storage_dtype, codec: the storage of the vectors (see storage.py).
+        shard: (i, n) - encode only shard i of n, into its shard file (see sharding.py).
+        """
 
         self.model = model
         self.equivalent_sentences_dict = equivalent_sentences_dict
         self.output_file = output_file
         self.persist = persist
+        self.max_batch_tokens = max_batch_tokens
+        self.window_size = window_size
+        self.writer_process = writer_process
+        self.storage_dtype = storage_dtype
+        self.codec = codec
+        self.shard = shard
 
     def run(self):
 
+        if self.shard is None:
+                self._run(self.output_file)
+        else:
+                self._run(sharding.shard_path(self.output_file, *self.shard), self.shard)
+
+    def run_parallel(self, num_workers: int, num_threads=0):
+        """
+        Encode the groups in num_workers processes, each into its own shard, and merge the shards into
+        output_file (see sharding.py).
+        num_threads: torch threads per worker (0 for an even share of the CPUs).
+        """
+
+        sharding.run_workers(lambda i, n: self._run(sharding.shard_path(self.output_file, i, n), (i, n)),
+                             num_workers, num_threads)
+        sharding.merge_shards(self.output_file, num_workers)
+
+    def _run(self, output_file: str, shard=None):
+
         print("Running neural model on equivalent sentences...")
 
         print(type(self.equivalent_sentences_dict.items()))
-        
-        with h5py.File(self.output_file, 'w') as h5:
+
+        stats = EncodingStats()
+        window = []
+
+        with AsyncHDF5Writer(output_file, use_process=self.writer_process, storage_dtype=self.storage_dtype,
+                             codec=self.codec) as writer:
                 for i, group_of_equivalent_sentences in tqdm.tqdm(enumerate(self.equivalent_sentences_dict.values()), ascii = True):
-                        vecs = self.model.run(group_of_equivalent_sentences)
-
-                        L = len(group_of_equivalent_sentences[0])  # group's sentence length
-                        content_indices = np.array([i for i in range(L) if group_of_equivalent_sentences[0][i] not in FUNCTION_WORDS])
-                        sents = np.array(group_of_equivalent_sentences, dtype=object)
-
-                        # data.append(bert_states)
-                        g = h5.create_group(str(i))
-                        g.attrs['group_size'], g.attrs['sent_length'] = sents.shape
-                        g.create_dataset('vecs', data=vecs, compression=True, chunks=True)
-                        dt = h5py.special_dtype(vlen=str)
-                        g.create_dataset('sents', data=sents, dtype=dt, compression=True, chunks=True)
-                        g.create_dataset('content_indices', data=content_indices, compression=True, chunks=True)
+                        if shard is not None and i % shard[1] != shard[0]:
+                                continue
+
+                        window.append((i, group_of_equivalent_sentences))
+
+                        if len(window) == self.window_size:
+                                self._encode_window(writer, window, stats)
+                                window = []
+
+                if window:
+                        self._encode_window(writer, window, stats)
+
+        print(stats.report())
+
+    def _encode_window(self, writer: AsyncHDF5Writer, window: List[Tuple[int, List[List[str]]]], stats: EncodingStats):
+
+        vecs = encode_groups(self.model, [group for _, group in window], self.max_batch_tokens, stats)
+
+        for (i, group_of_equivalent_sentences), group_vecs in zip(window, vecs):
+                writer.write_group(str(i), group_of_equivalent_sentences, group_vecs)
                 
 
 
@@ -66,13 +202,12 @@ class TuplesModelRunner(object):
 
         print("Running neural model on equivalent sentences...")
 
-        N = len(self.equivalent_sentences_dict)
-
         with open(self.output_file, "w") as f:
 
-            for i in tqdm.tqdm(range(N)):
+            # the keys are the indices of the source sentences, with gaps where the quality gate dropped groups
+            for group in tqdm.tqdm(self.equivalent_sentences_dict.values(), total=len(self.equivalent_sentences_dict)):
 
-                equivalent_sentences = self.equivalent_sentences_dict[i][:num_equivalents]
+                equivalent_sentences = group[:num_equivalents]
                 vecs = self.model.run(equivalent_sentences)
 
                 sent_length = len(equivalent_sentences[0])
@@ -0,0 +1,246 @@
+"""
+A packed HDF5 layout for encoded groups of equivalent sentences.
+
+The per-group layout (see hdf5_writer.write_group) stores every group as an HDF5 group with three small datasets,
+so a file of 150k groups holds hundreds of thousands of objects. The packed layout stores the same data in a few
+flat datasets:
+    vecs          - (total_tokens, D), the vectors of all words of all sentences, group after group and
+                    sentence after sentence. Chunked by rows, chunk_bytes bytes per chunk.
+    sents         - (total_tokens,) int32, the ids of the words, in the same order.
+    vocab         - the words (variable-length strings) of the ids in sents.
+    content_mask  - (total_tokens,) bool, whether the word is a content word (see FUNCTION_WORDS).
+    group_offsets - (num_groups + 1,) int64, the rows of group k are group_offsets[k]:group_offsets[k + 1].
+    group_size    - (num_groups,) int32, the number of sentences of each group.
+    sent_length   - (num_groups,) int32, the length of the sentences of each group.
+    names         - the names of the groups in the per-group layout (str(i)).
+
+PackedFile reads a packed file through the interface of h5py.File used by the readers of the per-group layout:
+f[name] is a group with the datasets "vecs", "sents" and "content_indices", and the attributes "group_size"
+and "sent_length". open_file opens a file of either layout. In both, "vecs" is upcast to float32 if it was stored
+in a smaller dtype (see storage.py).
+
+A per-group file may hold several layers of the encoder (see hdf5_writer.write_group). Opened with a layer, "vecs"
+reads the vectors of that layer. A packed file holds a single layer, chosen by convert.
+"""
+
+import argparse
+from typing import List
+
+import h5py
+import numpy as np
+import tqdm
+
+import storage
+
+PACKED_LAYOUT = "packed"
+
+
+class UpcastGroup(object):
+    """
+    A group of the per-group layout, whose "vecs" (of layer, if given) are upcast to float32 when read.
+    """
+
+    def __init__(self, group: h5py.Group, layer=None):
+        self.group = group
+        self.attrs = group.attrs
+        self.layer = layer
+
+    def __getitem__(self, name: str):
+        if name == "vecs":
+            return storage.read_vecs(self.group[storage.vecs_name(self.layer)])
+
+        return self.group[name]
+
+
+class GroupsFile(object):
+    """
+    A file of the per-group layout, whose groups are UpcastGroups.
+    """
+
+    def __init__(self, path: str, layer=None):
+        self.h5 = h5py.File(path, 'r')
+        self.layer = layer
+
+    def __getitem__(self, name: str) -> UpcastGroup:
+        return UpcastGroup(self.h5[name], self.layer)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.h5
+
+    def __len__(self):
+        return len(self.h5)
+
+    def __iter__(self):
+        return iter(self.h5)
+
+    def keys(self):
+        return self.h5.keys()
+
+    def close(self):
+        self.h5.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PackedGroup(object):
+
+    def __init__(self, f: "PackedFile", k: int):
+        self.f = f
+        self.k = k
+        self.attrs = {"group_size": int(f.group_size[k]), "sent_length": int(f.sent_length[k])}
+        self._cache = dict()
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        if name not in self._cache:
+            self._cache[name] = self.f.read(self.k, name)
+
+        return self._cache[name]
+
+
+class PackedFile(object):
+
+    def __init__(self, path: str, layer=None):
+        self.h5 = h5py.File(path, 'r')
+
+        packed_layer = self.h5.attrs.get("layer")
+        if layer is not None and str(layer) != packed_layer:
+            raise ValueError("{} holds the vectors of layer {}, not {}".format(path, packed_layer, layer))
+
+        self.vecs, self.sents, self.content_mask = self.h5["vecs"], self.h5["sents"], self.h5["content_mask"]
+        self.storage_dtype = storage.get_storage_dtype(self.vecs)
+        self.group_offsets = self.h5["group_offsets"][()]
+        self.group_size = self.h5["group_size"][()]
+        self.sent_length = self.h5["sent_length"][()]
+        self.vocab = np.array([w.decode("utf-8") if isinstance(w, bytes) else w for w in self.h5["vocab"][()]],
+                              dtype=object)
+        self.names = [name.decode("utf-8") if isinstance(name, bytes) else name for name in self.h5["names"][()]]
+        self.name2k = {name: k for k, name in enumerate(self.names)}
+
+    def read(self, k: int, name: str) -> np.ndarray:
+        start, end = self.group_offsets[k], self.group_offsets[k + 1]
+        shape = (self.group_size[k], self.sent_length[k])
+
+        if name == "vecs":
+            return storage.from_storage(self.vecs[start:end], self.storage_dtype).reshape(shape + (-1,))
+        elif name == "sents":
+            return self.vocab[self.sents[start:end]].reshape(shape)
+        elif name == "content_indices":
+            return np.where(self.content_mask[start: start + shape[1]])[0]
+
+        raise KeyError(name)
+
+    def __getitem__(self, name: str) -> PackedGroup:
+        return PackedGroup(self, self.name2k[name])
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.name2k
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def keys(self) -> List[str]:
+        return list(self.names)
+
+    def close(self):
+        self.h5.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def is_packed(path: str) -> bool:
+    with h5py.File(path, 'r') as f:
+        return f.attrs.get("layout") == PACKED_LAYOUT
+
+
+def open_file(path: str, layer=None):
+    """
+    Open an encoded equivalent sentences file of either layout, for reading.
+    layer: the layer whose vectors are read as "vecs" (None for the default one).
+    """
+
+    return PackedFile(path, layer) if is_packed(path) else GroupsFile(path, layer)
+
+
+def convert(input_path: str, output_path: str, codec="gzip:4", chunk_bytes=1 << 20, layer=None):
+    """
+    Convert a file of the per-group layout into the packed layout. The vectors keep their storage dtype.
+    layer: the layer whose vectors are packed (None for the default one).
+    """
+
+    vecs_name = storage.vecs_name(layer)
+
+    compression = storage.parse_codec(codec)
+
+    with h5py.File(input_path, 'r') as src, h5py.File(output_path, 'w') as dst:
+        names = sorted(src.keys(), key=lambda name: (not name.isdigit(), int(name) if name.isdigit() else name))
+        group_size = np.array([src[name].attrs["group_size"] for name in names], dtype=np.int32)
+        sent_length = np.array([src[name].attrs["sent_length"] for name in names], dtype=np.int32)
+        group_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+        group_offsets[1:] = np.cumsum(group_size.astype(np.int64) * sent_length)
+
+        first = src[names[0]][vecs_name]
+        dim, dtype = first.shape[-1], first.dtype
+        total_tokens = int(group_offsets[-1])
+        chunk_rows = max(1, min(total_tokens, chunk_bytes // (dim * dtype.itemsize)))
+
+        vecs = dst.create_dataset("vecs", shape=(total_tokens, dim), dtype=dtype, chunks=(chunk_rows, dim),
+                                  **compression)
+        sents = dst.create_dataset("sents", shape=(total_tokens,), dtype=np.int32, **compression)
+        content_mask = dst.create_dataset("content_mask", shape=(total_tokens,), dtype=bool, **compression)
+
+        if storage.get_storage_dtype(first) != "float32":
+            vecs.attrs["storage_dtype"] = storage.get_storage_dtype(first)
+        word2id = dict()
+
+        for k, name in enumerate(tqdm.tqdm(names, ascii=True)):
+            group = src[name]
+            start, end = group_offsets[k], group_offsets[k + 1]
+            group_sents = group["sents"][()]
+
+            vecs[start:end] = group[vecs_name][()].reshape(-1, dim)
+            sents[start:end] = [word2id.setdefault(w.decode("utf-8") if isinstance(w, bytes) else w, len(word2id))
+                                for w in group_sents.reshape(-1)]
+
+            mask = np.zeros(sent_length[k], dtype=bool)
+            mask[group["content_indices"][()].astype(np.int64)] = True
+            content_mask[start:end] = np.tile(mask, group_size[k])
+
+        string_dtype = h5py.special_dtype(vlen=str)
+        dst.create_dataset("vocab", data=np.array(sorted(word2id, key=word2id.get), dtype=object), dtype=string_dtype)
+        dst.create_dataset("names", data=np.array(names, dtype=object), dtype=string_dtype)
+        dst.create_dataset("group_offsets", data=group_offsets)
+        dst.create_dataset("group_size", data=group_size)
+        dst.create_dataset("sent_length", data=sent_length)
+        dst.attrs["layout"] = PACKED_LAYOUT
+        if layer is not None:
+            dst.attrs["layer"] = str(layer)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert encoded equivalent sentences to the packed HDF5 layout',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--input-file', dest='input_file', type=str, required=True,
+                        help='HDF5 file of the per-group layout')
+    parser.add_argument('--output-file', dest='output_file', type=str, required=True,
+                        help='packed HDF5 file to create')
+    parser.add_argument('--chunk-bytes', dest='chunk_bytes', type=int, default=1 << 20,
+                        help='size of a chunk of the vecs dataset')
+    parser.add_argument('--codec', dest='codec', type=str, default='gzip:4',
+                        help='compression of the packed datasets: none / lzf / gzip:N')
+    parser.add_argument('--layer', dest='layer', type=str, default=None,
+                        help='the layer to pack, of a file holding several layers (e.g. 8 / mean / mix). '
+                             'by default, the first one')
+
+    args = parser.parse_args()
+    convert(args.input_file, args.output_file, codec=args.codec, chunk_bytes=args.chunk_bytes, layer=args.layer)
@@ -0,0 +1,202 @@
+"""
+A pipelined mode of main.py, in which the generation of equivalent sentences overlaps with their encoding:
+
+    generator (a thread, and its worker processes) -> groups queue -> encoder (main thread)
+                                                   -> vectors queue -> writer (a thread)
+
+The generator thread pushes each accepted group to a bounded queue. The encoder takes up to batch_size groups at
+a time and encodes their sentences in length-sorted batches (see model_runner.encode_groups). The writer thread
+appends each group to the sentences file (see shards.py), and its vectors to the HDF5 file in the format of
+model_runner.ModelRunner.
+Both queues are bounded, so memory use does not grow with the size of the corpus.
+With several generation workers, their pool is forked before the threads start (see
+EquivalentSentencesGenerator.worker_pool).
+"""
+
+import queue
+import threading
+import time
+from typing import Callable, List, Tuple
+
+import h5py
+
+import shards
+from hdf5_writer import write_group
+from model_runner import EncodingStats, encode_groups
+
+_END = object()  # marks the end of a queue
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+class _Stage(threading.Thread):
+    """
+    A pipeline thread, that records its exception (if any) and signals the other stages to stop.
+    """
+
+    def __init__(self, name: str, target: Callable, failed: threading.Event):
+        super().__init__(name=name, daemon=True)
+        self.target = target
+        self.failed = failed
+        self.error = None
+        self.elapsed = 0.
+
+    def run(self):
+        start = time.time()
+
+        try:
+            self.target()
+        except PipelineAborted:
+            pass
+        except BaseException as e:
+            self.error = e
+            self.failed.set()
+
+        self.elapsed = time.time() - start
+
+
+def _put(q: queue.Queue, item, failed: threading.Event):
+    while not failed.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return
+        except queue.Full:
+            pass
+
+    raise PipelineAborted()
+
+
+def _get(q: queue.Queue, failed: threading.Event):
+    while not failed.is_set():
+        try:
+            return q.get(timeout=0.5)
+        except queue.Empty:
+            pass
+
+    raise PipelineAborted()
+
+
+def _open_hdf5(path: str, resume: bool, num_done: int) -> h5py.File:
+    """
+    Open the HDF5 output. When resuming, keep the first num_done groups (those whose sentences were written too)
+    and remove the rest.
+    """
+
+    if not resume:
+        return h5py.File(path, "w")
+
+    h5 = h5py.File(path, "a")
+
+    for name in list(h5.keys()):
+        if int(name) >= num_done:
+            del h5[name]
+
+    return h5
+
+
+def run_pipeline(generator, model, output_file: str, resume=False, workers=1, seed=None, quality_gate=None,
+                 max_retries=2, batch_size=32, queue_size=256, max_batch_tokens=None, storage_dtype="float32",
+                 codec="gzip:4") -> int:
+    """
+    Generate equivalent sentences with generator (writing them to generator.output_file), and encode them with
+    model into the HDF5 file output_file. See EquivalentSentencesGenerator.generate for the generation arguments.
+    batch_size: number of groups encoded together.
+    max_batch_tokens: the token budget of a model call (see model_runner.encode_groups).
+    queue_size: the maximal number of groups waiting in each queue.
+    storage_dtype, codec: the storage of the vectors (see storage.py).
+    return: the number of groups written.
+    """
+
+    groups_queue, vectors_queue = queue.Queue(queue_size), queue.Queue(queue_size)
+    failed = threading.Event()
+    sentences_writer = shards.ShardWriter(generator.output_file, resume=resume)
+    h5 = _open_hdf5(output_file, resume, len(sentences_writer.done))
+    num_written = len(sentences_writer.done)
+
+    if quality_gate is not None:
+        quality_gate.open(generator.output_file, resume=resume, num_done=num_written)
+
+    pool = generator.worker_pool(workers, seed) if workers > 1 else None  # forked before the threads start
+
+    def produce():
+        indices = generator.pending_indices(sentences_writer.done, resume=resume, quality_gate=quality_gate)
+
+        for item in generator.iter_groups(indices, workers=workers, seed=seed, quality_gate=quality_gate,
+                                          max_retries=max_retries, pool=pool):
+            _put(groups_queue, item, failed)
+
+        _put(groups_queue, _END, failed)
+
+    def write():
+        nonlocal num_written
+
+        while True:
+            item = _get(vectors_queue, failed)
+            if item is _END:
+                return
+
+            i, group, vecs = item
+            write_group(h5, str(num_written), group, vecs, storage_dtype=storage_dtype, codec=codec)
+            h5.flush()
+            sentences_writer.write(i, group)  # after the vectors, so that resume never skips a missing group
+            num_written += 1
+
+            if quality_gate is not None:
+                quality_gate.commit(i)
+
+    producer = _Stage("generator", produce, failed)
+    writer = _Stage("writer", write, failed)
+    producer.start()
+    writer.start()
+
+    stats = EncodingStats()
+    start = time.time()
+
+    try:
+        finished = False
+
+        while not finished:
+            batch: List[Tuple[int, List[List[str]]]] = []
+
+            while len(batch) < batch_size:
+                item = _get(groups_queue, failed)
+                if item is _END:
+                    finished = True
+                    break
+
+                batch.append(item)
+
+            if batch:
+                vecs = encode_groups(model, [group for _, group in batch], max_batch_tokens, stats)
+
+                for (i, group), group_vecs in zip(batch, vecs):
+                    _put(vectors_queue, (i, group, group_vecs), failed)
+
+        _put(vectors_queue, _END, failed)
+
+    except PipelineAborted:
+        pass
+    except BaseException:
+        failed.set()
+        raise
+
+    finally:
+        producer.join()
+        writer.join()
+        if pool is not None:
+            pool.terminate()
+        h5.close()
+        sentences_writer.close()
+        generator.save_quality_stats(quality_gate)  # of the groups written so far, if a stage failed
+
+    for stage in [producer, writer]:
+        if stage.error is not None:
+            raise RuntimeError("the {} stage of the pipeline failed".format(stage.name)) from stage.error
+
+    print("Pipeline: {} groups in {:.1f}s (generation {:.1f}s, encoding {:.1f}s).".format(
+        num_written, time.time() - start, producer.elapsed, stats.time))
+    print(stats.report())
+
+    return num_written
@@ -0,0 +1,104 @@
+"""
+A one-time, batched POS tagging pass over an input (wiki) file, cached next to the file.
+
+The tags of all sentences are stored as a single flat array of tag ids, with the offset of each sentence,
+in <data file>.tags.<hash of the data file>.npz. The cache is rebuilt whenever the data file changes.
+"""
+
+import os.path
+from typing import List
+
+import numpy as np
+import spacy
+import tqdm
+
+import utils
+
+
+class WhitespaceTokenizer(object):
+    """
+    A spaCy tokenizer for pre-tokenized text, that keeps the tokens of the input file as they are.
+    """
+
+    def __init__(self, vocab):
+        self.vocab = vocab
+
+    def __call__(self, text):
+        return spacy.tokens.Doc(self.vocab, words=text.split(" "))
+
+
+def cache_path(data_filename: str) -> str:
+    return "{}.tags.{}.npz".format(data_filename, utils.file_hash(data_filename))
+
+
+class POSCache(object):
+
+    def __init__(self, tag_ids: np.ndarray, offsets: np.ndarray, tag_names: List[str]):
+        """
+        tag_ids: the tag ids of all the tokens of the corpus, concatenated.
+        offsets: an array of size num_sentences + 1; the tags of sentence i are tag_ids[offsets[i]:offsets[i + 1]].
+        tag_names: maps tag ids to tags (strings).
+        """
+
+        self.tag_ids = tag_ids
+        self.offsets = offsets
+        self.tag_names = list(tag_names)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_ids(self, i: int) -> np.ndarray:
+        return self.tag_ids[self.offsets[i]: self.offsets[i + 1]]
+
+    def __getitem__(self, i: int) -> List[str]:
+        return [self.tag_names[t] for t in self.get_ids(i)]
+
+    def save(self, path: str):
+        np.savez(path, tag_ids=self.tag_ids, offsets=self.offsets, tag_names=np.array(self.tag_names))
+
+    @staticmethod
+    def load(path: str) -> "POSCache":
+        data = np.load(path)
+        return POSCache(data["tag_ids"], data["offsets"], data["tag_names"].tolist())
+
+
+def tag_sentences(sentences: List[List[str]], batch_size=1000, n_process=1) -> POSCache:
+    """
+    POS-tag all sentences with nlp.pipe.
+    """
+
+    nlp = spacy.load('en_core_web_sm', disable=["parser", "ner"])
+    nlp.tokenizer = WhitespaceTokenizer(nlp.vocab)
+
+    tag2id = dict()
+    tag_ids = np.zeros(sum(len(sentence) for sentence in sentences), dtype=np.uint8)
+    offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+    texts = (" ".join(sentence) for sentence in sentences)
+
+    for i, doc in tqdm.tqdm(enumerate(nlp.pipe(texts, batch_size=batch_size, n_process=n_process)),
+                            total=len(sentences)):
+
+        ids = [tag2id.setdefault(token.tag_, len(tag2id)) for token in doc]
+        offsets[i + 1] = offsets[i] + len(ids)
+        tag_ids[offsets[i]: offsets[i + 1]] = ids
+
+    tag_names = sorted(tag2id, key=tag2id.get)
+
+    return POSCache(tag_ids, offsets, tag_names)
+
+
+def get_pos_cache(data_filename: str, sentences: List[List[str]], batch_size=1000, n_process=1) -> POSCache:
+    """
+    Load the POS tags of the sentences of data_filename from the cache, or tag them and create the cache.
+    """
+
+    path = cache_path(data_filename)
+
+    if os.path.isfile(path):
+        return POSCache.load(path)
+
+    print("POS-tagging {}...".format(data_filename))
+    cache = tag_sentences(sentences, batch_size=batch_size, n_process=n_process)
+    cache.save(path)
+
+    return cache
@@ -0,0 +1,160 @@
+"""
+An inline quality gate for groups of equivalent sentences, applied by EquivalentSentencesGenerator.generate
+before a group is written (and later encoded).
+
+The statistics of a run are kept next to its output file (see open): the indices of the dropped groups are appended
+to <output file>.quality.dropped as they are dropped, so that a resumed run never generates them again, and the
+counters are saved to <output file>.quality.json every save_every written groups and at the end. An accepted group
+is counted once it is written (see commit).
+"""
+
+import json
+import os.path
+import threading
+from collections import Counter
+from typing import List
+
+
+class QualityGate(object):
+
+    def __init__(self, reject_identical=True, reject_duplicates=True, min_score=None, max_score=None,
+                 w2v_file=None, save_every=1000):
+        """
+        reject_identical: reject groups in which no word of the source sentence was replaced.
+        reject_duplicates: reject groups that contain the same sentence more than once.
+        min_score, max_score: if given, reject groups whose similarity score (the mean cosine distance between
+                              the bag-of-words vectors of their sentences, see filter_sentences.py) is outside
+                              this range. Requires w2v_file.
+        save_every: save the counters every this number of written groups.
+        """
+
+        self.reject_identical = reject_identical
+        self.reject_duplicates = reject_duplicates
+        self.min_score = min_score
+        self.max_score = max_score
+
+        if min_score is not None or max_score is not None:
+            import filter_sentences
+            self.embds, self.vocab = filter_sentences.load_embeddings(w2v_file)
+
+        self.save_every = save_every
+        self.stats = {"accepted": 0, "regenerated": 0, "dropped": 0, "rejections": Counter(), "dropped_indices": []}
+        self.output_file, self._dropped_file = None, None
+        self._pending = dict()  # the rejections of the accepted groups that are not written yet, by index
+        self._num_committed = 0
+        self._lock = threading.Lock()  # the groups are recorded and committed by different threads in pipeline.py
+
+    def similarity_score(self, group: List[List[str]]) -> float:
+        import filter_sentences
+
+        ids, group_sizes, embedding_matrix = filter_sentences.encode_groups([group], self.embds, self.vocab)
+        return filter_sentences.score_groups(ids, group_sizes, embedding_matrix)[0]
+
+    def check(self, group: List[List[str]]) -> str:
+        """
+        return: the reason for rejecting the group, or None if it is accepted.
+        """
+
+        sentences = [tuple(sentence) for sentence in group]
+
+        if self.reject_identical and all(sentence == sentences[0] for sentence in sentences):
+            return "identical_to_source"
+
+        if self.reject_duplicates and len(set(sentences)) < len(sentences):
+            return "duplicate_sentences"
+
+        if self.min_score is not None or self.max_score is not None:
+            score = self.similarity_score(group)
+
+            if (self.min_score is not None and score < self.min_score) or (
+                    self.max_score is not None and score > self.max_score):
+                return "similarity_score"
+
+        return None
+
+    def record(self, i: int, rejections: List[str], accepted: bool):
+        """
+        Record the decision on the group of sentence i. A dropped group is saved at once, an accepted one is
+        counted when it is committed.
+        """
+
+        if accepted:
+            self._pending[i] = rejections
+            return
+
+        with self._lock:
+            self.stats["rejections"].update(rejections)
+            self.stats["dropped"] += 1
+            self.stats["dropped_indices"].append(i)
+
+            if self._dropped_file is not None:
+                self._dropped_file.write("{}\n".format(i))
+                self._dropped_file.flush()
+
+    def commit(self, i: int):
+        """
+        Count the accepted group of sentence i, once it is written.
+        """
+
+        rejections = self._pending.pop(i)
+
+        with self._lock:
+            self.stats["rejections"].update(rejections)
+            self.stats["accepted"] += 1
+            self.stats["regenerated"] += len(rejections) > 0
+            self._num_committed += 1
+
+            if self.output_file is not None and self._num_committed % self.save_every == 0:
+                self.save_stats()
+
+    @staticmethod
+    def stats_path(output_file: str) -> str:
+        return output_file + ".quality.json"
+
+    @staticmethod
+    def dropped_path(output_file: str) -> str:
+        return output_file + ".quality.dropped"
+
+    def open(self, output_file: str, resume=False, num_done=0):
+        """
+        Keep the statistics next to output_file.
+        resume: continue the statistics of a previous (interrupted) run, that wrote num_done groups. The dropped
+                groups are all known; the counters of the last groups before an interruption may be missing,
+                except for the number of accepted groups, which is num_done.
+        """
+
+        self.output_file = output_file
+        stats_path, dropped_path = self.stats_path(output_file), self.dropped_path(output_file)
+
+        if resume:
+            if os.path.isfile(stats_path):
+                with open(stats_path, "r") as f:
+                    self.stats.update(json.load(f))
+
+                self.stats["rejections"] = Counter(self.stats["rejections"])
+
+            if os.path.isfile(dropped_path):
+                with open(dropped_path, "r") as f:
+                    self.stats["dropped_indices"] = [int(line) for line in f if line.strip()]
+
+            self.stats["accepted"] = num_done
+            self.stats["dropped"] = len(self.stats["dropped_indices"])
+
+        self._dropped_file = open(dropped_path, "a" if resume else "w")
+
+    def save_stats(self):
+        path = self.stats_path(self.output_file)
+        stats = {name: value for name, value in self.stats.items() if name != "dropped_indices"}  # see open
+
+        with open(path + ".tmp", "w") as f:  # an interrupted save keeps the previous statistics
+            json.dump(stats, f, indent=2)
+
+        os.replace(path + ".tmp", path)
+
+    def close(self):
+        if self.output_file is not None:
+            self.save_stats()
+
+        if self._dropped_file is not None:
+            self._dropped_file.close()
+            self._dropped_file = None
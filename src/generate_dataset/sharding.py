@@ -0,0 +1,103 @@
+"""
+Data-parallel encoding of groups of equivalent sentences.
+
+Shard i of n holds the groups whose index is i modulo n, under their usual names (str(index)), in the HDF5 file
+<output>.shard-<i>-of-<n>. Workers (see run_workers) encode the shards in parallel, each in its own process with
+its own share of the CPU threads, or separate jobs encode one shard each (--shard i/n).
+
+merge_shards then writes <output> itself: a small HDF5 file with an external link to every group in the shards,
+so readers of the per-group layout (h5py, packed_hdf5.open_file) read it as a single file. The shards must stay in
+the directory of the merged file. To get a single self-contained file, convert the merged file to the packed
+layout (see packed_hdf5.py).
+"""
+
+import argparse
+import multiprocessing
+import os
+from typing import Callable, Sequence, Tuple
+
+import h5py
+import torch
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """
+    shard: "i/n" (0 <= i < n).
+    """
+
+    i, n = (int(x) for x in shard.split("/"))
+    if not 0 <= i < n:
+        raise ValueError("bad shard {}: expected i/n with 0 <= i < n".format(shard))
+
+    return i, n
+
+
+def shard_path(output_file: str, i: int, n: int) -> str:
+    return "{}.shard-{}-of-{}".format(output_file, i, n)
+
+
+def shard_indices(num_groups: int, i: int, n: int) -> Sequence[int]:
+    return range(i, num_groups, n)
+
+
+def merge_shards(output_file: str, n: int):
+    """
+    Write output_file, linking to the groups of the n shards of output_file.
+    """
+
+    names = dict()
+
+    for i in range(n):
+        path = shard_path(output_file, i, n)
+
+        with h5py.File(path, 'r') as shard:
+            for name in shard.keys():
+                names[name] = os.path.basename(path)  # the shards are found next to the merged file
+
+    with h5py.File(output_file, 'w') as f:
+        for name in sorted(names, key=int):
+            f[name] = h5py.ExternalLink(names[name], name)
+
+
+def _run_worker(run_shard: Callable[[int, int], None], i: int, n: int, num_threads: int):
+    torch.set_num_threads(num_threads)
+    run_shard(i, n)
+
+
+def run_workers(run_shard: Callable[[int, int], None], num_workers: int, num_threads=0):
+    """
+    Run run_shard(i, num_workers) for every shard i, each in a forked process (so that the model, loaded before,
+    is shared copy-on-write). The model must be on the CPU, as CUDA can not be used in forked processes.
+    num_threads: torch threads per worker (0 for an even share of the CPUs).
+    """
+
+    if torch.cuda.is_initialized():
+        raise RuntimeError("the workers are forked, so they can not use CUDA, which is already initialized. "
+                           "run them on the CPU (--cuda-device -1), or run each shard as a separate job (--shard)")
+
+    num_threads = num_threads or max(1, os.cpu_count() // num_workers)
+    ctx = multiprocessing.get_context("fork")
+    workers = [ctx.Process(target=_run_worker, args=(run_shard, i, num_workers, num_threads))
+               for i in range(num_workers)]
+
+    for worker in workers:
+        worker.start()
+
+    for worker in workers:
+        worker.join()
+
+    failed = [i for i, worker in enumerate(workers) if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError("the workers of shards {} failed".format(failed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge the HDF5 shards written with --shard i/n',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--output-file', dest='output_file', type=str, required=True,
+                        help='the output file the shards were written for')
+    parser.add_argument('--num-shards', dest='num_shards', type=int, required=True,
+                        help='the number of shards (n)')
+
+    args = parser.parse_args()
+    merge_shards(args.output_file, args.num_shards)
@@ -0,0 +1,151 @@
+"""
+An append-only, resumable storage format for groups of equivalent sentences.
+
+The data file is a sequence of length-prefixed records, one per group: an 8-byte little-endian length,
+followed by the pickled (sentence index, group) pair. A sidecar index file (<data file>.index) holds one
+(sentence index, byte offset) pair of 8-byte little-endian integers per record. A record is appended to the
+index only after it was fully written to the data file, so after a crash, everything up to the last indexed
+record is valid and the rest is discarded.
+"""
+
+import os
+import pickle
+import struct
+from typing import Dict, List, Tuple
+
+import groups_store
+
+RECORD_HEADER = struct.Struct("<Q")
+INDEX_ENTRY = struct.Struct("<QQ")
+
+
+def index_path(path: str) -> str:
+    return path + ".index"
+
+
+def is_shard_file(path: str) -> bool:
+    return os.path.isfile(index_path(path))
+
+
+def read_index(path: str) -> List[Tuple[int, int]]:
+    """
+    return: a list of (sentence index, byte offset) pairs, in the order the records were written.
+    """
+
+    with open(index_path(path), "rb") as f:
+        data = f.read()
+
+    num_entries = len(data) // INDEX_ENTRY.size  # ignore a partially-written last entry
+    return [INDEX_ENTRY.unpack_from(data, k * INDEX_ENTRY.size) for k in range(num_entries)]
+
+
+def _read_record(f, offset: int) -> Tuple[int, List[List[str]]]:
+    f.seek(offset)
+    length, = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+    return pickle.loads(f.read(length))
+
+
+def _record_end(f, offset: int, data_size: int):
+    """
+    return: the byte offset right after the record starting at offset, or None if the record is incomplete.
+    """
+
+    if offset + RECORD_HEADER.size > data_size:
+        return None
+
+    f.seek(offset)
+    length, = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+    end = offset + RECORD_HEADER.size + length
+
+    return end if end <= data_size else None
+
+
+class ShardWriter(object):
+
+    def __init__(self, path: str, resume=False):
+        """
+        path: the data file to write.
+        resume: if True and the file exists, keep the groups already written and append new ones.
+                Otherwise, start a new file.
+        """
+
+        self.path = path
+        self.done = set()
+
+        if resume and is_shard_file(path) and os.path.isfile(path):
+            entries = read_index(path)
+            data_size = os.path.getsize(path)
+            end = 0
+
+            with open(path, "rb") as f:
+                while entries:
+                    end = _record_end(f, entries[-1][1], data_size)
+                    if end is not None:
+                        break
+                    entries.pop()  # the data of the last indexed record did not make it to disk
+
+            end = end or 0
+            self.done = set(i for i, _ in entries)
+
+            # drop a record (or index entry) that was written only partially.
+
+            with open(path, "r+b") as f:
+                f.truncate(end)
+            with open(index_path(path), "r+b") as f:
+                f.truncate(len(entries) * INDEX_ENTRY.size)
+
+            self.data_file = open(path, "ab")
+            self.index_file = open(index_path(path), "ab")
+
+        else:
+            self.data_file = open(path, "wb")
+            self.index_file = open(index_path(path), "wb")
+
+    def write(self, i: int, group: List[List[str]]):
+
+        record = pickle.dumps((i, [list(sentence) for sentence in group]), protocol=pickle.HIGHEST_PROTOCOL)
+        offset = self.data_file.tell()
+
+        self.data_file.write(RECORD_HEADER.pack(len(record)))
+        self.data_file.write(record)
+        self.data_file.flush()
+
+        self.index_file.write(INDEX_ENTRY.pack(i, offset))
+        self.index_file.flush()
+
+        self.done.add(i)
+
+    def close(self):
+        self.data_file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load_equivalent_sentences(path: str) -> Dict[int, List[List[str]]]:
+    """
+    Load groups of equivalent sentences, from a shard file, a group store (see groups_store.py) or a (legacy)
+    pickled dictionary.
+    return: a dictionary mapping sentence indices to groups of equivalent sentences, sorted by index
+            (for a group store, a read-only mapping that decodes the groups lazily, in storage order).
+    """
+
+    if groups_store.is_group_store(path):
+        return groups_store.GroupStore(path)
+
+    if not is_shard_file(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    sents_dict = dict()
+
+    with open(path, "rb") as f:
+        for _, offset in sorted(read_index(path)):
+            i, group = _read_record(f, offset)
+            sents_dict[i] = group
+
+    return sents_dict
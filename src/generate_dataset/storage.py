@@ -0,0 +1,94 @@
+"""
+Storage dtypes and compression codecs of encoded vectors in HDF5 files.
+
+A vecs dataset stored in a dtype other than float32 has a "storage_dtype" attribute; read_vecs upcasts it back to
+float32. bfloat16 (the upper 16 bits of a float32, rounded to nearest even) is stored as uint16, as HDF5 has no
+bfloat16 type.
+
+A group may hold the vectors of several layers of the encoder, in the datasets "vecs_<layer>" (see vecs_name),
+with "vecs" linking to the first of them.
+"""
+
+from typing import Dict
+
+import h5py
+import numpy as np
+
+STORAGE_DTYPES = ["float32", "float16", "bfloat16-as-uint16"]
+
+
+def to_storage(vecs: np.ndarray, storage_dtype="float32") -> np.ndarray:
+    vecs = np.asarray(vecs, dtype=np.float32)
+
+    if storage_dtype == "float32":
+        return vecs
+    elif storage_dtype == "float16":
+        return vecs.astype(np.float16)
+    elif storage_dtype == "bfloat16-as-uint16":
+        bits = vecs.view(np.uint32)
+        rounding = ((bits >> 16) & 1) + np.uint32(0x7FFF)
+        return ((bits + rounding) >> 16).astype(np.uint16)
+
+    raise ValueError("unknown storage dtype {}".format(storage_dtype))
+
+
+def from_storage(data: np.ndarray, storage_dtype="float32") -> np.ndarray:
+    if storage_dtype == "bfloat16-as-uint16":
+        return (data.astype(np.uint32) << 16).view(np.float32)
+    elif data.dtype == np.float16:
+        return data.astype(np.float32)
+
+    return data
+
+
+def parse_codec(codec: str) -> Dict:
+    """
+    codec: "none", "lzf", "gzip" or "gzip:N" (N is the compression level, 0-9).
+    return: the compression arguments of h5py's create_dataset.
+    """
+
+    if codec == "none":
+        return dict()
+    elif codec == "lzf":
+        return dict(compression="lzf")
+    elif codec.startswith("gzip"):
+        level = int(codec.split(":")[1]) if ":" in codec else 4
+        return dict(compression="gzip", compression_opts=level)
+
+    raise ValueError("unknown codec {}".format(codec))
+
+
+def vecs_name(layer=None) -> str:
+    """
+    return: the name of the dataset of the vectors of layer ("vecs" for the default layer, None).
+    """
+
+    return "vecs" if layer is None else "vecs_{}".format(layer)
+
+
+def create_vecs(g: h5py.Group, name: str, vecs, storage_dtype="float32", codec="gzip:4") -> h5py.Dataset:
+    """
+    Create a dataset of vectors of shape (..., sentence length, D), chunked by sentences.
+    """
+
+    data = to_storage(vecs, storage_dtype)
+    chunks = (1,) * (data.ndim - 2) + data.shape[-2:] if data.ndim > 2 and data.size else None
+
+    dataset = g.create_dataset(name, data=data, chunks=chunks, **parse_codec(codec))
+    if storage_dtype != "float32":
+        dataset.attrs["storage_dtype"] = storage_dtype
+
+    return dataset
+
+
+def get_storage_dtype(dataset: h5py.Dataset) -> str:
+    storage_dtype = dataset.attrs.get("storage_dtype", "float32")
+    return storage_dtype.decode("utf-8") if isinstance(storage_dtype, bytes) else storage_dtype
+
+
+def read_vecs(dataset: h5py.Dataset, selection=()) -> np.ndarray:
+    """
+    return: dataset[selection], upcast to float32.
+    """
+
+    return from_storage(dataset[selection], get_storage_dtype(dataset))
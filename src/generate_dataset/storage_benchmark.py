@@ -0,0 +1,147 @@
+"""
+Benchmark the storage dtypes and codecs of storage.py: file size, write MB/s and read MB/s of every
+(storage dtype, codec) combination, and the drift of the CCA correlations (as computed by
+linear_decomposition/views_collector.py + numpy_cca.py) caused by storing the vectors in a smaller dtype.
+MB/s are of the float32 vectors, so that the combinations are comparable.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from typing import List, Tuple
+
+import h5py
+import numpy as np
+
+import storage
+from hdf5_writer import write_group
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "linear_decomposition"))
+from numpy_cca import CCAModel
+
+
+def load_groups(path: str, num_groups: int) -> List[Tuple[List[List[str]], np.ndarray]]:
+    with h5py.File(path, 'r') as f:
+        names = sorted(f.keys(), key=int)[:num_groups]
+        return [([[w.decode("utf-8") if isinstance(w, bytes) else w for w in sent] for sent in f[name]["sents"][()]],
+                 storage.read_vecs(f[name]["vecs"])) for name in names]
+
+
+def random_groups(num_groups: int, group_size: int, dim: int, seed=0) -> List[Tuple[List[List[str]], np.ndarray]]:
+    """
+    Random groups whose sentences share a component per position, so that the CCA of their views is meaningful.
+    """
+
+    rng = np.random.RandomState(seed)
+    groups = []
+
+    for _ in range(num_groups):
+        L = rng.randint(5, 30)
+        shared = rng.randn(1, L, dim).astype(np.float32)
+        vecs = shared + 0.5 * rng.randn(group_size, L, dim).astype(np.float32)
+        groups.append(([["w{}".format(i) for i in range(L)]] * group_size, vecs))
+
+    return groups
+
+
+def benchmark(groups, storage_dtype: str, codec: str) -> Tuple[int, float, float]:
+    """
+    return: file size (bytes), write MB/s, read MB/s.
+    """
+
+    megabytes = sum(vecs.size for _, vecs in groups) * 4 / 2 ** 20
+    fd, path = tempfile.mkstemp(suffix=".hdf5")
+    os.close(fd)
+
+    try:
+        start = time.time()
+        with h5py.File(path, 'w') as f:
+            for i, (group, vecs) in enumerate(groups):
+                write_group(f, str(i), group, vecs, storage_dtype=storage_dtype, codec=codec)
+        write_time = time.time() - start
+
+        start = time.time()
+        with h5py.File(path, 'r') as f:
+            for i in range(len(groups)):
+                storage.read_vecs(f[str(i)]["vecs"])
+        read_time = time.time() - start
+
+        return os.path.getsize(path), megabytes / write_time, megabytes / read_time
+
+    finally:
+        os.remove(path)
+
+
+def collect_views(groups, seed=0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pair the vector of every word of the first sentence of a group with the vector of the same word in a random
+    other sentence of the group, as in views_collector.py.
+    """
+
+    rng = np.random.RandomState(seed)
+    view1, view2 = [], []
+
+    for _, vecs in groups:
+        j = rng.randint(1, len(vecs))
+        view1.append(vecs[0])
+        view2.append(vecs[j])
+
+    return np.concatenate(view1).astype(np.float64), np.concatenate(view2).astype(np.float64)
+
+
+def cca_drift(groups, storage_dtype: str, dim: int) -> Tuple[float, float]:
+    """
+    return: the mean and the max absolute difference between the top dim CCA correlations of the float32 vectors
+            and those of the vectors stored in storage_dtype.
+    """
+
+    view1, view2 = collect_views(groups)
+    stored1, stored2 = [storage.from_storage(storage.to_storage(view, storage_dtype), storage_dtype)
+                        .astype(np.float64) for view in (view1, view2)]
+
+    reference, stored = CCAModel(dim), CCAModel(dim)
+    reference(view1, view2, noise=False)
+    stored(stored1, stored2, noise=False)
+
+    diff = np.abs(reference.D[-dim:] - stored.D[-dim:])
+    return float(np.mean(diff)), float(np.max(diff))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Storage dtype and codec benchmark',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--input-file', dest='input_file', type=str, default='',
+                        help='HDF5 file of encoded groups to sample from (random vectors if not given)')
+    parser.add_argument('--num-groups', dest='num_groups', type=int, default=200,
+                        help='number of groups to write and read')
+    parser.add_argument('--group-size', dest='group_size', type=int, default=8,
+                        help='sentences per random group')
+    parser.add_argument('--dim', dest='dim', type=int, default=1024,
+                        help='dimension of the random vectors')
+    parser.add_argument('--cca-dim', dest='cca_dim', type=int, default=50,
+                        help='number of top CCA correlations to compare')
+    parser.add_argument('--codecs', dest='codecs', type=str, default='none,lzf,gzip:1,gzip:4',
+                        help='comma-separated list of codecs to benchmark')
+
+    args = parser.parse_args()
+
+    if args.input_file:
+        groups = load_groups(args.input_file, args.num_groups)
+    else:
+        groups = random_groups(args.num_groups, args.group_size, args.dim)
+
+    print("{:<22}{:>10}{:>14}{:>12}{:>12}".format("dtype", "codec", "size (MB)", "write MB/s", "read MB/s"))
+
+    for storage_dtype in storage.STORAGE_DTYPES:
+        for codec in args.codecs.split(","):
+            size, write_speed, read_speed = benchmark(groups, storage_dtype, codec)
+            print("{:<22}{:>10}{:>14.2f}{:>12.1f}{:>12.1f}".format(storage_dtype, codec, size / 2 ** 20,
+                                                                    write_speed, read_speed))
+
+    print("\nCCA correlation drift (top {} correlations, vs. float32):".format(args.cca_dim))
+
+    for storage_dtype in storage.STORAGE_DTYPES[1:]:
+        mean_drift, max_drift = cca_drift(groups, storage_dtype, args.cca_dim)
+        print("{:<22}mean {:.2e}    max {:.2e}".format(storage_dtype, mean_drift, max_drift))
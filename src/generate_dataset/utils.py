@@ -1,3 +1,8 @@
+import hashlib
+
+import corpus
+from typing import List
+
 DEFAULT_PARAMS = {"file_name": "resources/wikipedia.sample.tokenized",
                   "pos2words_filename": "resources/pos2words.pickle",
                   "sentences_dict_filename": "resources/same_pos/sents.pickle",
@@ -19,15 +24,46 @@ DEFAULT_PARAMS = {"file_name": "resources/wikipedia.sample.tokenized",
 
 
 def read_sentences(fname):
-    with open(fname, "r", encoding = "utf-8") as f:
-        lines = f.readlines()
+    """
+    return: a lazy, indexable sequence of the sentences of fname (see corpus.py).
+    """
+
+    return corpus.Corpus(fname)
+
+
+def pack_batches(lengths: List[int], max_batch_tokens: int) -> List[List[int]]:
+    """
+    Sort sentences by length, and pack them into batches whose padded size (batch size * longest sentence) is
+    at most max_batch_tokens (a longer sentence gets a batch of its own).
+    return: batches of indices into lengths.
+    """
+
+    batches, batch = [], []
 
-    splitted = [line.strip().split(" ") for line in lines]
+    for k in sorted(range(len(lengths)), key=lambda k: lengths[k]):
+        if batch and (len(batch) + 1) * lengths[k] > max_batch_tokens:
+            batches.append(batch)
+            batch = []
 
-    return splitted
+        batch.append(k)
+
+    if batch:
+        batches.append(batch)
+
+    return batches
 
 
 def to_string(np_array):
     shape = np_array.shape
 
     return " ".join(["%0.4f" % x for x in np_array])
+
+
+def file_hash(path: str, block_size=1 << 20) -> str:
+    sha1 = hashlib.sha1()
+
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha1.update(block)
+
+    return sha1.hexdigest()[:16]
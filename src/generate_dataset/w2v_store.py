@@ -0,0 +1,132 @@
+"""
+A vocabulary-pruned word2vec store.
+
+The full GoogleNews binary is converted once into <output>.npy, a float32 matrix holding the vectors of the
+corpus vocabulary (in word2vec order) followed by one OOV fallback vector, and <output>.vocab.txt, the
+corresponding words (one per line, without the OOV row). The matrix is opened with mmap_mode='r'.
+
+W2VStore implements the parts of gensim's KeyedVectors used in this package (vocab, index2word, vectors,
+__getitem__, __contains__ and most_similar), so the two can be used interchangeably. Unknown words are
+mapped to the OOV vector.
+"""
+
+import argparse
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+import corpus
+
+
+def vocab_path(path: str) -> str:
+    return path[:-len(".npy")] + ".vocab.txt"
+
+
+class W2VStore(object):
+
+    def __init__(self, path: str):
+        self.matrix = np.load(path, mmap_mode="r")
+        self.vectors = self.matrix[:-1]
+        self.oov_vector = self.matrix[-1]
+
+        with open(vocab_path(path), "r", encoding="utf-8") as f:
+            self.index2word = [line.rstrip("\n") for line in f]
+
+        self.vocab = {w: i for i, w in enumerate(self.index2word)}
+        self._normalized = None
+
+    @property
+    def wv(self):
+        return self
+
+    def __contains__(self, w: str) -> bool:
+        return w in self.vocab
+
+    def __getitem__(self, w: str) -> np.ndarray:
+        i = self.vocab.get(w)
+        return self.vectors[i] if i is not None else self.oov_vector
+
+    def most_similar(self, positive: List[str], topn=10) -> List[Tuple[str, float]]:
+        """
+        Like KeyedVectors.most_similar, but the neighbours are searched among the (pruned) vocabulary only.
+        """
+
+        if self._normalized is None:
+            vecs = np.asarray(self.vectors, dtype=np.float32)
+            self._normalized = vecs / np.maximum(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-8)
+
+        query = np.mean([self._normalized[self.vocab[w]] for w in positive], axis=0)
+        sims = self._normalized @ query
+        sims[[self.vocab[w] for w in positive]] = -np.inf
+        top = np.argsort(-sims)[:topn]
+
+        return [(self.index2word[i], float(sims[i])) for i in top]
+
+
+def load(w2v_file: str):
+    """
+    Load word embeddings, either from a pruned store (.npy) or from a word2vec binary file.
+    """
+
+    if w2v_file.endswith(".npy"):
+        return W2VStore(w2v_file)
+
+    import gensim
+    return gensim.models.KeyedVectors.load_word2vec_format(w2v_file, binary=True)
+
+
+def convert(embeddings, words: Iterable[str], output_file: str, oov_word="##"):
+    """
+    embeddings: gensim KeyedVectors.
+    words: the words to keep (words without a vector are skipped).
+    oov_word: the word whose vector is used as the OOV fallback (a zero vector if it has no vector).
+    """
+
+    words = set(words) | {oov_word}
+    kept = [w for w in embeddings.index2word if w in words]
+    oov_vector = embeddings[oov_word] if oov_word in embeddings.vocab else np.zeros(embeddings.vector_size)
+
+    matrix = np.lib.format.open_memmap(output_file, mode="w+", dtype=np.float32,
+                                       shape=(len(kept) + 1, embeddings.vector_size))
+
+    for i, w in enumerate(kept):
+        matrix[i] = embeddings[w]
+
+    matrix[len(kept)] = oov_vector
+    matrix.flush()
+
+    with open(vocab_path(output_file), "w", encoding="utf-8") as f:
+        for w in kept:
+            f.write(w + "\n")
+
+    print("Kept {} of {} words.".format(len(kept), len(embeddings.index2word)))
+
+
+if __name__ == '__main__':
+    import shards
+
+    parser = argparse.ArgumentParser(description='Prune a word2vec file to the vocabulary of the corpus',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--input-wiki', dest='input_wiki', type=str,
+                        default='../../data/external/wiki.clean.250k',
+                        help='name of the source wikipedia text file')
+    parser.add_argument('--sentences-file', dest='sentences_file', type=str, default='',
+                        help='optional equivalent sentences file, whose words are kept as well')
+    parser.add_argument('--w2v-file', dest='w2v_file', type=str,
+                        default='../../data/external/GoogleNews-vectors-negative300.bin',
+                        help='word2vec binary file')
+    parser.add_argument('--output-file', dest='output_file', type=str,
+                        default='../../data/external/GoogleNews-vectors-negative300.pruned.npy',
+                        help='output .npy file (the vocabulary is written next to it)')
+    parser.add_argument('--oov-word', dest='oov_word', type=str, default='##',
+                        help='word whose vector is used for unknown words')
+
+    args = parser.parse_args()
+
+    words = set(w for sentence in corpus.Corpus(args.input_wiki) for w in sentence)
+
+    if args.sentences_file:
+        for group in shards.load_equivalent_sentences(args.sentences_file).values():
+            words.update(w for sentence in group for w in sentence)
+
+    convert(load(args.w2v_file), words, args.output_file, oov_word=args.oov_word)
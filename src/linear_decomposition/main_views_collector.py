@@ -20,10 +20,13 @@ if __name__ == '__main__':
     parser.add_argument('--exclude_function_words', dest='exclude_function_words', type=bool,
                         default=True,
                         help='whether or not to exclude function words from the pairs')
+    parser.add_argument('--layer', dest='layer', type=str, default=None,
+                        help='for input files holding several layers (see collect_bert_states.py --layers), '
+                             'the layer to collect the views of. by default, the first one')
 
     args = parser.parse_args()
 
-    collector_args = (args.input_path, args.num_examples, args.mode, args.exclude_function_words)
+    collector_args = (args.input_path, args.num_examples, args.mode, args.exclude_function_words, args.layer)
 
     if args.mode == "simple":
         collector = views_collector.SimpleCollector(*collector_args)
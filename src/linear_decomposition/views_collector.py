@@ -4,6 +4,10 @@ from typing import Dict, Tuple, List
 import numpy as np
 import tqdm
 import pickle
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "generate_dataset"))
+import packed_hdf5
 
 Equivalent_sentences_group = typing.NamedTuple("equivalent_sentences",
                                                [('vecs', np.ndarray), ('sents', List[List[str]]),
@@ -12,7 +16,7 @@ Equivalent_sentences_group = typing.NamedTuple("equivalent_sentences",
 
 class CollectorBase(object):
 
-    def __init__(self, path, view_size, method, exclude_function_words):
+    def __init__(self, path, view_size, method, exclude_function_words, layer=None):
         """
                 Parameters
                 -------------------------
@@ -22,10 +26,13 @@ class CollectorBase(object):
                        and contains datasets "vecs" (ELMO representations of the words), "sents" and "content indices"
                         (indices of content words)
                      (The format is described above in 'Equivalent_sentences_group'")
+                     Files of the packed layout (see packed_hdf5.py) are read through the same interface.
+                layer: str, optional.
+                      For files holding several layers of the encoder, the layer whose vectors are read.
                 """
 
         self.path = path
-        self.f = h5py.File(path, 'r')
+        self.f = packed_hdf5.open_file(path, layer)  # either the per-group or the packed layout
         self.view_size = view_size
         self.exclude_function_words = exclude_function_words
         self.method = method
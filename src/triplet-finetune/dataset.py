@@ -1,8 +1,12 @@
 from torch.utils import data
 import numpy as np
 import torch
-import pickle
 import h5py
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "generate_dataset"))
+import shards
+import groups_store
 
 
 CUDA = False
@@ -46,9 +50,8 @@ class PadCollate:
 class Dataset(data.Dataset):
     def __init__(self, data_path, filter_func = False):
 
-        with open(data_path, "rb") as f:
-
-            self.sents = list(pickle.load(f).values())
+        # a pickled dictionary of groups, or a group store (read lazily)
+        self.sents = groups_store.group_list(shards.load_equivalent_sentences(data_path))
 
         print("Dataset set size is {}".format(len(self.sents)))
 
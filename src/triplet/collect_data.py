@@ -6,6 +6,10 @@ import h5py
 import tqdm
 import pickle
 import random
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "generate_dataset"))
+import packed_hdf5
 
 Equivalent_sentences_group = typing.NamedTuple("equivalent_sentences",
                                     [('vecs', np.ndarray), ('sents', List[List[str]]),
@@ -15,7 +19,7 @@ MODE = "words"
 
 def collect_data(path, num_examples, num_examples_per_group,  min_length = 12, max_length = 35):
 
-    f = h5py.File(path, 'r')
+    f = packed_hdf5.open_file(path)  # either the per-group or the packed layout
     pbar = tqdm.tqdm(total=num_examples, ascii = True)
     data = []
     i = 0
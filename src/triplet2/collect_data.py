@@ -6,6 +6,10 @@ import h5py
 import tqdm
 import pickle
 import random
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "generate_dataset"))
+import packed_hdf5
 
 Equivalent_sentences_group = typing.NamedTuple("equivalent_sentences",
                                     [('vecs', np.ndarray), ('sents', List[List[str]]),
@@ -13,7 +17,7 @@ Equivalent_sentences_group = typing.NamedTuple("equivalent_sentences",
 
 def collect_data(path):
 
-    data_file = h5py.File(path, 'r')
+    data_file = packed_hdf5.open_file(path)  # either layout; "vecs" is upcast to float32
     pbar = tqdm.tqdm(total=35000, ascii = True)
     data = []
     i = 0